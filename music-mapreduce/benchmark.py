@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks the analysis jobs over synthetic transaction data.
+
+Generates a transactions zip in the format of data/small.txt, runs the jobs of
+main.py over it with the local runner and prints one JSON document with the
+throughput, peak memory, shuffle bytes and phase wall times of every job:
+
+  python benchmark.py --lines=1000000 --skew=1.2 --output=results.json
+
+Each job runs in its own process so that its peak RSS is not hidden by the
+jobs before it. The App Engine SDK must be on the Python path.
+"""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+
+import bisect
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+import zipfile
+
+import local_runner
+
+
+GENRES = ("Alternative", "Country", "Dance", "Hiphop", "Jazz", "Pop", "Rock")
+PRICES = ("0.59", "0.99", "1.29")
+
+# Default number of lines per zip member, which bounds the map shard count.
+LINES_PER_MEMBER = 1000000
+
+# Number of generated lines written to a member at once.
+_WRITE_BATCH = 10000
+
+
+def _catalogue(songs, rand):
+  """Returns the song lines of a synthetic catalogue, without user fields."""
+  artists = max(1, songs // 10)
+  catalogue = []
+  for i in xrange(songs):
+    seconds = rand.randint(120, 419)
+    catalogue.append("\t".join((
+        "Song %d" % i,
+        "Artist %d" % (i % artists),
+        "Album %d" % (i // 10),
+        GENRES[i % len(GENRES)],
+        "%d:%02d" % divmod(seconds, 60),
+        rand.choice(PRICES))))
+  return catalogue
+
+
+def _popularity(songs, skew):
+  """Returns cumulative Zipf weights of songs ranked by popularity."""
+  cumulative = []
+  total = 0.0
+  for rank in xrange(1, songs + 1):
+    total += 1.0 / rank ** skew
+    cumulative.append(total)
+  return cumulative
+
+
+def generate_lines(lines, songs=10000, users=None, basket_size=3, skew=1.0,
+                   seed=0):
+  """Yields synthetic transaction lines, without line separators.
+
+  Args:
+    lines: number of lines to generate.
+    songs: number of songs in the catalogue.
+    users: number of users, defaults to one per 10 lines.
+    basket_size: mean number of songs bought together. Basket sizes are
+      uniform between 1 and 2 * basket_size - 1.
+    skew: exponent of the Zipf distribution of song popularity. 0 makes all
+      songs equally popular.
+    seed: random seed, so that runs are reproducible.
+
+  Yields:
+    Lines in the format of data/small.txt. The lines of a basket are
+    consecutive and share their timestamp and user.
+  """
+  rand = random.Random(seed)
+  catalogue = _catalogue(songs, rand)
+  cumulative = _popularity(songs, skew)
+  total = cumulative[-1]
+  users = users or max(1, lines // 10)
+  generated = 0
+  while generated < lines:
+    prefix = "2017.%d.%d %d:%02d\tUser%d\t" % (
+        rand.randint(1, 12), rand.randint(1, 28), rand.randint(0, 23),
+        rand.randint(0, 59), rand.randrange(users))
+    size = min(rand.randint(1, 2 * basket_size - 1), lines - generated)
+    basket = set()
+    while len(basket) < min(size, songs):
+      basket.add(bisect.bisect_left(cumulative, rand.random() * total))
+    for song in basket:
+      yield prefix + catalogue[song]
+    generated += len(basket)
+
+
+def generate(path, lines, members=None, **kwargs):
+  """Writes a zip of synthetic transactions.
+
+  Args:
+    path: path of the zip file to write.
+    lines: number of lines to generate.
+    members: number of zip members, defaults to one per LINES_PER_MEMBER
+      lines.
+    **kwargs: generation parameters, see generate_lines.
+
+  Returns:
+    The uncompressed size of the transactions in bytes.
+  """
+  members = members or max(1, -(-lines // LINES_PER_MEMBER))
+  generated = generate_lines(lines, **kwargs)
+  size = 0
+  temp_dir = tempfile.mkdtemp()
+  try:
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as zf:
+      for member in xrange(members):
+        member_lines = (lines * (member + 1) // members -
+                        lines * member // members)
+        member_path = os.path.join(temp_dir, "transaction%d.txt" % (member + 1))
+        with open(member_path, "wb") as f:
+          while member_lines > 0:
+            batch = [line for (_, line) in zip(
+                xrange(min(member_lines, _WRITE_BATCH)), generated)]
+            if not batch:
+              break
+            f.write("\n".join(batch) + "\n")
+            member_lines -= len(batch)
+          size += f.tell()
+        zf.write(member_path, os.path.basename(member_path))
+        os.remove(member_path)
+  finally:
+    shutil.rmtree(temp_dir, ignore_errors=True)
+  return size
+
+
+def _peak_rss_kb():
+  """Returns the peak RSS in KB of this process and its waited children."""
+  return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+             resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def _run_job(conn, job_name, input_path, processes, options):
+  """Runs one job and sends its stats, or the error, through conn."""
+  output_dir = tempfile.mkdtemp(prefix=job_name + "-")
+  try:
+    pipeline_class = local_runner.analysis_pipelines()[job_name]
+    start = time.time()
+    (_, stats) = local_runner.run_analysis(
+        pipeline_class, input_path, output_dir, processes=processes,
+        **options)
+    stats["seconds"] = time.time() - start
+    stats["peak_rss_kb"] = _peak_rss_kb()
+    conn.send(stats)
+  except Exception:  # pylint: disable=broad-except
+    conn.send({"error": traceback.format_exc()})
+  finally:
+    shutil.rmtree(output_dir, ignore_errors=True)
+    conn.close()
+
+
+def run_job(job_name, input_path, lines, processes=None, options=None):
+  """Runs a job in a new process and returns its benchmark results.
+
+  Args:
+    job_name: name of the job, see local_runner.analysis_pipelines.
+    input_path: path of the input zip.
+    lines: number of lines in the input, to compute the throughput.
+    processes: number of worker processes of the job.
+    options: the job options, see AnalysisPipeline.job_params.
+
+  Returns:
+    A dict with the job name, the wall time in seconds, the input lines per
+    second, the peak RSS in KB of the job and its workers, the shuffle bytes,
+    the map output records and the wall time of each phase. If the job
+    failed, the dict has the job name and the error instead.
+  """
+  (parent_conn, child_conn) = multiprocessing.Pipe(False)
+  process = multiprocessing.Process(
+      target=_run_job,
+      args=(child_conn, job_name, input_path, processes, options or {}))
+  process.start()
+  stats = parent_conn.recv()
+  process.join()
+  if "error" in stats:
+    return {"job": job_name, "error": stats["error"]}
+  return {
+      "job": job_name,
+      "seconds": stats["seconds"],
+      "records_per_sec": lines / stats["seconds"],
+      "peak_rss_kb": stats["peak_rss_kb"],
+      "shuffle_bytes": stats["shuffle_bytes"],
+      "map_outputs": stats["map_outputs"],
+      "phases": stats["phases"],
+  }
+
+
+def _count_lines(path):
+  """Returns the number of lines and uncompressed bytes of a zip's members."""
+  lines = 0
+  size = 0
+  with zipfile.ZipFile(path) as zf:
+    for info in zf.infolist():
+      size += info.file_size
+      with zf.open(info) as member:
+        lines += sum(1 for _ in member)
+  return (lines, size)
+
+
+def main():
+  pipelines = local_runner.analysis_pipelines()
+  parser = optparse.OptionParser(
+      usage="%prog [options]",
+      description="Benchmarks the analysis jobs over synthetic transactions.")
+  parser.add_option("--lines", type="int", default=10 ** 5,
+                    help="number of transactions to generate.")
+  parser.add_option("--songs", type="int", default=10000,
+                    help="number of songs in the catalogue.")
+  parser.add_option("--users", type="int",
+                    help="number of users, defaults to one per 10 lines.")
+  parser.add_option("--basket-size", type="int", default=3,
+                    dest="basket_size", help="mean basket size.")
+  parser.add_option("--skew", type="float", default=1.0,
+                    help="Zipf exponent of song popularity, 0 for uniform.")
+  parser.add_option("--members", type="int",
+                    help="number of zip members, defaults to one per %d "
+                    "lines." % LINES_PER_MEMBER)
+  parser.add_option("--seed", type="int", default=0, help="random seed.")
+  parser.add_option("--input",
+                    help="benchmark this zip instead of generating one.")
+  parser.add_option("--keep-input", dest="keep_input",
+                    help="write the generated zip to this path and keep it.")
+  parser.add_option("--job", action="append", dest="jobs",
+                    choices=sorted(pipelines),
+                    help="job to run, may be repeated. Defaults to all jobs.")
+  parser.add_option("--processes", type="int",
+                    help="worker processes, defaults to the number of CPUs.")
+  parser.add_option("--option", action="append", dest="options", default=[],
+                    metavar="NAME=VALUE",
+                    help="job option such as top_k=3, may be repeated.")
+  parser.add_option("--output",
+                    help="file to write the results to, defaults to stdout.")
+  (flags, args) = parser.parse_args()
+  if args:
+    parser.error("unexpected arguments")
+  options = dict(local_runner.parse_option(option) for option in flags.options)
+  job_names = flags.jobs or sorted(pipelines)
+  # Each job gets the options it accepts, as in local_runner.main.
+  unused = local_runner.unaccepted_options(
+      [pipelines[job_name] for job_name in job_names], options)
+  if unused:
+    parser.error("no job accepts the options %s" % ", ".join(unused))
+
+  results = {
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "cpus": multiprocessing.cpu_count(),
+      "processes": flags.processes,
+      "options": options,
+  }
+  input_path = flags.input
+  temp_dir = None
+  try:
+    if input_path:
+      (lines, size) = _count_lines(input_path)
+      results["input"] = {"path": input_path}
+    else:
+      input_path = flags.keep_input
+      if not input_path:
+        temp_dir = tempfile.mkdtemp()
+        input_path = os.path.join(temp_dir, "transactions.zip")
+      generation = {
+          "lines": flags.lines,
+          "songs": flags.songs,
+          "users": flags.users,
+          "basket_size": flags.basket_size,
+          "skew": flags.skew,
+          "seed": flags.seed,
+      }
+      start = time.time()
+      size = generate(input_path, members=flags.members, **generation)
+      generation["seconds"] = time.time() - start
+      lines = flags.lines
+      results["input"] = generation
+    results["input"].update({
+        "lines": lines,
+        "bytes": size,
+        "compressed_bytes": os.path.getsize(input_path),
+    })
+
+    results["jobs"] = [
+        run_job(job_name, input_path, lines, processes=flags.processes,
+                options=local_runner.job_options(pipelines[job_name],
+                                                 options))
+        for job_name in job_names]
+  finally:
+    if temp_dir:
+      shutil.rmtree(temp_dir, ignore_errors=True)
+
+  out = open(flags.output, "w") if flags.output else sys.stdout
+  try:
+    json.dump(results, out, indent=2, sort_keys=True)
+    out.write("\n")
+  finally:
+    if flags.output:
+      out.close()
+
+
+if __name__ == "__main__":
+  main()
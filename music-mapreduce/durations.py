@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-genre song duration statistics, computed a file at a time.
+
+parse_columns turns the genre, duration and price columns of a whole file of
+transactions into arrays, and genre_stats sums and bins them per genre over
+the whole arrays at once. Both use NumPy when it is available and fall back to
+the array module and plain loops otherwise.
+
+The statistics of a genre are a GenreStats: the number of sales, their total
+duration and price and a histogram of their durations. GenreStats are encoded
+as varints so that they can be shuffle values, and merged by combiners and
+reducers.
+"""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+
+import array
+import re
+
+import transactions
+
+# pylint: disable=g-import-not-at-top
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# Width of a duration histogram bin, in seconds.
+BIN_SECONDS = 30
+
+# Number of histogram bins. The last bin also counts every longer song.
+BINS = 20
+
+_NUM_FIELDS = 8
+_GENRE_FIELD = 5
+_DURATION_FIELD = 6
+_PRICE_FIELD = 7
+
+
+class GenreStats(object):
+  """Duration statistics of the sales of a genre.
+
+  Attributes:
+    sales: number of songs sold.
+    seconds: total duration of the songs sold, in seconds.
+    cents: total price of the songs sold, in cents.
+    histogram: list of BINS counts of songs sold per duration bin.
+  """
+
+  __slots__ = ("sales", "seconds", "cents", "histogram")
+
+  def __init__(self, sales=0, seconds=0, cents=0, histogram=None):
+    self.sales = sales
+    self.seconds = seconds
+    self.cents = cents
+    self.histogram = histogram or [0] * BINS
+
+  def merge(self, other):
+    """Adds the statistics of other to these."""
+    self.sales += other.sales
+    self.seconds += other.seconds
+    self.cents += other.cents
+    self.histogram = [a + b for (a, b) in zip(self.histogram, other.histogram)]
+
+  def encode(self):
+    return "".join(transactions.encode_varint(value) for value in
+                   [self.sales, self.seconds, self.cents] + self.histogram)
+
+  @classmethod
+  def decode(cls, value):
+    numbers = list(transactions.decode_varints(value))
+    return cls(numbers[0], numbers[1], numbers[2], numbers[3:])
+
+
+# Columns of values that the NumPy conversions handle, joined by newlines.
+# Other forms, e.g. 'h:mm:ss' durations or prices with a sign or more than two
+# decimals, are left to transactions.parse_duration and parse_cents.
+_DURATIONS_RE = re.compile(r"(?:\d+:\d+\n)*\d+:\d+\Z")
+_PRICES_RE = re.compile(r"(?:\d+\.\d\d\n)*\d+\.\d\d\Z")
+
+
+def _numpy_pairs(values, pattern, sep):
+  """Converts 'a<sep>b' values of integers to an (a, b) array of rows.
+
+  Returns:
+    The array, or None if pattern does not match the values joined by
+    newlines.
+  """
+  joined = "\n".join(values)
+  if not pattern.match(joined):
+    return None
+  return numpy.fromstring(joined.replace(sep, "\n"), dtype=numpy.int64,
+                          sep="\n").reshape(-1, 2)
+
+
+def _numpy_seconds(durations):
+  """Converts 'm:ss' durations to seconds, or returns None if any is not."""
+  pairs = _numpy_pairs(durations, _DURATIONS_RE, ":")
+  if pairs is None:
+    return None
+  return pairs[:, 0] * 60 + pairs[:, 1]
+
+
+def _numpy_cents(prices):
+  """Converts 'd.cc' prices to cents, or returns None if any is not."""
+  pairs = _numpy_pairs(prices, _PRICES_RE, ".")
+  if pairs is None:
+    return None
+  return pairs[:, 0] * 100 + pairs[:, 1]
+
+
+def parse_columns(data):
+  """Parses the genre, duration and price columns of a file of transactions.
+
+  Lines that transactions.iter_transactions would skip are skipped.
+
+  Args:
+    data: the file contents, either as a string or as an iterable of lines.
+
+  Returns:
+    A (genres, seconds, cents) tuple of columns with one value per
+    transaction. genres is a list of strings. seconds and cents are integer
+    NumPy arrays if NumPy is available, and array.array otherwise.
+  """
+  if isinstance(data, basestring):
+    data = transactions.iter_lines(data)
+  genres = []
+  durations = []
+  prices = []
+  for line in data:
+    fields = line.rstrip("\r\n").split("\t")
+    if len(fields) >= _NUM_FIELDS:
+      genres.append(fields[_GENRE_FIELD])
+      durations.append(fields[_DURATION_FIELD])
+      prices.append(fields[_PRICE_FIELD])
+
+  if numpy and genres:
+    seconds = _numpy_seconds(durations)
+    cents = _numpy_cents(prices)
+    if seconds is not None and cents is not None:
+      return (genres, seconds, cents)
+
+  # Parse the values one by one, dropping the lines with a malformed value.
+  parsed_genres = []
+  seconds = array.array("l")
+  cents = array.array("l")
+  for (genre, duration, price) in zip(genres, durations, prices):
+    try:
+      duration = transactions.parse_duration(duration)
+      price = transactions.parse_cents(price)
+    except ValueError:
+      continue
+    parsed_genres.append(genre)
+    seconds.append(duration)
+    cents.append(price)
+  if numpy:
+    return (parsed_genres, numpy.array(seconds, dtype=numpy.int64),
+            numpy.array(cents, dtype=numpy.int64))
+  return (parsed_genres, seconds, cents)
+
+
+def _bin(seconds):
+  return min(max(seconds // BIN_SECONDS, 0), BINS - 1)
+
+
+def genre_stats(genres, seconds, cents):
+  """Computes the statistics of each genre of columns from parse_columns.
+
+  Returns:
+    A genre -> GenreStats dict.
+  """
+  if not genres:
+    return {}
+  if not numpy:
+    stats = {}
+    for (genre, duration, price) in zip(genres, seconds, cents):
+      entry = stats.get(genre)
+      if entry is None:
+        entry = stats[genre] = GenreStats()
+      entry.sales += 1
+      entry.seconds += duration
+      entry.cents += price
+      entry.histogram[_bin(duration)] += 1
+    return stats
+
+  (names, codes) = numpy.unique(numpy.array(genres), return_inverse=True)
+  bins = numpy.clip(seconds // BIN_SECONDS, 0, BINS - 1)
+  histograms = numpy.bincount(
+      codes * BINS + bins, minlength=len(names) * BINS).reshape(-1, BINS)
+  sales = numpy.bincount(codes, minlength=len(names))
+  stats = {}
+  for (i, genre) in enumerate(names):
+    # Not bincount with weights, which would sum in floats.
+    in_genre = codes == i
+    stats[str(genre)] = GenreStats(
+        int(sales[i]), int(seconds[in_genre].sum()),
+        int(cents[in_genre].sum()),
+        [int(count) for count in histograms[i]])
+  return stats
+
+
+def bin_label(i):
+  """Returns the label of a histogram bin, e.g. '3:30' for its lower bound."""
+  label = "%d:%02d" % divmod(i * BIN_SECONDS, 60)
+  if i == BINS - 1:
+    label += "+"
+  return label
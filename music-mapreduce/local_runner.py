@@ -0,0 +1,857 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs MapReduce jobs in-process against local files.
+
+run_mapreduce takes the same arguments as mapreduce_pipeline.MapreducePipeline
+and runs the job without App Engine services: map shards run in a
+multiprocessing pool, the shuffle hashes, sorts and merges records files in a
+local work directory, and the reduce output is written to a local directory.
+Blobstore input readers read the local file named by their blob key.
+
+The phases mirror the App Engine shuffle (map, hash, sort, merge, reduce) and
+their wall times are reported, so the runner can also be used to benchmark
+jobs. Run the jobs of main.py with:
+
+  python local_runner.py [--job=song_sold_num ...] [--option=top_k=3 ...] \
+      data/transactions.zip
+
+Each job gets the options its job_params accepts. The stages that merge the
+results of the leaderboards and incremental_metrics jobs after the MapReduce
+run locally too, see run_analysis.
+
+The App Engine SDK must be on the Python path.
+"""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+
+import collections
+import heapq
+import inspect
+import itertools
+import json
+import logging
+import multiprocessing
+import optparse
+import os
+import shutil
+import tempfile
+import time
+import zlib
+
+from mapreduce import columnar
+from mapreduce import context
+from mapreduce import input_readers
+from mapreduce import kv_format
+from mapreduce import model
+from mapreduce import operation
+from mapreduce import output_writers
+from mapreduce import records
+from mapreduce import shuffler
+from mapreduce import util
+from mapreduce.api import map_job
+
+
+# Maximum number of values per KeyValues record written by the merge phase,
+# as in shuffler._MergePipeline.
+_MAX_VALUES_COUNT = 100000
+
+# Order of the phases in the reported wall times.
+PHASES = ("map", "hash", "sort", "merge", "reduce")
+
+
+def _open_local(path):
+  """Blobstore reader replacement: opens the local file named path."""
+  return open(path, "rb")
+
+
+class _LocalShardState(object):
+  """Stands in for model.ShardState in the context of a local shard."""
+
+  def __init__(self, shard_id):
+    self.shard_id = shard_id
+    self.counters_map = model.CountersMap()
+
+  def get_shard_id(self):
+    return self.shard_id
+
+
+class _LocalShardContext(object):
+  """Stands in for map_job_context.ShardContext and SliceContext.
+
+  Outputs passed to emit() are handed to the emit callable.
+  """
+
+  def __init__(self, ctx, shard_number, emit):
+    self._ctx = ctx
+    self.id = ctx.shard_id
+    self.number = shard_number
+    self.attempt = 1
+    self.shard_context = self
+    self.emit = emit
+
+  def incr(self, counter_name, delta=1):
+    self._ctx.counters.increment(counter_name, delta)
+
+  def counter(self, counter_name, default=0):
+    return self._ctx._shard_state.counters_map.get(counter_name, default)
+
+
+def _make_context(job, phase, shard_number, params, handler_spec):
+  """Creates the context of a local shard and makes it current."""
+  mapper_spec = model.MapperSpec(handler_spec,
+                                 job["input_reader_spec"],
+                                 params,
+                                 job["shards"])
+  mapreduce_spec = model.MapreduceSpec(job["job_name"],
+                                       "%s-%s" % (job["job_name"], phase),
+                                       mapper_spec.to_json())
+  ctx = context.Context(mapreduce_spec, _LocalShardState(
+      "%s-%s-%d" % (job["job_name"], phase, shard_number)))
+  context.Context._set(ctx)
+  return ctx
+
+
+def _handle_outputs(ctx, result, emit):
+  """Emits the outputs of a map or reduce function call."""
+  if not util.is_generator(result):
+    return
+  for output in result:
+    if isinstance(output, operation.Operation):
+      output(ctx)
+    else:
+      emit(output)
+
+
+def _write_key_value(writer, data, shuffle_format):
+  """Writes a (key, value) map output as a KeyValue record."""
+  writer.write(kv_format.encode_key_value(str(data[0]), str(data[1]),
+                                          shuffle_format))
+
+
+def _read_key_values(path):
+  """Yields the (key, value) pairs of a records file of KeyValue records."""
+  with open(path, "rb") as f:
+    for record in records.RecordsReader(f):
+      yield kv_format.decode_key_value(record)
+
+
+def _run_handler(ctx, handler, shard_number, inputs, emit,
+                 expand_parameters=False):
+  """Calls a map or reduce handler on every input of a shard.
+
+  Args:
+    ctx: the context of the shard.
+    handler: the handler, a function or a map_job.Mapper instance.
+    shard_number: the number of the shard.
+    inputs: the shard's input, as yielded by its input reader.
+    emit: callable to pass the handler's outputs to.
+    expand_parameters: whether function handlers take each input as
+      positional arguments, like reducers do.
+  """
+  if isinstance(handler, map_job.Mapper):
+    shard_ctx = _LocalShardContext(ctx, shard_number, emit)
+    handler.begin_shard(shard_ctx)
+    handler.begin_slice(shard_ctx)
+    for data in inputs:
+      if data is not input_readers.ALLOW_CHECKPOINT:
+        handler(shard_ctx, data)
+    handler.end_slice(shard_ctx)
+    # Like the App Engine handler, end the shard with a slice without input.
+    handler.begin_slice(shard_ctx)
+    handler.end_slice(shard_ctx)
+    handler.end_shard(shard_ctx)
+  else:
+    for data in inputs:
+      if data is input_readers.ALLOW_CHECKPOINT:
+        continue
+      if expand_parameters:
+        result = handler(*data)
+      else:
+        result = handler(data)
+      _handle_outputs(ctx, result, emit)
+
+
+class _SortedRuns(object):
+  """Writes map output as sorted runs per reduce shard.
+
+  Like shuffler._SortedRunsGCSOutputWriter, records are buffered per reduce
+  shard, and each buffer is sorted and written to a new file when they get
+  too large and when the map shard is done.
+
+  Attributes:
+    runs: list of the paths of the runs of each reduce shard.
+  """
+
+  def __init__(self, path, reduce_shards, shuffle_format):
+    self._path = path
+    self._shuffle_format = shuffle_format
+    self._buffers = [[] for _ in range(reduce_shards)]
+    self._size = 0
+    self.runs = [[] for _ in range(reduce_shards)]
+
+  def write(self, data):
+    key = str(data[0])
+    record = kv_format.encode_key_value(key, str(data[1]),
+                                        self._shuffle_format)
+    # Unlike str.__hash__, crc32 is the same in every worker process.
+    bucket = (zlib.crc32(key) & 0xffffffff) % len(self._buffers)
+    self._buffers[bucket].append((key, record))
+    self._size += len(record)
+    if self._size > shuffler._SortedRunsGCSOutputWriter._MAX_RUN_SIZE:
+      self.flush()
+
+  def flush(self):
+    for bucket, key_records in enumerate(self._buffers):
+      if not key_records:
+        continue
+      key_records.sort(key=lambda key_record: key_record[0])
+      path = "%s-bucket-%d-run-%d" % (self._path, bucket,
+                                      len(self.runs[bucket]))
+      with open(path, "wb") as f:
+        with records.RecordsWriter(f) as writer:
+          writer.write_many(record for (_, record) in key_records)
+      self.runs[bucket].append(path)
+    self._buffers = [[] for _ in self._buffers]
+    self._size = 0
+
+
+def _map_shard(args):
+  """Runs one map shard, writing its output as KeyValue records.
+
+  Returns:
+    A (number of outputs, counters, runs) tuple. If the job sorts map output,
+    runs is the list of the sorted runs of each reduce shard, see _SortedRuns.
+    Otherwise runs is None, and the output is written to path.
+  """
+  (job, shard_number, reader, path, reduce_shards) = args
+  ctx = _make_context(job, "map", shard_number, job["mapper_params"],
+                      job["mapper_spec"])
+  handler = util.handler_for_name(job["mapper_spec"])
+  outputs = [0]
+  if job["sort_map_output"]:
+    sorted_runs = _SortedRuns(path, reduce_shards, job["shuffle_format"])
+
+    def emit(data):
+      sorted_runs.write(data)
+      outputs[0] += 1
+
+    _run_handler(ctx, handler, shard_number, reader, emit)
+    sorted_runs.flush()
+    return (outputs[0], ctx._shard_state.counters_map.counters,
+            sorted_runs.runs)
+
+  with open(path, "wb") as f:
+    writer = records.RecordsWriter(f)
+
+    def emit(data):
+      _write_key_value(writer, data, job["shuffle_format"])
+      outputs[0] += 1
+
+    _run_handler(ctx, handler, shard_number, reader, emit)
+    writer.close()
+  return (outputs[0], ctx._shard_state.counters_map.counters, None)
+
+
+def _sample_file(path):
+  """Returns the bytes per key of the first records of a map output file."""
+  key_sizes = collections.Counter()
+  with open(path, "rb") as f:
+    for record in itertools.islice(
+        records.RecordsReader(f),
+        shuffler._SampleHotKeysPipeline._SAMPLE_RECORDS):
+      key_sizes[kv_format.decode_key(record)] += len(record)
+  return key_sizes
+
+
+def _hash_file(args):
+  """Splits a map output file into one file per reduce shard by key hash.
+
+  Like shuffler._HashingGCSOutputWriter, hot keys are salted round-robin
+  into reduce_shards more files, starting at salt.
+  """
+  (path, reduce_shards, hot_keys, salt, shuffle_format) = args
+  files = {}
+  writers = {}
+  try:
+    with open(path, "rb") as f:
+      for record in records.RecordsReader(f):
+        key = kv_format.decode_key(record)
+        # Unlike str.__hash__, crc32 is the same in every worker process.
+        key_hash = zlib.crc32(key) & 0xffffffff
+        if key in hot_keys:
+          shard = reduce_shards + (key_hash + salt) % reduce_shards
+          (key, value) = kv_format.decode_key_value(record)
+          record = kv_format.encode_key_value(
+              shuffler._salt_key(key, salt), value, shuffle_format)
+          salt = (salt + 1) % reduce_shards
+        else:
+          shard = key_hash % reduce_shards
+        if shard not in writers:
+          files[shard] = open("%s-bucket-%d" % (path, shard), "wb")
+          writers[shard] = records.RecordsWriter(files[shard])
+        writers[shard].write(record)
+  finally:
+    for shard, writer in writers.iteritems():
+      writer.close()
+      files[shard].close()
+  return dict((shard, f.name) for shard, f in files.iteritems())
+
+
+def _sort_file(path):
+  """Sorts a records file of KeyValue records by key."""
+  key_records = []
+  with open(path, "rb") as f:
+    for record in records.RecordsReader(f):
+      key_records.append((kv_format.decode_key(record), record))
+  key_records.sort(key=lambda key_record: key_record[0])
+  with open(path + "-sorted", "wb") as f:
+    with records.RecordsWriter(f) as writer:
+      writer.write_many(record for (_, record) in key_records)
+  return path + "-sorted"
+
+
+def _merge_files(args):
+  """Merges sorted files into one file of KeyValues records, one per key."""
+  (paths, out_path, shuffle_format) = args
+  merged = heapq.merge(*[_read_key_values(path) for path in paths])
+  with open(out_path, "wb") as f:
+    with records.RecordsWriter(f) as writer:
+      for (key, key_values) in itertools.groupby(merged, lambda kv: kv[0]):
+        values = []
+        for (_, value) in key_values:
+          values.append(value)
+          if len(values) >= _MAX_VALUES_COUNT:
+            writer.write(
+                kv_format.encode_key_values(key, values, shuffle_format))
+            values = []
+        if values:
+          writer.write(kv_format.encode_key_values(key, values, shuffle_format))
+  return out_path
+
+
+def _read_reducer_input(ctx, path, combiner):
+  """Yields (key, values) from a merged file, like input_readers._ReducerReader.
+  """
+  current_key = None
+  current_values = None
+  with open(path, "rb") as f:
+    for record in records.RecordsReader(f):
+      (key, values) = kv_format.decode_key_values(record)
+      if current_key is not None and current_key != key:
+        yield (current_key, current_values)
+        current_key = None
+      if current_key is None:
+        current_key = key
+        current_values = []
+      if combiner:
+        combined = []
+        _handle_outputs(ctx, combiner(current_key, values, current_values),
+                        combined.append)
+        current_values = combined
+      else:
+        current_values.extend(values)
+  if current_key is not None:
+    yield (current_key, current_values)
+
+
+class _LocalOutput(object):
+  """Writes reduce output to local files, the way the output writer would.
+
+  Records output writers get records files, columnar output writers get
+  columnar files, partitioned output writers get one file per partition and
+  other output writers get text files.
+  """
+
+  def __init__(self, output_writer_spec, output_dir, job_name, shard_number,
+               writer_params=None):
+    writer_class = (output_writer_spec and
+                    util.for_name(output_writer_spec) or None)
+    self._partitioned = bool(writer_class) and issubclass(
+        writer_class, output_writers._GoogleCloudStoragePartitionedOutputWriter)
+    self._records = bool(writer_class) and issubclass(
+        writer_class, output_writers._GoogleCloudStorageRecordOutputWriterBase)
+    self._columnar = bool(writer_class) and issubclass(
+        writer_class, output_writers._GoogleCloudStorageColumnarOutputWriter)
+    self._writer_params = writer_params or {}
+    self._output_dir = output_dir
+    self._basename = "%s-output-%d" % (job_name, shard_number)
+    self._files = collections.OrderedDict()
+
+  def _file(self, partition):
+    if partition not in self._files:
+      if partition is None:
+        dirname = self._output_dir
+      else:
+        dirname = os.path.join(
+            self._output_dir,
+            output_writers._GoogleCloudStoragePartitionedOutputWriter
+            ._partition_path(partition))
+      try:
+        os.makedirs(dirname)
+      except OSError:
+        # Another reduce shard may have created it.
+        if not os.path.isdir(dirname):
+          raise
+      f = open(os.path.join(dirname, self._basename), "wb")
+      writer = None
+      if self._records:
+        writer = records.RecordsWriter(f)
+      elif self._columnar:
+        writer = columnar.ColumnarWriter(
+            f, self._writer_params["columns"],
+            block_rows=self._writer_params.get(
+                "block_rows", columnar.DEFAULT_BLOCK_ROWS))
+      self._files[partition] = (f, writer)
+    return self._files[partition]
+
+  def write(self, data):
+    partition = None
+    if self._partitioned:
+      (partition, data) = data
+      if isinstance(partition, list):
+        partition = tuple(partition)
+    (f, writer) = self._file(partition)
+    if writer:
+      writer.write(data)
+    else:
+      f.write(data)
+
+  def close(self):
+    """Closes all files and returns their names."""
+    filenames = []
+    for (f, writer) in self._files.itervalues():
+      if writer:
+        writer.close()
+      f.close()
+      filenames.append(f.name)
+    return filenames
+
+
+def _reduce_file(args):
+  """Runs one reduce shard over a merged file."""
+  (job, shard_number, path) = args
+  params = dict(job["reducer_params"] or {})
+  params["combiner_spec"] = job["combiner_spec"]
+  ctx = _make_context(job, "reduce", shard_number, params, job["reducer_spec"])
+  reducer = util.handler_for_name(job["reducer_spec"])
+  combiner = (job["combiner_spec"] and
+              util.handler_for_name(job["combiner_spec"]) or None)
+  output = _LocalOutput(job["output_writer_spec"], job["output_dir"],
+                        job["job_name"], shard_number,
+                        params.get("output_writer"))
+  _run_handler(ctx, reducer, shard_number,
+               _read_reducer_input(ctx, path, combiner), output.write,
+               expand_parameters=True)
+  return (output.close(), ctx._shard_state.counters_map.counters)
+
+
+def _reduce_hot_file(args):
+  """Combines the sub-keys of a merged file of hot keys and unsalts them.
+
+  This is the first stage of hot keys, see mapreduce_pipeline.ReducePipeline.
+  The output is a records file of KeyValue records, like map output.
+  """
+  (job, shard_number, path, out_path) = args
+  params = dict(job["reducer_params"] or {})
+  params["combiner_spec"] = job["combiner_spec"]
+  ctx = _make_context(job, "reduce-hot", shard_number, params,
+                      job["reducer_spec"])
+  combiner = util.handler_for_name(job["combiner_spec"])
+  with open(out_path, "wb") as f:
+    with records.RecordsWriter(f) as writer:
+      for (key, values) in _read_reducer_input(ctx, path, combiner):
+        key = shuffler._unsalt_key(key)
+        for value in values:
+          _write_key_value(writer, (key, value), job["shuffle_format"])
+  return out_path
+
+
+def _timed(phases, phase, function, *args):
+  """Calls function, adding its wall time to phases[phase]."""
+  start = time.time()
+  result = function(*args)
+  phases[phase] = phases.get(phase, 0) + time.time() - start
+  return result
+
+
+def _shuffle(run, phases, map_files, reduce_shards, hot_keys, work_dir,
+             shuffle_format):
+  """Hashes, sorts and merges map output files.
+
+  Returns:
+    The merged files, one per reduce shard. If there are hot keys, they are
+    followed by as many files of their salted sub-keys.
+  """
+  buckets = [[] for _ in range(reduce_shards * (2 if hot_keys else 1))]
+  hashed = _timed(phases, "hash", run, _hash_file, [
+      (path, reduce_shards, hot_keys, i % reduce_shards, shuffle_format)
+      for i, path in enumerate(map_files)])
+  for shard_paths in hashed:
+    for shard, path in shard_paths.iteritems():
+      buckets[shard].append(path)
+
+  sorted_files = iter(_timed(phases, "sort", run, _sort_file,
+                             [path for paths in buckets for path in paths]))
+  buckets = [[next(sorted_files) for _ in paths] for paths in buckets]
+  return _merge(run, phases, buckets, work_dir, shuffle_format)
+
+
+def _merge(run, phases, buckets, work_dir, shuffle_format):
+  """Merges the sorted files of each reduce shard into one file.
+
+  Returns:
+    The merged files, one per reduce shard.
+  """
+  return _timed(phases, "merge", run, _merge_files, [
+      (paths, os.path.join(work_dir, "merged-%d" % i), shuffle_format)
+      for i, paths in enumerate(buckets)])
+
+
+def _reduce(run, phases, job, merged_files, counters):
+  """Reduces merged files, returning the output files."""
+  filenames = []
+  for (shard_filenames, shard_counters) in _timed(
+      phases, "reduce", run, _reduce_file,
+      [(job, i, path) for i, path in enumerate(merged_files)]):
+    filenames.extend(shard_filenames)
+    counters.update(shard_counters)
+  return filenames
+
+
+def _split_input(job):
+  """Returns the input readers of the map shards."""
+  mapper_spec = model.MapperSpec(job["mapper_spec"],
+                                 job["input_reader_spec"],
+                                 job["mapper_params"],
+                                 job["shards"])
+  reader_class = mapper_spec.input_reader_class()
+  if "_reader" in inspect.getargspec(reader_class.split_input).args:
+    return reader_class.split_input(mapper_spec, _reader=_open_local)
+  return reader_class.split_input(mapper_spec)
+
+
+def run_mapreduce(job_name,
+                  mapper_spec,
+                  reducer_spec,
+                  input_reader_spec,
+                  output_writer_spec=None,
+                  mapper_params=None,
+                  reducer_params=None,
+                  shards=None,
+                  combiner_spec=None,
+                  reduce_shards=None,
+                  output_dir="output",
+                  processes=None,
+                  work_dir=None,
+                  detect_hot_keys=False,
+                  shuffle_format=kv_format.FORMAT_PROTO,
+                  sort_map_output=False,
+                  hot_key_share=None):
+  """Runs a MapReduce job locally.
+
+  Args:
+    job_name: job name as string.
+    mapper_spec: specification of mapper to use.
+    reducer_spec: specification of reducer to use.
+    input_reader_spec: specification of input reader to read data from.
+    output_writer_spec: specification of output writer to save reduce output
+      to. Only used to choose the format of the local output files.
+    mapper_params: parameters to use for mapper phase.
+    reducer_params: parameters to use for reduce phase.
+    shards: number of map shards to use as int.
+    combiner_spec: Optional. Specification of a combine function.
+    reduce_shards: Optional. Number of reduce shards. Defaults to the number
+      of map shards.
+    output_dir: directory to write the reduce output to.
+    processes: number of worker processes, defaults to the number of CPUs. If
+      1, the job runs in the calling process.
+    work_dir: directory for the shuffle files, removed when the job is done.
+      Defaults to a new temporary directory.
+    detect_hot_keys: whether to salt hot keys, see
+      mapreduce_pipeline.MapreducePipeline.
+    shuffle_format: kv_format version of the shuffle records.
+    sort_map_output: whether map shards write sorted runs per reduce shard,
+      which are then only merged, see mapreduce_pipeline.MapreducePipeline.
+      Hot keys are not detected then.
+    hot_key_share: fraction of a reduce shard's fair share that makes a key
+      hot, see mapreduce_pipeline.MapreducePipeline.
+
+  Returns:
+    A (filenames, stats) tuple. filenames lists the output files. stats is a
+    dict with the wall time of each phase in seconds ('phases'), the number of
+    map output records ('map_outputs'), the bytes they take in the shuffle
+    ('shuffle_bytes'), the number of salted hot keys ('hot_keys') and the job
+    counters ('counters').
+  """
+  job = {
+      "job_name": job_name,
+      "mapper_spec": mapper_spec,
+      "reducer_spec": reducer_spec,
+      "input_reader_spec": input_reader_spec,
+      "output_writer_spec": output_writer_spec,
+      "mapper_params": mapper_params or {},
+      "reducer_params": reducer_params or {},
+      "shards": shards or 1,
+      "combiner_spec": combiner_spec,
+      "output_dir": output_dir,
+      "shuffle_format": shuffle_format,
+      "sort_map_output": sort_map_output,
+  }
+  temp_dir = tempfile.mkdtemp(prefix=job_name + "-", dir=work_dir)
+  pool = None
+  if processes != 1:
+    pool = multiprocessing.Pool(processes)
+  run = pool and pool.map or map
+
+  phases = collections.OrderedDict((phase, 0) for phase in PHASES)
+  counters = collections.Counter()
+  try:
+    start = time.time()
+    readers = _split_input(job)
+    map_files = [os.path.join(temp_dir, "map-%d" % i)
+                 for i in range(len(readers))]
+    reduce_shards = min(reduce_shards or len(readers), len(readers)) or 1
+    map_outputs = 0
+    buckets = [[] for _ in range(reduce_shards)]
+    for (shard_outputs, shard_counters, shard_runs) in run(_map_shard, [
+        (job, i, reader, path, reduce_shards)
+        for i, (reader, path) in enumerate(zip(readers, map_files))]):
+      map_outputs += shard_outputs
+      counters.update(shard_counters)
+      for bucket, runs in enumerate(shard_runs or []):
+        buckets[bucket].extend(runs)
+    phases["map"] = time.time() - start
+
+    hot_keys = []
+    if sort_map_output:
+      shuffle_bytes = sum(os.path.getsize(path)
+                          for runs in buckets for path in runs)
+      merged_files = _merge(run, phases, buckets, temp_dir, shuffle_format)
+    else:
+      shuffle_bytes = sum(os.path.getsize(path) for path in map_files)
+      if combiner_spec and detect_hot_keys:
+        key_sizes = collections.Counter()
+        for sample in _timed(phases, "hash", run, _sample_file, map_files):
+          key_sizes.update(sample)
+        if hot_key_share is None:
+          hot_key_share = shuffler._SampleHotKeysPipeline._HOT_KEY_SHARE
+        hot_keys = shuffler._find_hot_keys(
+            key_sizes, reduce_shards, hot_key_share,
+            shuffler._SampleHotKeysPipeline._MAX_HOT_KEYS)
+      merged_files = _shuffle(run, phases, map_files, reduce_shards,
+                              frozenset(hot_keys), temp_dir, shuffle_format)
+    filenames = _reduce(run, phases, job, merged_files[:reduce_shards],
+                        counters)
+
+    if hot_keys:
+      # Combine the sub-keys of hot keys, then shuffle and reduce the partial
+      # results of each hot key again.
+      hot_dir = os.path.join(temp_dir, "hot")
+      os.mkdir(hot_dir)
+      partials = _timed(phases, "reduce", run, _reduce_hot_file, [
+          (job, i, path, os.path.join(hot_dir, "partial-%d" % i))
+          for i, path in enumerate(merged_files[reduce_shards:])])
+      hot_job = dict(job, job_name=job_name + "-hot")
+      filenames.extend(_reduce(
+          run, phases, hot_job,
+          _shuffle(run, phases, partials, reduce_shards, frozenset(),
+                   hot_dir, shuffle_format),
+          counters))
+  finally:
+    if pool:
+      pool.terminate()
+      pool.join()
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+  return (sorted(filenames),
+          {"phases": phases,
+           "map_outputs": map_outputs,
+           "shuffle_bytes": shuffle_bytes,
+           "hot_keys": len(hot_keys),
+           "counters": dict(counters)})
+
+
+def analysis_pipelines():
+  """Returns the job name -> AnalysisPipeline subclass dict of main.py."""
+  import main as jobs  # pylint: disable=g-import-not-at-top
+
+  return dict((cls.job_name, cls)
+              for cls in vars(jobs).itervalues()
+              if inspect.isclass(cls) and
+              issubclass(cls, jobs.AnalysisPipeline) and cls.job_name)
+
+
+def _merge_leaderboards(filenames, output_dir, top_n=20):
+  """Writes the global leaderboards, like main.MergeLeaderboards.
+
+  Returns:
+    The names of the leaderboard files.
+  """
+  import main as jobs  # pylint: disable=g-import-not-at-top
+
+  os.makedirs(output_dir)
+  merged = []
+  for name, lines in sorted(
+      jobs.merge_leaderboards(filenames, top_n, _open=open).iteritems()):
+    merged.append(os.path.join(output_dir, name))
+    with open(merged[-1], "w") as f:
+      f.writelines(lines)
+  return merged
+
+
+def _merge_snapshots(filenames, output_dir):
+  """Writes the snapshot and report of each metric, like main.MergeSnapshots.
+
+  There is no history of uploads locally, so the snapshots hold the totals of
+  the input alone.
+
+  Returns:
+    The names of the snapshot and report files.
+  """
+  import main as jobs  # pylint: disable=g-import-not-at-top
+
+  writer = output_writers.GoogleCloudStoragePartitionedOutputWriter
+  partials = collections.defaultdict(list)
+  for filename in filenames:
+    partials["".join(writer.get_partition(filename))].append(filename)
+  os.makedirs(output_dir)
+  merged = []
+  for metric, metric_files in sorted(partials.iteritems()):
+    snapshot_name = os.path.join(output_dir, metric + "-snapshot")
+    report_name = os.path.join(output_dir, metric + "-report")
+    readers = [open(filename) for filename in metric_files]
+    try:
+      with open(snapshot_name, "w") as snapshot:
+        with open(report_name, "w") as report:
+          jobs.write_snapshot(metric, readers, snapshot, report)
+    finally:
+      for reader in readers:
+        reader.close()
+    merged.extend((snapshot_name, report_name))
+  return merged
+
+
+# Local versions of the stages that AnalysisPipeline.store_output runs after
+# some jobs, by job name. They take the job's output files, a directory to
+# write to and the options of store_output, and return the files they wrote.
+_POST_STAGES = {
+    "leaderboards": _merge_leaderboards,
+    "incremental_metrics": _merge_snapshots,
+}
+
+
+def _accepted_options(function, options):
+  """Returns the options that are named arguments of function."""
+  names = inspect.getargspec(function).args
+  return dict((name, value) for name, value in options.iteritems()
+              if name in names)
+
+
+def job_options(pipeline_class, options):
+  """Returns the options accepted by the job_params of an AnalysisPipeline."""
+  return _accepted_options(pipeline_class.job_params, options)
+
+
+def unaccepted_options(pipeline_classes, options):
+  """Returns the sorted names of the options that none of the jobs accept."""
+  unused = set(options)
+  for pipeline_class in pipeline_classes:
+    unused.difference_update(job_options(pipeline_class, options))
+  return sorted(unused)
+
+
+def run_analysis(pipeline_class, input_path, output_dir, processes=None,
+                 **options):
+  """Runs the job of an AnalysisPipeline subclass over a local zip.
+
+  Jobs whose results are merged by a stage after the MapReduce (see
+  AnalysisPipeline.store_output) also run a local version of that stage,
+  which writes to the 'merged' subdirectory of output_dir.
+
+  Args:
+    pipeline_class: the AnalysisPipeline subclass.
+    input_path: path of the input zip file.
+    output_dir: directory to write the reduce output to.
+    processes: number of worker processes, see run_mapreduce.
+    **options: the job options, see AnalysisPipeline.job_params.
+
+  Returns:
+    The (filenames, stats) tuple of run_mapreduce. filenames also lists the
+    files of the merge stage, whose wall time is reported as the 'post' phase.
+  """
+  (job_args, job_kwargs) = pipeline_class.mapreduce_args(
+      input_path, {}, _reader=_open_local, **options)
+  (filenames, stats) = run_mapreduce(*job_args, output_dir=output_dir,
+                                     processes=processes, **job_kwargs)
+  post_stage = _POST_STAGES.get(pipeline_class.job_name)
+  if post_stage:
+    start = time.time()
+    filenames = filenames + post_stage(
+        filenames, os.path.join(output_dir, "merged"),
+        **_accepted_options(pipeline_class.store_output, options))
+    stats["phases"]["post"] = time.time() - start
+  return (filenames, stats)
+
+
+def parse_option(option):
+  """Parses a --option name=value argument, with a JSON or string value."""
+  (name, _, value) = option.partition("=")
+  try:
+    return (name, json.loads(value))
+  except ValueError:
+    return (name, value)
+
+
+def main():
+  pipelines = analysis_pipelines()
+  parser = optparse.OptionParser(
+      usage="%prog [options] INPUT_ZIP",
+      description="Runs the analysis jobs over a local transactions zip.")
+  parser.add_option("--job", action="append", dest="jobs",
+                    choices=sorted(pipelines),
+                    help="job to run, may be repeated. Defaults to all jobs.")
+  parser.add_option("--output", default="output",
+                    help="output directory, one subdirectory per job.")
+  parser.add_option("--processes", type="int",
+                    help="worker processes, defaults to the number of CPUs.")
+  parser.add_option("--option", action="append", dest="options", default=[],
+                    metavar="NAME=VALUE",
+                    help="job option such as top_k=3, may be repeated.")
+  (flags, args) = parser.parse_args()
+  if len(args) != 1:
+    parser.error("expected one input zip")
+  options = dict(parse_option(option) for option in flags.options)
+  job_names = flags.jobs or sorted(pipelines)
+  # Each job gets the options it accepts, and an option no job accepts is
+  # most likely misspelled.
+  unused = unaccepted_options(
+      [pipelines[job_name] for job_name in job_names], options)
+  if unused:
+    parser.error("no job accepts the options %s" % ", ".join(unused))
+
+  for job_name in job_names:
+    (filenames, stats) = run_analysis(
+        pipelines[job_name], args[0], os.path.join(flags.output, job_name),
+        processes=flags.processes,
+        **job_options(pipelines[job_name], options))
+    logging.info("%s: wrote %d files", job_name, len(filenames))
+    print json.dumps(dict(stats, job=job_name, files=filenames), indent=2)
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  main()
@@ -30,12 +30,14 @@ Bunch)"""
 # Using opensource naming conventions, pylint: disable=g-bad-name
 
 import datetime
+import heapq
+import itertools
 import jinja2
 import logging
 import re
-import operator
 import urllib
 import webapp2
+import zipfile
 
 from google.appengine.ext import blobstore
 from google.appengine.ext import db
@@ -46,10 +48,21 @@ from google.appengine.api import app_identity
 from google.appengine.api import taskqueue
 from google.appengine.api import users
 
+import cloudstorage
+
 from mapreduce import base_handler
+from mapreduce import context
+from mapreduce import kv_format
 from mapreduce import mapreduce_pipeline
 from mapreduce import operation as op
+from mapreduce import output_writers
 from mapreduce import shuffler
+from mapreduce.api import map_job
+
+import durations
+import sketches
+import timeseries
+import transactions
 
 
 class FileMetadata(db.Model):
@@ -57,13 +70,14 @@ class FileMetadata(db.Model):
 
   Specifially, we want to keep track of who uploaded it, where they uploaded it
   from (right now they can only upload from their computer, but in the future
-  urlfetch would be nice to add), and links to the results of their MR jobs. To
-  enable our querying to scan over our input data, we store keys in the form
-  'user/date/blob_key', where 'user' is the given user's e-mail address, 'date'
-  is the date and time that they uploaded the item on, and 'blob_key'
-  indicates the location in the Blobstore that the item can be found at. '/'
-  is not the actual separator between these values - we use '..' since it is
-  an illegal set of characters for an e-mail address to contain.
+  urlfetch would be nice to add), and (as ResultManifest children) links to the
+  results of their MR jobs. To enable our querying to scan over our input data,
+  we store keys in the form 'user/date/blob_key', where 'user' is the given
+  user's e-mail address, 'date' is the date and time that they uploaded the
+  item on, and 'blob_key' indicates the location in the Blobstore that the item
+  can be found at. '/' is not the actual separator between these values - we
+  use '..' since it is an illegal set of characters for an e-mail address to
+  contain.
   """
 
   __SEP = ".."
@@ -74,45 +88,6 @@ class FileMetadata(db.Model):
   uploadedOn = db.DateTimeProperty()
   source = db.StringProperty()
   blobkey = db.StringProperty()
-  songsoldnum_link = db.StringProperty()
-  dollarsong_link = db.StringProperty()
-  songartist_link = db.StringProperty()
-  dollarartist_link = db.StringProperty()
-  jazzsongsoldnum_link = db.StringProperty()
-  jazzdollarsong_link = db.StringProperty()
-  jazzsongartist_link = db.StringProperty()
-  jazzdollarartist_link = db.StringProperty()
-  mostbuytogether_link = db.StringProperty()
-
-
-  songsoldnum_link1 = db.StringProperty()
-  songsoldnum_link2 = db.StringProperty()
-  songsoldnum_link3 = db.StringProperty()
-  dollarsong_link1 = db.StringProperty()
-  dollarsong_link2 = db.StringProperty()
-  dollarsong_link3 = db.StringProperty()
-  songartist_link1 = db.StringProperty()
-  songartist_link2 = db.StringProperty()
-  songartist_link3 = db.StringProperty()
-  dollarartist_link1 = db.StringProperty()
-  dollarartist_link2 = db.StringProperty()
-  dollarartist_link3 = db.StringProperty()
-  jazzsongsoldnum_link1 = db.StringProperty()
-  jazzsongsoldnum_link2 = db.StringProperty()
-  jazzsongsoldnum_link3 = db.StringProperty()
-  jazzdollarsong_link1 = db.StringProperty()
-  jazzdollarsong_link2 = db.StringProperty()
-  jazzdollarsong_link3 = db.StringProperty()
-  jazzsongartist_link1 = db.StringProperty()
-  jazzsongartist_link2 = db.StringProperty()
-  jazzsongartist_link3 = db.StringProperty()
-  jazzdollarartist_link1 = db.StringProperty()
-  jazzdollarartist_link2 = db.StringProperty()
-  jazzdollarartist_link3 = db.StringProperty()
-  mostbuytogether_link1 = db.StringProperty()
-  mostbuytogether_link2 = db.StringProperty()
-  mostbuytogether_link3 = db.StringProperty()
-
 
   @staticmethod
   def getFirstKeyForUser(username):
@@ -167,6 +142,42 @@ class FileMetadata(db.Model):
     return str(username + sep + str(date) + sep + blob_key)
 
 
+class ResultManifest(db.Model):
+  """Links to the output files of one result of a MapReduce job.
+
+  Stored as a child of the FileMetadata of the input file, with the result
+  name (e.g. 'SongSoldNum', or 'JazzDollarArtist' for one metric of the
+  per-genre job) as key name. A job may store several results, each with any
+  number of output files.
+  """
+
+  name = db.StringProperty()
+  links = db.StringListProperty()
+  createdOn = db.DateTimeProperty(auto_now=True)
+
+
+class CumulativeSnapshot(db.Model):
+  """The cumulative totals of one metric over a user's incremental uploads.
+
+  The totals are kept in a single GCS file of 'entity<TAB>total' lines sorted
+  by entity, so that the partial results of the next upload can be merged into
+  it in one sequential pass (see MergeSnapshots). Keys have the form
+  'user..metric'.
+  """
+
+  owner = db.UserProperty()
+  metric = db.StringProperty()
+  filename = db.StringProperty()
+  # Encoded keys of the FileMetadata of the uploads included in the totals.
+  uploads = db.StringListProperty()
+  updatedOn = db.DateTimeProperty(auto_now=True)
+
+  @staticmethod
+  def getKeyName(username, metric):
+    """Returns the key name of a user's snapshot of a metric."""
+    return str(username + ".." + metric)
+
+
 class IndexHandler(webapp2.RequestHandler):
   """The main page that users will interact with, which presents users with
   the ability to upload new data or run MapReduce jobs on their existing data.
@@ -189,6 +200,9 @@ class IndexHandler(webapp2.RequestHandler):
 
     items = [result for result in results]
     length = len(items)
+    manifests = dict(
+        (item.key(), ResultManifest.all().ancestor(item).fetch(100))
+        for item in items)
 
     bucket_name = app_identity.get_default_gcs_bucket_name()
     upload_url = blobstore.create_upload_url("/upload",
@@ -197,6 +211,7 @@ class IndexHandler(webapp2.RequestHandler):
     self.response.out.write(self.template_env.get_template("index.html").render(
         {"username": username,
          "items": items,
+         "manifests": manifests,
          "length": length,
          "upload_url": upload_url}))
 
@@ -220,18 +235,36 @@ class IndexHandler(webapp2.RequestHandler):
       pipeline = JazzSongArtistPipeline(filekey, blob_key)
     elif self.request.get("jazz_dollar_artist"):
       pipeline = JazzDollarArtistPipeline(filekey, blob_key)
+    elif self.request.get("all_metrics"):
+      pipeline = AllMetricsPipeline(filekey, blob_key)
+    elif self.request.get("user_profile"):
+      pipeline = UserProfilePipeline(filekey, blob_key)
+    elif self.request.get("song_sales"):
+      pipeline = SongSalesPipeline(filekey, blob_key)
+    elif self.request.get("duration_stats"):
+      pipeline = DurationStatsPipeline(filekey, blob_key)
+    elif self.request.get("distinct_buyers"):
+      pipeline = DistinctBuyersPipeline(filekey, blob_key)
+    elif self.request.get("leaderboards"):
+      pipeline = LeaderboardsPipeline(
+          filekey, blob_key, top_n=int(self.request.get("top_n") or 20))
+    elif self.request.get("windowed_sales"):
+      pipeline = WindowedSalesPipeline(filekey, blob_key)
+    elif self.request.get("incremental_metrics"):
+      pipeline = IncrementalMetricsPipeline(filekey, blob_key)
+    elif self.request.get("genre_metrics"):
+      genres = self.request.get("genres")
+      pipeline = GenreMetricsPipeline(
+          filekey, blob_key, genres=genres and genres.split(",") or None)
     else:
-      pipeline = MostBuyTogetherPipeline(filekey, blob_key)
+      pipeline = MostBuyTogetherPipeline(
+          filekey, blob_key,
+          top_k=int(self.request.get("top_k") or 1),
+          min_support=int(self.request.get("min_support") or 1))
 
     pipeline.start()
     self.redirect(pipeline.base_path + "/status?root=" + pipeline.pipeline_id)
 
-def transaction_into_sentences(s):
-  return s.split("\n")
-
-def transaction_into_fields(s):
-  return s.split("\t")
-
 def split_into_sentences(s):
   """Split text into list of sentences."""
   s = re.sub(r"\s+", " ", s)
@@ -246,21 +279,62 @@ def split_into_words(s):
   return s.split()
 
 
+class _SumMapper(map_job.Mapper):
+  """In-mapper combiner for map functions that yield (key, integer) pairs.
+
+  Values are summed per key in memory and emitted as varints at the end of
+  each slice (or earlier if too many keys are held), so the shuffle carries
+  one partial sum per key and slice instead of one record per transaction.
+  Subclasses set map_function to the map function to wrap.
+  """
+
+  map_function = None
+
+  # Maximum number of keys to hold in memory before emitting partial sums.
+  _MAX_KEYS = 100000
+
+  def __init__(self):
+    super(_SumMapper, self).__init__()
+    self._sums = {}
+
+  def __call__(self, slice_ctx, data):
+    sums = self._sums
+    for (key, value) in self.map_function(data):
+      sums[key] = sums.get(key, 0) + value
+    if len(sums) > self._MAX_KEYS:
+      self._emit(slice_ctx)
+
+  def end_slice(self, slice_ctx):
+    self._emit(slice_ctx)
+
+  def _emit(self, slice_ctx):
+    for key, value in self._sums.iteritems():
+      slice_ctx.emit((key, transactions.encode_varint(value)))
+    self._sums = {}
+
+
+def _sum_varints(values):
+  return sum(transactions.decode_varint(v) for v in values)
+
+
+def sum_combine(key, values, previously_combined_values):
+  """Combiner for counts and cents, yields a single partial sum."""
+  yield transactions.encode_varint(
+      _sum_varints(values) + _sum_varints(previously_combined_values))
+
+
 # Count each song sold number map and reduce function
 def song_sold_num_map(data):
   (entry, text_fn) = data
   text = text_fn()
 
   logging.debug("Got %s", entry.filename)
-  for s in transaction_into_sentences(text):
-    words = transaction_into_fields(s)
-    w = [words[2], words[3], words[4]];
-    w = "-".join(w)
-    yield (w, "")
+  for t in transactions.iter_transactions(text):
+    yield (t.song, 1)
 
 def song_sold_num_reduce(key, values):
   a = key.split("-")
-  yield "%s: %d\n" % (a[0], len(values))
+  yield "%s: %d\n" % (a[0], _sum_varints(values))
 
 
 # Calculate the total dollar for each song map and reduce function
@@ -269,18 +343,12 @@ def dollar_song_map(data):
   text = text_fn()
 
   logging.debug("Got %s", entry.filename)
-  for s in transaction_into_sentences(text):
-    words = transaction_into_fields(s)
-    w = [words[2], words[3], words[4]];
-    w = "-".join(w)
-    yield (w, words[7])
+  for t in transactions.iter_transactions(text):
+    yield (t.song, t.price)
 
 def dollar_song_reduce(key, values):
   a = key.split("-")
-  sum_price = 0.0
-  for price in values:
-    sum_price = sum_price + float(price)
-  yield "%s: %.2f\n" % (a[0], sum_price)
+  yield "%s: %s\n" % (a[0], transactions.format_cents(_sum_varints(values)))
 
 
 # Count the number of songs sold for each artist
@@ -289,12 +357,11 @@ def song_artist_map(data):
   text = text_fn()
 
   logging.debug("Got %s", entry.filename)
-  for s in transaction_into_sentences(text):
-    words = transaction_into_fields(s)
-    yield (words[3], "")
+  for t in transactions.iter_transactions(text):
+    yield (t.artist, 1)
 
 def song_artist_reduce(key, values):
-  yield "%s: %d\n" % (key, len(values))
+  yield "%s: %d\n" % (key, _sum_varints(values))
 
 
 # Calculate the total dollar amount of sales for each artist
@@ -303,487 +370,1403 @@ def dollar_artist_map(data):
   text = text_fn()
 
   logging.debug("Got %s", entry.filename)
-  for s in transaction_into_sentences(text):
-    words = transaction_into_fields(s)
-    yield (words[3], words[7])
+  for t in transactions.iter_transactions(text):
+    yield (t.artist, t.price)
 
 def dollar_artist_reduce(key, values):
-  sum_price = 0.0
-  for price in values:
-    sum_price = sum_price + float(price)
-  yield "%s: %.2f\n" % (key, sum_price)
+  yield "%s: %s\n" % (key, transactions.format_cents(_sum_varints(values)))
+
+
+# Compute every per-song and per-artist metric in a single pass. Keys are
+# tagged with the metric name (the same name StoreOutput uses for the
+# standalone job) so the reducer can dispatch on it and write each metric to
+# its own set of output files.
+_METRIC_SEP = "\t"
 
+# Genre of the genre-filtered metrics.
+_FILTER_GENRE = "Jazz"
 
-# Count each song sold number map and reduce function for Jazz
-def jazz_song_sold_num_map(data):
+# Metrics computed by the genre-partitioned job, see genre_metrics_map.
+_GENRE_METRICS = ("SongSoldNum", "DollarSong", "SongArtist", "DollarArtist")
+
+
+def _metric_values(t):
+  """Returns (metric, entity, value) tuples for a transaction."""
+  song = t.song
+  artist = t.artist
+  price = t.price
+  return (("SongSoldNum", song, 1),
+          ("DollarSong", song, price),
+          ("SongArtist", artist, 1),
+          ("DollarArtist", artist, price))
+
+
+def all_metrics_map(data):
   (entry, text_fn) = data
   text = text_fn()
 
   logging.debug("Got %s", entry.filename)
-  for s in transaction_into_sentences(text):
-    words = transaction_into_fields(s)
-    if words[5] == "Jazz":
-      w = [words[2], words[3], words[4]];
-      w = "-".join(w)
-      yield (w, "")
-
-def jazz_song_sold_num_reduce(key, values):
-  a = key.split("-")
-  yield "%s: %d\n" % (a[0], len(values))
+  for t in transactions.iter_transactions(text):
+    in_genre = t.genre == _FILTER_GENRE
+    for (metric, entity, value) in _metric_values(t):
+      yield (metric + _METRIC_SEP + entity, value)
+      if in_genre:
+        yield (_FILTER_GENRE + metric + _METRIC_SEP + entity, value)
+
+
+_METRIC_REDUCERS = {
+    "SongSoldNum": song_sold_num_reduce,
+    "DollarSong": dollar_song_reduce,
+    "SongArtist": song_artist_reduce,
+    "DollarArtist": dollar_artist_reduce,
+    _FILTER_GENRE + "SongSoldNum": song_sold_num_reduce,
+    _FILTER_GENRE + "DollarSong": dollar_song_reduce,
+    _FILTER_GENRE + "SongArtist": song_artist_reduce,
+    _FILTER_GENRE + "DollarArtist": dollar_artist_reduce,
+}
+
+
+def all_metrics_reduce(key, values):
+  (metric, key) = key.split(_METRIC_SEP, 1)
+  for line in _METRIC_REDUCERS[metric](key, values):
+    yield (metric, line)
 
 
-# Calculate the total dollar for each song map and reduce function for Jazz
-def jazz_dollar_song_map(data):
+def _mapper_param_set(name):
+  """Returns the set of values of a list mapper parameter, or None if unset.
+
+  The parameter may be given either as a list or as a comma-separated string.
+  """
+  value = context.get().mapreduce_spec.mapper.params.get(name)
+  if not value:
+    return None
+  if isinstance(value, basestring):
+    value = value.split(",")
+  return set(v.strip() for v in value if v.strip()) or None
+
+
+def _job_param_int(name, default):
+  """Returns an integer parameter of the current map or reduce job."""
+  return int(context.get().mapreduce_spec.mapper.params.get(name, default))
+
+
+# Compute the per-song and per-artist metrics of every genre in a single pass.
+# Keys are (metric, genre, entity) composites. The "genres" and "metrics"
+# mapper parameters restrict the job to a subset of genres and metrics.
+def genre_metrics_map(data):
   (entry, text_fn) = data
   text = text_fn()
+  genres = _mapper_param_set("genres")
+  metrics = _mapper_param_set("metrics")
 
   logging.debug("Got %s", entry.filename)
-  for s in transaction_into_sentences(text):
-    words = transaction_into_fields(s)
-    if words[5] == "Jazz":
-      w = [words[2], words[3], words[4]];
-      w = "-".join(w)
-      yield (w, words[7])
-
-def jazz_dollar_song_reduce(key, values):
-  a = key.split("-")
-  sum_price = 0.0
-  for price in values:
-    sum_price = sum_price + float(price)
-  yield "%s: %.2f\n" % (a[0], sum_price)
+  for t in transactions.iter_transactions(text):
+    genre = t.genre
+    if genres and genre not in genres:
+      continue
+    for (metric, entity, value) in _metric_values(t):
+      if metrics and metric not in metrics:
+        continue
+      yield (_METRIC_SEP.join((metric, genre, entity)), value)
+
+def genre_metrics_reduce(key, values):
+  (metric, genre, key) = key.split(_METRIC_SEP, 2)
+  for line in _METRIC_REDUCERS[metric](key, values):
+    yield ((genre, metric), line)
+
 
+class SongSoldNumMapper(_SumMapper):
+  map_function = staticmethod(song_sold_num_map)
 
 
-# Count the number of songs sold for each artist for Jazz
-def jazz_song_artist_map(data):
+class DollarSongMapper(_SumMapper):
+  map_function = staticmethod(dollar_song_map)
+
+
+class SongArtistMapper(_SumMapper):
+  map_function = staticmethod(song_artist_map)
+
+
+class DollarArtistMapper(_SumMapper):
+  map_function = staticmethod(dollar_artist_map)
+
+
+class AllMetricsMapper(_SumMapper):
+  map_function = staticmethod(all_metrics_map)
+
+
+class GenreMetricsMapper(_SumMapper):
+  map_function = staticmethod(genre_metrics_map)
+
+
+# Top-N leaderboards of every metric, overall and per genre. Keys are
+# (metric, genre, entity) composites like those of genre_metrics_map, with an
+# empty genre for the overall leaderboards. Each reduce shard only keeps its
+# "top_n" best entities per (genre, metric), which MergeLeaderboards merges
+# into the global leaderboards.
+_DOLLAR_METRICS = ("DollarSong", "DollarArtist")
+
+
+def leaderboard_map(data):
   (entry, text_fn) = data
   text = text_fn()
 
   logging.debug("Got %s", entry.filename)
-  for s in transaction_into_sentences(text):
-    words = transaction_into_fields(s)
-    if words[5] == "Jazz":
-      yield (words[3], "")
+  for t in transactions.iter_transactions(text):
+    for (metric, entity, value) in _metric_values(t):
+      yield (_METRIC_SEP.join((metric, "", entity)), value)
+      yield (_METRIC_SEP.join((metric, t.genre, entity)), value)
+
+
+class LeaderboardMapper(_SumMapper):
+  map_function = staticmethod(leaderboard_map)
 
-def jazz_song_artist_reduce(key, values):
-  yield "%s: %d\n" % (key, len(values))
 
+class LeaderboardReducer(map_job.Mapper):
+  """Keeps the "top_n" entities of each (genre, metric) of a reduce shard.
 
-# Calculate the total dollar amount of sales for each artist for Jazz
-def jazz_dollar_artist_map(data):
+  Totals are held in bounded heaps, and written as 'total<TAB>entity' lines
+  to the (genre, "Top" + metric) partition by the first slice that gets no
+  input, i.e. once the shard's input is exhausted (see CoPurchaseMapper).
+  """
+
+  def __init__(self):
+    super(LeaderboardReducer, self).__init__()
+    self._heaps = {}
+    self._top_n = 0
+    self._got_input = False
+
+  def begin_slice(self, slice_ctx):
+    self._top_n = _job_param_int("top_n", 20)
+    self._got_input = False
+
+  def __call__(self, slice_ctx, data):
+    (key, values) = data
+    self._got_input = True
+    (metric, genre, entity) = key.split(_METRIC_SEP, 2)
+    sketches.bounded_top_add(self._heaps.setdefault((genre, metric), []),
+                             self._top_n, _sum_varints(values), entity)
+
+  def end_slice(self, slice_ctx):
+    if self._got_input:
+      return
+    for (genre, metric), heap in sorted(self._heaps.iteritems()):
+      for (total, entity) in sketches.bounded_top_items(heap):
+        slice_ctx.emit(((genre, "Top" + metric),
+                        "%d\t%s\n" % (total, entity)))
+    self._heaps = {}
+
+
+# Approximate number of distinct buyers of each song, artist and genre. Keys
+# are tagged with the metric like in all_metrics_map, and values are encoded
+# HyperLogLog sketches of the buyers, so the shuffle value and reducer memory
+# of a key have a fixed size whatever its number of buyers.
+def distinct_buyers_map(data):
   (entry, text_fn) = data
   text = text_fn()
 
   logging.debug("Got %s", entry.filename)
-  for s in transaction_into_sentences(text):
-    words = transaction_into_fields(s)
-    if words[5] == "Jazz":
-      yield (words[3], words[7])
+  for t in transactions.iter_transactions(text):
+    yield ("SongBuyers" + _METRIC_SEP + t.song, t.user)
+    yield ("ArtistBuyers" + _METRIC_SEP + t.artist, t.user)
+    yield ("GenreBuyers" + _METRIC_SEP + t.genre, t.user)
 
-def jazz_dollar_artist_reduce(key, values):
-  sum_price = 0.0
-  for price in values:
-    sum_price = sum_price + float(price)
-  yield "%s: %.2f\n" % (key, sum_price)
+
+class DistinctBuyersMapper(map_job.Mapper):
+  """In-mapper combiner for distinct_buyers_map.
+
+  Buyers are added to one sketch per key, and the sketches are emitted at the
+  end of each slice (or earlier if too many are held). The "hll_precision"
+  job parameter sets the size of the sketches.
+  """
+
+  # Maximum number of sketches to hold in memory before emitting.
+  _MAX_SKETCHES = 4096
+
+  def __init__(self):
+    super(DistinctBuyersMapper, self).__init__()
+    self._sketches = {}
+    self._precision = sketches.HLL_PRECISION
+
+  def begin_slice(self, slice_ctx):
+    self._precision = _job_param_int("hll_precision", sketches.HLL_PRECISION)
+
+  def __call__(self, slice_ctx, data):
+    all_sketches = self._sketches
+    for (key, user) in distinct_buyers_map(data):
+      registers = all_sketches.get(key)
+      if registers is None:
+        registers = all_sketches[key] = sketches.hll_new(self._precision)
+      sketches.hll_add(registers, user)
+    if len(all_sketches) > self._MAX_SKETCHES:
+      self._emit(slice_ctx)
+
+  def end_slice(self, slice_ctx):
+    self._emit(slice_ctx)
+
+  def _emit(self, slice_ctx):
+    for key, registers in self._sketches.iteritems():
+      slice_ctx.emit((key, sketches.hll_encode(registers)))
+    self._sketches = {}
+
+
+def _merge_sketches(*value_lists):
+  """Merges encoded HyperLogLog sketches into one sketch."""
+  registers = None
+  for values in value_lists:
+    for value in values:
+      sketch = sketches.hll_decode(value)
+      if registers is None:
+        registers = sketch
+      else:
+        sketches.hll_merge(registers, sketch)
+  return registers
+
+
+def distinct_buyers_combine(key, values, previously_combined_values):
+  yield sketches.hll_encode(
+      _merge_sketches(values, previously_combined_values))
+
+def distinct_buyers_reduce(key, values):
+  (metric, entity) = key.split(_METRIC_SEP, 1)
+  if metric == "SongBuyers":
+    entity = entity.split("-")[0]
+  yield (metric, "%s: %d\n" % (
+      entity, sketches.hll_count(_merge_sketches(values))))
+
+
+# Sales count and revenue of each song and artist per hour, day and month.
+# Maps yield ("Song" or "Artist" + _METRIC_SEP + entity, (hour, 1, cents))
+# and WindowedSalesMapper sums them into one hourly series per key. The
+# reducer merges the hourly series and rolls them up to every granularity,
+# writing one partition per granularity and entity kind (e.g. "DailySong") of
+# 'entity<TAB>bucket<TAB>count<TAB>revenue' lines, sorted by entity and bucket
+# within each file so that timeseries.scan_series can range-scan them.
+def windowed_sales_map(data):
+  (entry, text_fn) = data
+  text = text_fn()
+
+  logging.debug("Got %s", entry.filename)
+  for t in transactions.iter_transactions(text):
+    dt = transactions.parse_timestamp(t.timestamp)
+    if dt is None:
+      continue
+    sale = (timeseries.hour_of(dt), 1, t.price)
+    yield ("Song" + _METRIC_SEP + t.song, sale)
+    yield ("Artist" + _METRIC_SEP + t.artist, sale)
+
+
+class WindowedSalesMapper(map_job.Mapper):
+  """In-mapper combiner for windowed_sales_map.
+
+  Like _SumMapper, but sums the sales of each key per hour and emits one
+  encoded hourly series per key at the end of each slice.
+  """
+
+  # Maximum number of (key, hour) series entries to hold in memory.
+  _MAX_ENTRIES = 100000
+
+  def __init__(self):
+    super(WindowedSalesMapper, self).__init__()
+    self._series = {}
+    self._entries = 0
+
+  def __call__(self, slice_ctx, data):
+    all_series = self._series
+    for (key, (hour, count, cents)) in windowed_sales_map(data):
+      series = all_series.setdefault(key, {})
+      size = len(series)
+      timeseries.add(series, hour, count, cents)
+      self._entries += len(series) - size
+    if self._entries > self._MAX_ENTRIES:
+      self._emit(slice_ctx)
+
+  def end_slice(self, slice_ctx):
+    self._emit(slice_ctx)
+
+  def _emit(self, slice_ctx):
+    for key, series in self._series.iteritems():
+      slice_ctx.emit((key, timeseries.encode(series)))
+    self._series = {}
+    self._entries = 0
+
+
+def _merge_series(*value_lists):
+  series = {}
+  for values in value_lists:
+    for value in values:
+      timeseries.merge(series, value)
+  return series
+
+
+def windowed_sales_combine(key, values, previously_combined_values):
+  yield timeseries.encode(_merge_series(values, previously_combined_values))
+
+def windowed_sales_reduce(key, values):
+  (kind, entity) = key.split(_METRIC_SEP, 1)
+  for (granularity, buckets) in timeseries.rollups(_merge_series(values)):
+    for (bucket, count, cents) in buckets:
+      yield ((granularity, kind), "%s\t%s\t%d\t%s\n" % (
+          entity, bucket, count, transactions.format_cents(cents)))
+
+
+# Sales count and revenue of each song, written as columnar rows (see
+# SONG_SALES_COLUMNS) so that reports can be loaded by column and range-queried
+# by song without parsing text. Keys are song + _METRIC_SEP + genre and values
+# are (count, cents) varint pairs.
+SONG_SALES_COLUMNS = (("song", "string"), ("count", "int"),
+                      ("cents", "int"), ("genre", "string"))
+
+
+def song_sales_map(data):
+  (entry, text_fn) = data
+  text = text_fn()
+
+  logging.debug("Got %s", entry.filename)
+  for t in transactions.iter_transactions(text):
+    yield (t.song + _METRIC_SEP + t.genre, t.price)
+
+
+def _encode_sales(count, cents):
+  return transactions.encode_varint(count) + transactions.encode_varint(cents)
+
+
+def _sum_sales(*value_lists):
+  """Sums (count, cents) varint pairs."""
+  count = 0
+  cents = 0
+  for values in value_lists:
+    for value in values:
+      numbers = transactions.decode_varints(value)
+      count += next(numbers)
+      cents += next(numbers)
+  return (count, cents)
+
+
+class SongSalesMapper(map_job.Mapper):
+  """In-mapper combiner for song_sales_map.
+
+  Like _SumMapper, but counts the sales of each key as well as summing their
+  prices.
+  """
+
+  # Maximum number of keys to hold in memory before emitting partial sums.
+  _MAX_KEYS = 100000
+
+  def __init__(self):
+    super(SongSalesMapper, self).__init__()
+    self._sales = {}
+
+  def __call__(self, slice_ctx, data):
+    sales = self._sales
+    for (key, cents) in song_sales_map(data):
+      totals = sales.get(key)
+      if totals is None:
+        sales[key] = [1, cents]
+      else:
+        totals[0] += 1
+        totals[1] += cents
+    if len(sales) > self._MAX_KEYS:
+      self._emit(slice_ctx)
+
+  def end_slice(self, slice_ctx):
+    self._emit(slice_ctx)
+
+  def _emit(self, slice_ctx):
+    for key, (count, cents) in self._sales.iteritems():
+      slice_ctx.emit((key, _encode_sales(count, cents)))
+    self._sales = {}
+
+
+def song_sales_combine(key, values, previously_combined_values):
+  yield _encode_sales(*_sum_sales(values, previously_combined_values))
+
+def song_sales_reduce(key, values):
+  (song, genre) = key.split(_METRIC_SEP, 1)
+  (count, cents) = _sum_sales(values)
+  yield (song, count, cents, genre)
+
+
+# Sales, listening time, revenue per listening minute and a histogram of song
+# durations per genre. The mapper parses the genre, duration and price columns
+# of a whole file at once and computes the statistics of every genre over the
+# columns (see durations.py), so values are encoded durations.GenreStats.
+class DurationStatsMapper(map_job.Mapper):
+  """Sums the duration statistics of every chunk of a slice per genre.
+
+  The streaming BlobstoreZipInputReader hands each call one chunk of lines of
+  a contained file, about _STREAMING_CHUNK_SIZE bytes, not the whole file.
+  Chunks always end after a complete line, so a line is never parsed as two
+  broken records.
+  """
+
+  def __init__(self):
+    super(DurationStatsMapper, self).__init__()
+    self._stats = {}
+
+  def __call__(self, slice_ctx, data):
+    (entry, lines_fn) = data
+    lines = lines_fn()
+
+    logging.debug("Got %s", entry.filename)
+    for (genre, stats) in durations.genre_stats(
+        *durations.parse_columns(lines)).iteritems():
+      if genre in self._stats:
+        self._stats[genre].merge(stats)
+      else:
+        self._stats[genre] = stats
+
+  def end_slice(self, slice_ctx):
+    for genre, stats in self._stats.iteritems():
+      slice_ctx.emit((genre, stats.encode()))
+    self._stats = {}
+
+
+def _merge_genre_stats(*value_lists):
+  stats = durations.GenreStats()
+  for values in value_lists:
+    for value in values:
+      stats.merge(durations.GenreStats.decode(value))
+  return stats
+
+
+def duration_stats_combine(key, values, previously_combined_values):
+  yield _merge_genre_stats(values, previously_combined_values).encode()
+
+def duration_stats_reduce(key, values):
+  stats = _merge_genre_stats(values)
+  minutes = stats.seconds / 60.0
+  yield "%s\t%d\t%.1f\t%s\t%.4f\t%s\n" % (
+      key, stats.sales, minutes, transactions.format_cents(stats.cents),
+      minutes and stats.cents / 100.0 / minutes or 0.0,
+      " ".join("%s=%d" % (durations.bin_label(i), count)
+               for (i, count) in enumerate(stats.histogram)))
 
 
 # find the other song that was purchased most often at the same time
 # and count how many times the two songs were purchased together
-def songs_same_time_map(data):
+def _encode_counts(counts):
+  """Encodes a partner -> count dict as a shuffle value."""
+  return "\n".join("%s\t%d" % item for item in counts.iteritems())
+
+
+def _decode_counts(value, counts):
+  """Adds the partner counts encoded in value to the counts dict."""
+  for line in value.split("\n"):
+    (partner, count) = line.rsplit("\t", 1)
+    counts[partner] = counts.get(partner, 0) + int(count)
+
+
+# Incremental analytics. The per-song and per-artist totals of an upload are
+# written as partial results: for each metric, files of 'entity<TAB>total'
+# lines sorted by entity (the reduce input is sorted by key, and the metric
+# prefix of the key is the same for all of a file's lines). MergeSnapshots
+# merges them into the uploader's cumulative snapshots, so a new upload only
+# maps its own data and the history is read once, in order.
+def metric_partials_map(data):
   (entry, text_fn) = data
   text = text_fn()
 
   logging.debug("Got %s", entry.filename)
-  for s in transaction_into_sentences(text):
-    words = transaction_into_fields(s)
-    sametime = [words[0], words[1]]
-    song = [words[2], words[3], words[4]]
-    sametime = "-".join(sametime)
-    song = "-".join(song)
-    yield (sametime, song)
-
-def songs_same_time_reduce(key, values):
-  for v in values:
-    for other in values:
-      if v != other:
-        yield "%s\t%s\n" % (v, other)
-
-def most_buy_together_map(data):
-  while(data._remaining()):
-    text_fn = data.readline()
-    text_fn = text_fn[:-1]
-    words = transaction_into_fields(text_fn)
-    yield (words[0], words[1])
+  for t in transactions.iter_transactions(text):
+    for (metric, entity, value) in _metric_values(t):
+      yield (metric + _METRIC_SEP + entity, value)
+
+def metric_partials_reduce(key, values):
+  (metric, entity) = key.split(_METRIC_SEP, 1)
+  yield (metric, "%s\t%d\n" % (entity, _sum_varints(values)))
+
+
+def _read_partial(lines):
+  """Yields the (entity, total) pairs of a partial result or snapshot file."""
+  for line in lines:
+    line = line.rstrip("\n")
+    if line:
+      (entity, total) = line.rsplit("\t", 1)
+      yield (entity, int(total))
 
+
+def merge_partials(partials):
+  """Merges sorted partial results, summing the totals of equal entities.
+
+  Args:
+    partials: iterables of 'entity<TAB>total' lines, each sorted by entity.
+
+  Yields:
+    (entity, total) pairs sorted by entity.
+  """
+  merged = heapq.merge(*[_read_partial(lines) for lines in partials])
+  for (entity, pairs) in itertools.groupby(merged, lambda pair: pair[0]):
+    yield (entity, sum(total for (_, total) in pairs))
+
+
+class MetricPartialsMapper(_SumMapper):
+  map_function = staticmethod(metric_partials_map)
+
+
+class CoPurchaseMapper(map_job.Mapper):
+  """Counts how often each pair of songs is bought in the same basket.
+
+  A basket is a run of consecutive transactions with the same timestamp and
+  user, so the input must list the songs of a basket on consecutive lines:
+  lines of the same basket that are separated by other transactions count as
+  separate baskets. The last basket seen is kept open across inputs and
+  slices, so baskets split between streamed chunks of a file, or between
+  consecutive files of a shard, are still counted once. It is closed by the
+  first slice that gets no input, i.e. once the shard's input is exhausted.
+
+  Shards are split at file boundaries, and shards can't see each other's
+  baskets. A basket that starts at the end of one file and continues at the
+  start of the next is counted as two baskets when the two files are read by
+  different shards, so the pairs between its two parts are missed. Baskets
+  should therefore not span files.
+
+  Pair counts are held per song in memory and emitted as one partial
+  song -> {partner: count} value per song at the end of each slice (or
+  earlier if too many pairs are held). If the "sketch_size" job parameter is
+  set, each song keeps a space-saving summary of at most that many partners
+  instead of exact counts.
+  """
+
+  # Maximum number of song pairs to hold in memory before emitting.
+  _MAX_PAIRS = 100000
+
+  def __init__(self):
+    super(CoPurchaseMapper, self).__init__()
+    self._partners = {}
+    self._pairs = 0
+    self._sketch_size = 0
+    self._basket_key = None
+    self._basket = set()
+    self._got_input = False
+
+  def begin_slice(self, slice_ctx):
+    self._sketch_size = _job_param_int("sketch_size", 0)
+    self._got_input = False
+
+  def __call__(self, slice_ctx, data):
+    (entry, text_fn) = data
+    text = text_fn()
+    self._got_input = True
+
+    logging.debug("Got %s", entry.filename)
+    for t in transactions.iter_transactions(text):
+      if (t.timestamp, t.user) != self._basket_key:
+        self._add_basket(self._basket)
+        self._basket_key = (t.timestamp, t.user)
+        self._basket = set()
+      self._basket.add(t.song)
+    if self._pairs > self._MAX_PAIRS:
+      self._emit(slice_ctx)
+
+  def end_slice(self, slice_ctx):
+    if not self._got_input:
+      self._add_basket(self._basket)
+      self._basket_key = None
+      self._basket = set()
+    self._emit(slice_ctx)
+
+  def _add_basket(self, songs):
+    if len(songs) < 2:
+      return
+    partners = self._partners
+    sketch_size = self._sketch_size
+    for song in songs:
+      counts = partners.setdefault(song, {})
+      size = len(counts)
+      for other in songs:
+        if other == song:
+          continue
+        if sketch_size:
+          sketches.space_saving_add(counts, other, 1, sketch_size)
+        else:
+          counts[other] = counts.get(other, 0) + 1
+      self._pairs += len(counts) - size
+
+  def _emit(self, slice_ctx):
+    for song, counts in self._partners.iteritems():
+      slice_ctx.emit((song, _encode_counts(counts)))
+    self._partners = {}
+    self._pairs = 0
+
+
+def _merge_partners(*value_lists):
+  """Merges encoded partner counts, bounded by the "sketch_size" parameter."""
+  counts = {}
+  for values in value_lists:
+    for value in values:
+      _decode_counts(value, counts)
+  sketch_size = _job_param_int("sketch_size", 0)
+  if sketch_size:
+    sketches.space_saving_truncate(counts, sketch_size)
+  return counts
+
+
+def co_purchase_combine(key, values, previously_combined_values):
+  yield _encode_counts(_merge_partners(values, previously_combined_values))
+
+# Yields the "top_k" most frequent partners of each song (with ties) that were
+# bought together with it at least "min_support" times, one line per partner:
+# song, rank, partner, count.
 def most_buy_together_reduce(key, values):
-  song_list = {}
-  for v in values:
-    if v in song_list:
-      song_list[v] = song_list[v] + 1
+  counts = _merge_partners(values)
+  song = key.split("-")[0]
+  for (rank, partner, count) in sketches.top_k(
+      counts, _job_param_int("top_k", 1), _job_param_int("min_support", 1)):
+    yield "%s, %d, %s, %d\n" % (song, rank, partner.split("-")[0], count)
+
+
+# Per-user purchase profiles: total spend, number of baskets and songs, and
+# favourite genre and artist, ties going to the smallest name. Genres and
+# artists are counted exactly unless the "profile_capacity" parameter is set,
+# in which case they are counted with space-saving summaries of at most that
+# many entries so that heavy users take no more memory than others. The
+# favourites are then approximate for users who bought from more genres or
+# artists than that: a single summary overestimates a count by at most the
+# user's songs divided by the capacity, merging the partial profiles of
+# slices and shards adds to this error, and the result can depend on the
+# number of shards.
+class _UserProfile(object):
+  """Mergeable purchase profile of one user."""
+
+  __slots__ = ("spend", "baskets", "songs", "genres", "artists")
+
+  def __init__(self):
+    self.spend = 0
+    self.baskets = 0
+    self.songs = 0
+    self.genres = {}
+    self.artists = {}
+
+  def add(self, t, new_basket, capacity):
+    """Adds a transaction, which starts a new basket if new_basket is set.
+
+    Genres and artists are counted exactly if capacity is 0, and with
+    space-saving summaries of capacity entries otherwise.
+    """
+    self.spend += t.price
+    self.baskets += new_basket
+    self.songs += 1
+    if capacity:
+      sketches.space_saving_add(self.genres, t.genre, 1, capacity)
+      sketches.space_saving_add(self.artists, t.artist, 1, capacity)
     else:
-      song_list[v] = 1
-  target_song = max(song_list.iteritems(), key=operator.itemgetter(1))[0]
-  yield "%s, %s, %d\n" % (key.split("-")[0], target_song.split("-")[0], song_list[target_song])
+      self.genres[t.genre] = self.genres.get(t.genre, 0) + 1
+      self.artists[t.artist] = self.artists.get(t.artist, 0) + 1
 
+  def merge(self, other, capacity):
+    """Adds the purchases of another profile of the same user.
 
-class SongSoldNumPipeline(base_handler.PipelineBase):
+    The merged summaries are truncated to capacity entries unless capacity
+    is 0.
+    """
+    self.spend += other.spend
+    self.baskets += other.baskets
+    self.songs += other.songs
+    for (counts, other_counts) in ((self.genres, other.genres),
+                                   (self.artists, other.artists)):
+      for item, count in other_counts.iteritems():
+        counts[item] = counts.get(item, 0) + count
+      if capacity:
+        sketches.space_saving_truncate(counts, capacity)
+
+  def encode(self):
+    """Encodes the profile as a shuffle value.
+
+    The first line holds the totals and the number of genres, and is followed
+    by one 'name<TAB>count' line per genre and then per artist.
+    """
+    lines = ["%d\t%d\t%d\t%d" % (self.spend, self.baskets, self.songs,
+                                   len(self.genres))]
+    for counts in (self.genres, self.artists):
+      lines.extend("%s\t%d" % item for item in counts.iteritems())
+    return "\n".join(lines)
+
+  @classmethod
+  def decode(cls, value):
+    """Decodes a profile encoded by encode."""
+    lines = value.split("\n")
+    profile = cls()
+    (spend, baskets, songs, num_genres) = lines[0].split("\t")
+    profile.spend = int(spend)
+    profile.baskets = int(baskets)
+    profile.songs = int(songs)
+    num_genres = int(num_genres)
+    for i, line in enumerate(lines[1:]):
+      (name, count) = line.rsplit("\t", 1)
+      if i < num_genres:
+        profile.genres[name] = int(count)
+      else:
+        profile.artists[name] = int(count)
+    return profile
+
+
+class UserProfileMapper(map_job.Mapper):
+  """Builds a partial profile of each user, emitted at the end of each slice.
+
+  A basket is counted when a user's run of consecutive transactions with the
+  same timestamp starts; the last basket key is kept across inputs and slices
+  so that baskets split between streamed chunks, or between consecutive files
+  of a shard, are counted once.
+
+  Shards are split at file boundaries and each shard starts a new basket, so
+  a basket that continues from the end of one file into the next is counted
+  twice when the two files are read by different shards, as with
+  CoPurchaseMapper. The basket count of a profile is then one too high for
+  each such basket and can change with the number of shards, e.g. Rosana6435
+  has 48 baskets in data/transactions.zip with 1 shard and 49 with 4. Spend,
+  songs and favourites are not affected.
+  """
 
-  def run(self, filekey, blobkey):
-    bucket_name = app_identity.get_default_gcs_bucket_name()
-    output = yield mapreduce_pipeline.MapreducePipeline(
-        "song_sold_num",
-        "main.song_sold_num_map",
-        "main.song_sold_num_reduce",
-        "mapreduce.input_readers.BlobstoreZipInputReader",
-        "mapreduce.output_writers.GoogleCloudStorageOutputWriter",
-        mapper_params={
-            "blob_key": blobkey,
-        },
-        reducer_params={
-            "output_writer": {
-                "bucket_name": bucket_name,
-                "content_type": "text/plain",
-            }
-        },
-        shards=4)
-    yield StoreOutput("SongSoldNum", filekey, output)
-
-class DollarSongPipeline(base_handler.PipelineBase):
+  # Maximum number of profiles to hold in memory before emitting.
+  _MAX_USERS = 10000
 
-  def run(self, filekey, blobkey):
-    bucket_name = app_identity.get_default_gcs_bucket_name()
-    output = yield mapreduce_pipeline.MapreducePipeline(
-        "dollar_song",
-        "main.dollar_song_map",
-        "main.dollar_song_reduce",
-        "mapreduce.input_readers.BlobstoreZipInputReader",
-        "mapreduce.output_writers.GoogleCloudStorageOutputWriter",
-        mapper_params={
-            "blob_key": blobkey,
-        },
-        reducer_params={
-            "output_writer": {
-                "bucket_name": bucket_name,
-                "content_type": "text/plain",
-            }
-        },
-        shards=4)
-    yield StoreOutput("DollarSong", filekey, output)
-
-
-class SongArtistPipeline(base_handler.PipelineBase):
+  def __init__(self):
+    super(UserProfileMapper, self).__init__()
+    self._profiles = {}
+    self._capacity = 0
+    self._basket_key = None
 
-  def run(self, filekey, blobkey):
-    bucket_name = app_identity.get_default_gcs_bucket_name()
-    output = yield mapreduce_pipeline.MapreducePipeline(
-        "song_artist",
-        "main.song_artist_map",
-        "main.song_artist_reduce",
-        "mapreduce.input_readers.BlobstoreZipInputReader",
-        "mapreduce.output_writers.GoogleCloudStorageOutputWriter",
-        mapper_params={
-            "blob_key": blobkey,
-        },
-        reducer_params={
-            "output_writer": {
-                "bucket_name": bucket_name,
-                "content_type": "text/plain",
-            }
-        },
-        shards=4)
-    yield StoreOutput("SongArtist", filekey, output)
-
-class DollarArtistPipeline(base_handler.PipelineBase):
+  def begin_slice(self, slice_ctx):
+    self._capacity = _job_param_int("profile_capacity", 0)
 
-  def run(self, filekey, blobkey):
+  def __call__(self, slice_ctx, data):
+    (entry, text_fn) = data
+    text = text_fn()
+    profiles = self._profiles
+
+    logging.debug("Got %s", entry.filename)
+    for t in transactions.iter_transactions(text):
+      basket_key = (t.timestamp, t.user)
+      profile = profiles.get(t.user)
+      if profile is None:
+        profile = profiles[t.user] = _UserProfile()
+      profile.add(t, basket_key != self._basket_key, self._capacity)
+      self._basket_key = basket_key
+    if len(profiles) > self._MAX_USERS:
+      self._emit(slice_ctx)
+
+  def end_slice(self, slice_ctx):
+    self._emit(slice_ctx)
+
+  def _emit(self, slice_ctx):
+    for user, profile in self._profiles.iteritems():
+      slice_ctx.emit((user, profile.encode()))
+    self._profiles = {}
+
+
+def _merge_profiles(values, profile=None):
+  """Merges encoded profiles one at a time into profile."""
+  capacity = _job_param_int("profile_capacity", 0)
+  profile = profile or _UserProfile()
+  for value in values:
+    profile.merge(_UserProfile.decode(value), capacity)
+  return profile
+
+
+def user_profile_combine(key, values, previously_combined_values):
+  yield _merge_profiles(
+      previously_combined_values, _merge_profiles(values)).encode()
+
+# Yields one line per user: user, spend, baskets, songs, favourite genre and
+# favourite artist, tab-separated.
+def user_profile_reduce(key, values):
+  profile = _merge_profiles(values)
+  (_, genre, _) = sketches.top_k(profile.genres, 1)[0]
+  (_, artist, _) = sketches.top_k(profile.artists, 1)[0]
+  yield "%s\t%s\t%d\t%d\t%s\t%s\n" % (
+      key, transactions.format_cents(profile.spend), profile.baskets,
+      profile.songs, genre, artist)
+
+
+# Target uncompressed input bytes per map shard and per reduce shard. Reduce
+# shards get more input since the combiners shrink the map output.
+MAP_BYTES_PER_SHARD = 16 * 1024 * 1024
+REDUCE_BYTES_PER_SHARD = 64 * 1024 * 1024
+
+# Maximum number of map or reduce shards of a job.
+MAX_SHARDS = 128
+
+
+def _shard_count(input_size, bytes_per_shard):
+  return max(1, min(MAX_SHARDS, -(-input_size // bytes_per_shard)))
+
+
+def shard_counts(blobkey, _reader=blobstore.BlobReader):
+  """Returns the (map shards, reduce shards) to use for an uploaded zip file.
+
+  Shard counts are chosen from the total uncompressed size of the zip members,
+  as listed in the zip file's directory.
+
+  Args:
+    blobkey: the blob key of the zip file.
+    _reader: a callable that returns a file-like object for reading blobs.
+      Used for dependency injection.
+  """
+  zip_input = zipfile.ZipFile(_reader(blobkey))
+  input_size = sum(info.file_size for info in zip_input.infolist())
+  map_shards = _shard_count(input_size, MAP_BYTES_PER_SHARD)
+  reduce_shards = min(map_shards,
+                      _shard_count(input_size, REDUCE_BYTES_PER_SHARD))
+  return (map_shards, reduce_shards)
+
+
+class AnalysisPipeline(base_handler.PipelineBase):
+  """Base class for the pipelines running a MapReduce over an uploaded file.
+
+  Subclasses describe their job with the class attributes below, and may
+  override job_params to turn their options into job parameters. Shard
+  counts are chosen from the size of the input, see shard_counts.
+  """
+
+  job_name = None
+  mapper_spec = None
+  reducer_spec = None
+  combiner_spec = None
+  output_writer_spec = "mapreduce.output_writers.GoogleCloudStorageOutputWriter"
+  # Name of the result (see StoreOutput), and whether the output writer is
+  # partitioned.
+  result_name = None
+  partitioned = False
+  # (name, type) columns of the rows yielded by the reducer, for the columnar
+  # output writer.
+  columns = None
+  # kv_format version of the shuffle records, and whether the map phase
+  # writes sorted runs that the shuffle only merges. The compact format saves
+  # a message per record, which matters for jobs that emit many small
+  # records; the mappers of these jobs combine in memory and emit one record
+  # per key and slice.
+  shuffle_format = kv_format.FORMAT_PROTO
+  sort_map_output = False
+  # Whether the shuffle salts hot keys, and the share of a reduce shard that
+  # makes a key hot, see mapreduce_pipeline.MapreducePipeline. The mappers
+  # of these jobs combine in memory, so their map output is rarely skewed.
+  detect_hot_keys = False
+  hot_key_share = None
+
+  @classmethod
+  def job_params(cls, **options):
+    """Returns extra (mapper params, reducer params) for the job options."""
+    return ({}, {})
+
+  @classmethod
+  def mapreduce_args(cls, blobkey, output_writer_params,
+                     _reader=blobstore.BlobReader, **options):
+    """Returns the arguments of the job's MapreducePipeline.
+
+    Args:
+      blobkey: the blob key of the input zip file.
+      output_writer_params: parameters of the reduce output writer.
+      _reader: a callable that returns a file-like object for reading blobs.
+        Used for dependency injection.
+      **options: the job options, see job_params.
+
+    Returns:
+      A (positional arguments, keyword arguments) tuple.
+    """
+    (mapper_params, reducer_params) = cls.job_params(**options)
+    mapper_params.update({
+        "blob_key": blobkey,
+        "streaming": True,
+    })
+    if cls.columns:
+      output_writer_params = dict(output_writer_params, columns=cls.columns)
+    reducer_params["output_writer"] = output_writer_params
+    (map_shards, reduce_shards) = shard_counts(blobkey, _reader=_reader)
+    return ((cls.job_name,
+             cls.mapper_spec,
+             cls.reducer_spec,
+             "mapreduce.input_readers.BlobstoreZipInputReader",
+             cls.output_writer_spec),
+            {"mapper_params": mapper_params,
+             "reducer_params": reducer_params,
+             "shards": map_shards,
+             "combiner_spec": cls.combiner_spec,
+             "reduce_shards": reduce_shards,
+             "shuffle_format": cls.shuffle_format,
+             "sort_map_output": cls.sort_map_output,
+             "detect_hot_keys": cls.detect_hot_keys,
+             "hot_key_share": cls.hot_key_share})
+
+  def run(self, filekey, blobkey, **options):
     bucket_name = app_identity.get_default_gcs_bucket_name()
-    output = yield mapreduce_pipeline.MapreducePipeline(
-        "dollar_artist",
-        "main.dollar_artist_map",
-        "main.dollar_artist_reduce",
-        "mapreduce.input_readers.BlobstoreZipInputReader",
-        "mapreduce.output_writers.GoogleCloudStorageOutputWriter",
-        mapper_params={
-            "blob_key": blobkey,
-        },
-        reducer_params={
-            "output_writer": {
-                "bucket_name": bucket_name,
-                "content_type": "text/plain",
-            }
-        },
-        shards=4)
-    yield StoreOutput("DollarArtist", filekey, output)
+    content_type = "text/plain"
+    if self.columns:
+      content_type = "application/octet-stream"
+    (args, kwargs) = self.mapreduce_args(
+        blobkey,
+        {"bucket_name": bucket_name, "content_type": content_type},
+        **options)
+    output = yield mapreduce_pipeline.MapreducePipeline(*args, **kwargs)
+    yield self.store_output(filekey, output, **options)
+
+  def store_output(self, filekey, output, **options):
+    """Returns the pipeline storing the output of the job."""
+    return StoreOutput(self.result_name, filekey, output,
+                       partitioned=self.partitioned)
+
+
+class SongSoldNumPipeline(AnalysisPipeline):
+  job_name = "song_sold_num"
+  mapper_spec = "main.SongSoldNumMapper"
+  reducer_spec = "main.song_sold_num_reduce"
+  combiner_spec = "main.sum_combine"
+  result_name = "SongSoldNum"
+
+
+class DollarSongPipeline(AnalysisPipeline):
+  job_name = "dollar_song"
+  mapper_spec = "main.DollarSongMapper"
+  reducer_spec = "main.dollar_song_reduce"
+  combiner_spec = "main.sum_combine"
+  result_name = "DollarSong"
+
+
+class SongArtistPipeline(AnalysisPipeline):
+  job_name = "song_artist"
+  mapper_spec = "main.SongArtistMapper"
+  reducer_spec = "main.song_artist_reduce"
+  combiner_spec = "main.sum_combine"
+  result_name = "SongArtist"
+
+
+class DollarArtistPipeline(AnalysisPipeline):
+  job_name = "dollar_artist"
+  mapper_spec = "main.DollarArtistMapper"
+  reducer_spec = "main.dollar_artist_reduce"
+  combiner_spec = "main.sum_combine"
+  result_name = "DollarArtist"
+
 
 class JazzSongSoldNumPipeline(base_handler.PipelineBase):
 
   def run(self, filekey, blobkey):
-    bucket_name = app_identity.get_default_gcs_bucket_name()
-    output = yield mapreduce_pipeline.MapreducePipeline(
-        "jazz_song_sold_num",
-        "main.jazz_song_sold_num_map",
-        "main.jazz_song_sold_num_reduce",
-        "mapreduce.input_readers.BlobstoreZipInputReader",
-        "mapreduce.output_writers.GoogleCloudStorageOutputWriter",
-        mapper_params={
-            "blob_key": blobkey,
-        },
-        reducer_params={
-            "output_writer": {
-                "bucket_name": bucket_name,
-                "content_type": "text/plain",
-            }
-        },
-        shards=4)
-    yield StoreOutput("JazzSongSoldNum", filekey, output)
+    yield GenreMetricsPipeline(
+        filekey, blobkey, genres=[_FILTER_GENRE], metrics=["SongSoldNum"])
 
 class JazzDollarSongPipeline(base_handler.PipelineBase):
 
   def run(self, filekey, blobkey):
-    bucket_name = app_identity.get_default_gcs_bucket_name()
-    output = yield mapreduce_pipeline.MapreducePipeline(
-        "jazz_dollar_song",
-        "main.jazz_dollar_song_map",
-        "main.jazz_dollar_song_reduce",
-        "mapreduce.input_readers.BlobstoreZipInputReader",
-        "mapreduce.output_writers.GoogleCloudStorageOutputWriter",
-        mapper_params={
-            "blob_key": blobkey,
-        },
-        reducer_params={
-            "output_writer": {
-                "bucket_name": bucket_name,
-                "content_type": "text/plain",
-            }
-        },
-        shards=4)
-    yield StoreOutput("JazzDollarSong", filekey, output)
-
+    yield GenreMetricsPipeline(
+        filekey, blobkey, genres=[_FILTER_GENRE], metrics=["DollarSong"])
 
 class JazzSongArtistPipeline(base_handler.PipelineBase):
 
   def run(self, filekey, blobkey):
-    bucket_name = app_identity.get_default_gcs_bucket_name()
-    output = yield mapreduce_pipeline.MapreducePipeline(
-        "jazz_song_artist",
-        "main.jazz_song_artist_map",
-        "main.jazz_song_artist_reduce",
-        "mapreduce.input_readers.BlobstoreZipInputReader",
-        "mapreduce.output_writers.GoogleCloudStorageOutputWriter",
-        mapper_params={
-            "blob_key": blobkey,
-        },
-        reducer_params={
-            "output_writer": {
-                "bucket_name": bucket_name,
-                "content_type": "text/plain",
-            }
-        },
-        shards=4)
-    yield StoreOutput("JazzSongArtist", filekey, output)
+    yield GenreMetricsPipeline(
+        filekey, blobkey, genres=[_FILTER_GENRE], metrics=["SongArtist"])
 
 class JazzDollarArtistPipeline(base_handler.PipelineBase):
 
   def run(self, filekey, blobkey):
-    bucket_name = app_identity.get_default_gcs_bucket_name()
-    output = yield mapreduce_pipeline.MapreducePipeline(
-        "jazz_dollar_artist",
-        "main.jazz_dollar_artist_map",
-        "main.jazz_dollar_artist_reduce",
-        "mapreduce.input_readers.BlobstoreZipInputReader",
-        "mapreduce.output_writers.GoogleCloudStorageOutputWriter",
-        mapper_params={
-            "blob_key": blobkey,
-        },
-        reducer_params={
-            "output_writer": {
-                "bucket_name": bucket_name,
-                "content_type": "text/plain",
-            }
-        },
-        shards=4)
-    yield StoreOutput("JazzDollarArtist", filekey, output)
-
-
-class GCSMapperParams(base_handler.PipelineBase):
-
-  def run(self, GCSPath):
-      bucket_name = app_identity.get_default_gcs_bucket_name()
-
-      return {
-        "input_reader": {
-        "bucket_name": bucket_name,
-        "objects": [path.split('/', 2)[2] for path in GCSPath],
-        }
-      }
-
-class MostBuyTogetherPipeline(base_handler.PipelineBase):
+    yield GenreMetricsPipeline(
+        filekey, blobkey, genres=[_FILTER_GENRE], metrics=["DollarArtist"])
+
+
+class AllMetricsPipeline(AnalysisPipeline):
+  job_name = "all_metrics"
+  mapper_spec = "main.AllMetricsMapper"
+  reducer_spec = "main.all_metrics_reduce"
+  combiner_spec = "main.sum_combine"
+  output_writer_spec = (
+      "mapreduce.output_writers.GoogleCloudStoragePartitionedOutputWriter")
+  result_name = "AllMetrics"
+  partitioned = True
+
+
+class GenreMetricsPipeline(AnalysisPipeline):
+  """Computes per-genre metrics, with one set of output files per genre.
+
+  Options:
+    genres: genres to compute metrics for, or None for every genre
+    metrics: metrics to compute (see _GENRE_METRICS), or None for all of them
+  """
+
+  job_name = "genre_metrics"
+  mapper_spec = "main.GenreMetricsMapper"
+  reducer_spec = "main.genre_metrics_reduce"
+  combiner_spec = "main.sum_combine"
+  output_writer_spec = (
+      "mapreduce.output_writers.GoogleCloudStoragePartitionedOutputWriter")
+  result_name = "GenreMetrics"
+  partitioned = True
+
+  @classmethod
+  def job_params(cls, genres=None, metrics=None):
+    return ({"genres": genres, "metrics": metrics}, {})
+
+
+class MostBuyTogetherPipeline(AnalysisPipeline):
+  """Finds the songs most often bought together with each song.
+
+  Options:
+    top_k: number of ranked partners to report per song
+    min_support: minimum number of baskets a reported pair must appear in
+    sketch_size: if set, count at most this many partners per song with a
+      space-saving summary instead of counting every partner exactly
+  """
+
+  job_name = "most_buy_together"
+  mapper_spec = "main.CoPurchaseMapper"
+  reducer_spec = "main.most_buy_together_reduce"
+  combiner_spec = "main.co_purchase_combine"
+  result_name = "MostBuyTogether"
+
+  @classmethod
+  def job_params(cls, top_k=1, min_support=1, sketch_size=0):
+    return ({"sketch_size": sketch_size},
+            {"top_k": top_k,
+             "min_support": min_support,
+             "sketch_size": sketch_size})
+
+
+class WindowedSalesPipeline(AnalysisPipeline):
+  """Computes hourly, daily and monthly sales of each song and artist."""
+
+  job_name = "windowed_sales"
+  mapper_spec = "main.WindowedSalesMapper"
+  reducer_spec = "main.windowed_sales_reduce"
+  combiner_spec = "main.windowed_sales_combine"
+  output_writer_spec = (
+      "mapreduce.output_writers.GoogleCloudStoragePartitionedOutputWriter")
+  result_name = "WindowedSales"
+  partitioned = True
+
+
+class DistinctBuyersPipeline(AnalysisPipeline):
+  """Estimates the number of distinct buyers of each song, artist and genre.
+
+  Options:
+    hll_precision: log2 of the number of HyperLogLog registers per key; the
+      standard error of the estimates is 1.04 / sqrt(2^hll_precision)
+  """
+
+  job_name = "distinct_buyers"
+  mapper_spec = "main.DistinctBuyersMapper"
+  reducer_spec = "main.distinct_buyers_reduce"
+  combiner_spec = "main.distinct_buyers_combine"
+  output_writer_spec = (
+      "mapreduce.output_writers.GoogleCloudStoragePartitionedOutputWriter")
+  result_name = "DistinctBuyers"
+  partitioned = True
+
+  @classmethod
+  def job_params(cls, hll_precision=sketches.HLL_PRECISION):
+    return ({"hll_precision": hll_precision}, {})
+
+
+class UserProfilePipeline(AnalysisPipeline):
+  """Computes the purchase profile of each user.
+
+  Options:
+    profile_capacity: if set, the maximum number of genres and artists
+      counted per user. The favourites are exact for users who bought from
+      at most that many genres and artists, and approximate for the others,
+      see _UserProfile. Defaults to 0, which counts every genre and artist
+      exactly.
+  """
+
+  job_name = "user_profile"
+  mapper_spec = "main.UserProfileMapper"
+  reducer_spec = "main.user_profile_reduce"
+  combiner_spec = "main.user_profile_combine"
+  result_name = "UserProfile"
+
+  @classmethod
+  def job_params(cls, profile_capacity=0):
+    return ({"profile_capacity": profile_capacity},
+            {"profile_capacity": profile_capacity})
 
-  def run(self, filekey, blobkey):
-    bucket_name = app_identity.get_default_gcs_bucket_name()
 
-    deduped_blob_key = yield mapreduce_pipeline.MapreducePipeline(
-        "songs_same_time",
-        "main.songs_same_time_map",
-        "main.songs_same_time_reduce",
-        "mapreduce.input_readers.BlobstoreZipInputReader",
-        "mapreduce.output_writers.GoogleCloudStorageOutputWriter",
-        mapper_params={
-            "blob_key": blobkey,
-        },
-        reducer_params={
-            "output_writer": {
-                "bucket_name": bucket_name,
-                "content_type": "text/plain",
-            }
-        },
-        shards=4)
-
-    output = yield mapreduce_pipeline.MapreducePipeline(
-        "most_buy_together",
-        "main.most_buy_together_map",
-        "main.most_buy_together_reduce",
-        "mapreduce.input_readers.GoogleCloudStorageInputReader",
-        "mapreduce.output_writers.GoogleCloudStorageOutputWriter",
-        mapper_params=(yield GCSMapperParams(deduped_blob_key)),
-        reducer_params={
-            "output_writer": {
-                "bucket_name": bucket_name,
-                "content_type": "text/plain",
-            }
-        },
-        shards=4)
-
-    yield StoreOutput("MostBuyTogether", filekey, output)
+class SongSalesPipeline(AnalysisPipeline):
+  """Computes the sales count and revenue of each song, with its genre.
+
+  The output files are columnar files of SONG_SALES_COLUMNS rows sorted by
+  song, to be read with mapreduce.columnar.ColumnarReader.
+  """
+
+  job_name = "song_sales"
+  mapper_spec = "main.SongSalesMapper"
+  reducer_spec = "main.song_sales_reduce"
+  combiner_spec = "main.song_sales_combine"
+  output_writer_spec = (
+      "mapreduce.output_writers.GoogleCloudStorageColumnarOutputWriter")
+  result_name = "SongSales"
+  columns = SONG_SALES_COLUMNS
+
+
+class DurationStatsPipeline(AnalysisPipeline):
+  """Computes the duration statistics of each genre.
+
+  Writes one 'genre<TAB>sales<TAB>minutes<TAB>revenue<TAB>revenue per
+  minute<TAB>histogram' line per genre, where the histogram lists the sales
+  per duration bin as 'bin=count' pairs, see durations.bin_label.
+  """
+
+  job_name = "duration_stats"
+  mapper_spec = "main.DurationStatsMapper"
+  reducer_spec = "main.duration_stats_reduce"
+  combiner_spec = "main.duration_stats_combine"
+  result_name = "DurationStats"
+
+
+class LeaderboardsPipeline(AnalysisPipeline):
+  """Computes the top entities of every metric, overall and per genre.
+
+  Options:
+    top_n: number of entities per leaderboard
+  """
+
+  job_name = "leaderboards"
+  mapper_spec = "main.LeaderboardMapper"
+  reducer_spec = "main.LeaderboardReducer"
+  combiner_spec = "main.sum_combine"
+  output_writer_spec = (
+      "mapreduce.output_writers.GoogleCloudStoragePartitionedOutputWriter")
+  partitioned = True
+
+  @classmethod
+  def job_params(cls, top_n=20):
+    return ({}, {"top_n": top_n})
+
+  def store_output(self, filekey, output, top_n=20):
+    return MergeLeaderboards(filekey, output, top_n)
+
+
+class IncrementalMetricsPipeline(AnalysisPipeline):
+  """Adds the per-song and per-artist totals of an upload to the cumulative
+  totals of its owner, see MergeSnapshots.
+  """
+
+  job_name = "incremental_metrics"
+  mapper_spec = "main.MetricPartialsMapper"
+  reducer_spec = "main.metric_partials_reduce"
+  combiner_spec = "main.sum_combine"
+  output_writer_spec = (
+      "mapreduce.output_writers.GoogleCloudStoragePartitionedOutputWriter")
+  partitioned = True
+
+  def store_output(self, filekey, output):
+    return MergeSnapshots(filekey, output)
+
 
 class StoreOutput(base_handler.PipelineBase):
   """A pipeline to store the result of the MapReduce job in the database.
 
+  Results are stored as ResultManifest children of the input file's metadata,
+  one per result name, with a link to each output file.
+
   Args:
-    mr_type: the type of mapreduce job run (e.g., WordCount, Index)
+    mr_type: the type of mapreduce job run (e.g., SongSoldNum), used as the
+      result name
     encoded_key: the DB key corresponding to the metadata of this job
-    output: the gcs file path where the output of the job is stored
+    output: the gcs file paths where the output of the job is stored
+    partitioned: whether output was written by the partitioned output writer,
+      in which case each partition is stored as its own result, named after
+      the partition
   """
 
-  def run(self, mr_type, encoded_key, output):
+  def run(self, mr_type, encoded_key, output, partitioned=False):
     logging.debug("output is %s" % str(output))
     key = db.Key(encoded=encoded_key)
-    m = FileMetadata.get(key)
-
-    blobstore_filename = "/gs" + output[0]
-    blobstore_gs_key = blobstore.create_gs_key(blobstore_filename)
-    url_path = "/blobstore/" + blobstore_gs_key
-
-    if mr_type == "SongSoldNum":
-      m.songsoldnum_link = url_path
-      for i in range(1, len(output)):
-        blobstore_filename = "/gs" + output[i]
-        blobstore_gs_key = blobstore.create_gs_key(blobstore_filename)
-        url_path = "/blobstore/" + blobstore_gs_key
-        if i == 1:
-          m.songsoldnum_link1 = url_path
-        elif i == 2:
-          m.songsoldnum_link2 = url_path
-        else:
-          m.songsoldnum_link3 = url_path
-    elif mr_type == "DollarSong":
-      m.dollarsong_link = url_path
-      for i in range(1, len(output)):
-        blobstore_filename = "/gs" + output[i]
-        blobstore_gs_key = blobstore.create_gs_key(blobstore_filename)
-        url_path = "/blobstore/" + blobstore_gs_key
-        if i == 1:
-          m.dollarsong_link1 = url_path
-        elif i == 2:
-          m.dollarsong_link2 = url_path
-        else:
-          m.dollarsong_link3 = url_path
-    elif mr_type == "SongArtist":
-      m.songartist_link = url_path
-      for i in range(1, len(output)):
-        blobstore_filename = "/gs" + output[i]
-        blobstore_gs_key = blobstore.create_gs_key(blobstore_filename)
-        url_path = "/blobstore/" + blobstore_gs_key
-        if i == 1:
-          m.songartist_link1 = url_path
-        elif i == 2:
-          m.songartist_link2 = url_path
-        else:
-          m.songartist_link3 = url_path
-    elif mr_type == "DollarArtist":
-      m.dollarartist_link = url_path
-      for i in range(1, len(output)):
-        blobstore_filename = "/gs" + output[i]
-        blobstore_gs_key = blobstore.create_gs_key(blobstore_filename)
-        url_path = "/blobstore/" + blobstore_gs_key
-        if i == 1:
-          m.dollarartist_link1 = url_path
-        elif i == 2:
-          m.dollarartist_link2 = url_path
-        else:
-          m.dollarartist_link3 = url_path
-    elif mr_type == "JazzSongSoldNum":
-      m.jazzsongsoldnum_link = url_path
-      for i in range(1, len(output)):
-        blobstore_filename = "/gs" + output[i]
-        blobstore_gs_key = blobstore.create_gs_key(blobstore_filename)
-        url_path = "/blobstore/" + blobstore_gs_key
-        if i == 1:
-          m.jazzsongsoldnum_link1 = url_path
-        elif i == 2:
-          m.jazzsongsoldnum_link2 = url_path
-        else:
-          m.jazzsongsoldnum_link3 = url_path
-    elif mr_type == "JazzDollarSong":
-      m.jazzdollarsong_link = url_path
-      for i in range(1, len(output)):
-        blobstore_filename = "/gs" + output[i]
-        blobstore_gs_key = blobstore.create_gs_key(blobstore_filename)
-        url_path = "/blobstore/" + blobstore_gs_key
-        if i == 1:
-          m.jazzdollarsong_link1 = url_path
-        elif i == 2:
-          m.jazzdollarsong_link2 = url_path
-        else:
-          m.jazzdollarsong_link3 = url_path
-    elif mr_type == "JazzSongArtist":
-      m.jazzsongartist_link = url_path
-      for i in range(1, len(output)):
-        blobstore_filename = "/gs" + output[i]
-        blobstore_gs_key = blobstore.create_gs_key(blobstore_filename)
-        url_path = "/blobstore/" + blobstore_gs_key
-        if i == 1:
-          m.jazzsongartist_link1 = url_path
-        elif i == 2:
-          m.jazzsongartist_link2 = url_path
-        else:
-          m.jazzsongartist_link3 = url_path
-    elif mr_type == "JazzDollarArtist":
-      m.jazzdollarartist_link = url_path
-      for i in range(1, len(output)):
-        blobstore_filename = "/gs" + output[i]
-        blobstore_gs_key = blobstore.create_gs_key(blobstore_filename)
-        url_path = "/blobstore/" + blobstore_gs_key
-        if i == 1:
-          m.jazzdollarartist_link1 = url_path
-        elif i == 2:
-          m.jazzdollarartist_link2 = url_path
-        else:
-          m.jazzdollarartist_link3 = url_path
-    else:
-      m.mostbuytogether_link = url_path
-      for i in range(1, len(output)):
-        blobstore_filename = "/gs" + output[i]
-        blobstore_gs_key = blobstore.create_gs_key(blobstore_filename)
-        url_path = "/blobstore/" + blobstore_gs_key
-        if i == 1:
-          m.mostbuytogether_link1 = url_path
-        elif i == 2:
-          m.mostbuytogether_link2 = url_path
-        else:
-          m.mostbuytogether_link3 = url_path
 
-    m.put()
+    results = {}
+    if partitioned:
+      writer = output_writers.GoogleCloudStoragePartitionedOutputWriter
+      for filename in sorted(output):
+        name = "".join(writer.get_partition(filename))
+        results.setdefault(name, []).append(filename)
+    elif output:
+      results[mr_type] = output
+
+    _put_manifests(key, results)
+
+
+def _put_manifests(key, results):
+  """Stores ResultManifests for a result name -> GCS filenames dict.
+
+  Args:
+    key: the DB key of the metadata of the input file.
+    results: dict of result name to list of GCS file paths.
+  """
+  # Create all blobstore keys in one batch of asynchronous calls.
+  rpcs = dict(
+      (filename, blobstore.create_gs_key_async("/gs" + filename))
+      for filenames in results.itervalues() for filename in filenames)
+  db.put([ResultManifest(
+      parent=key,
+      key_name=name,
+      name=name,
+      links=["/blobstore/" + rpcs[filename].get_result()
+             for filename in filenames])
+          for name, filenames in sorted(results.iteritems())])
+
+
+class SnapshotConflictError(Exception):
+  """The snapshot changed while an upload was being merged into it."""
+
+
+class MergeSnapshots(base_handler.PipelineBase):
+  """A pipeline to merge the partial results of an upload into the snapshots.
+
+  For each metric, the upload's partial files and the owner's snapshot are
+  merged into a new snapshot file and a report in the format of the metric's
+  standalone job, stored as the 'Cumulative<metric>' result of the upload.
+  Uploads already included in a snapshot are skipped, so a retried or rerun
+  pipeline does not count an upload twice. If another upload's merge commits
+  first, the pipeline fails with SnapshotConflictError and is retried.
+
+  Args:
+    encoded_key: the DB key corresponding to the metadata of the upload
+    output: the gcs file paths of the partial results, as written by the
+      partitioned output writer with one partition per metric
+  """
+
+  def run(self, encoded_key, output):
+    key = db.Key(encoded=encoded_key)
+    owner = FileMetadata.get(key).owner
+    writer = output_writers.GoogleCloudStoragePartitionedOutputWriter
+    partials = {}
+    for filename in output:
+      partials.setdefault("".join(writer.get_partition(filename)),
+                          []).append(filename)
+
+    prefix = "/%s/cumulative/%s/%s" % (
+        app_identity.get_default_gcs_bucket_name(),
+        urllib.quote(owner.nickname(), safe=""),
+        self.pipeline_id)
+    reports = {}
+    for metric, filenames in sorted(partials.iteritems()):
+      snapshot_key = db.Key.from_path(
+          "CumulativeSnapshot",
+          CumulativeSnapshot.getKeyName(owner.nickname(), metric))
+      snapshot = db.get(snapshot_key)
+      if snapshot and encoded_key in snapshot.uploads:
+        continue
+      previous = snapshot and snapshot.filename
+      if previous:
+        filenames = [previous] + filenames
+      snapshot_name = "%s/%s-snapshot" % (prefix, metric)
+      report_name = "%s/%s-report" % (prefix, metric)
+      self._merge(metric, filenames, snapshot_name, report_name)
+
+      def commit(snapshot_key=snapshot_key, metric=metric, previous=previous,
+                 snapshot_name=snapshot_name):
+        snapshot = db.get(snapshot_key)
+        if (snapshot and snapshot.filename) != previous:
+          raise SnapshotConflictError(snapshot_key.name())
+        snapshot = snapshot or CumulativeSnapshot(
+            key=snapshot_key, owner=owner, metric=metric)
+        snapshot.filename = snapshot_name
+        snapshot.uploads.append(encoded_key)
+        snapshot.put()
+      db.run_in_transaction(commit)
+      reports["Cumulative" + metric] = [report_name]
+
+      if previous:
+        try:
+          cloudstorage.delete(previous)
+        except cloudstorage.NotFoundError:
+          pass
+
+    _put_manifests(key, reports)
+
+  @staticmethod
+  def _merge(metric, filenames, snapshot_name, report_name):
+    """Writes the merged totals of sorted files as a snapshot and a report."""
+    readers = [cloudstorage.open(filename) for filename in filenames]
+    try:
+      with cloudstorage.open(snapshot_name, "w",
+                             content_type="text/plain") as snapshot:
+        with cloudstorage.open(report_name, "w",
+                               content_type="text/plain") as report:
+          write_snapshot(metric, readers, snapshot, report)
+    finally:
+      for reader in readers:
+        reader.close()
+
+
+def write_snapshot(metric, partials, snapshot, report):
+  """Merges the partial results of a metric into a snapshot and a report.
+
+  Args:
+    metric: the metric of the partial results, e.g. 'DollarSong'.
+    partials: iterables of 'entity<TAB>total' lines, each sorted by entity,
+      see merge_partials.
+    snapshot: file to write the merged 'entity<TAB>total' lines to.
+    report: file to write the lines of the metric's standalone job to.
+  """
+  for (entity, total) in merge_partials(partials):
+    snapshot.write("%s\t%d\n" % (entity, total))
+    for line in _METRIC_REDUCERS[metric](
+        entity, [transactions.encode_varint(total)]):
+      report.write(line)
+
+
+class MergeLeaderboards(base_handler.PipelineBase):
+  """A pipeline to merge the per-shard leaderboards into global ones.
+
+  Each leaderboard is written as one file of 'rank<TAB>entity<TAB>value'
+  lines and stored as a result of the input file, named after its partition
+  (e.g. 'TopDollarSong', or 'JazzTopDollarSong' for a genre).
+
+  Args:
+    encoded_key: the DB key corresponding to the metadata of this job
+    output: the gcs file paths of the per-shard leaderboards, as written by
+      LeaderboardReducer
+    top_n: number of entities per leaderboard
+  """
+
+  def run(self, encoded_key, output, top_n):
+    key = db.Key(encoded=encoded_key)
+    prefix = "/%s/leaderboards/%s" % (
+        app_identity.get_default_gcs_bucket_name(), self.pipeline_id)
+    results = {}
+    for name, lines in sorted(merge_leaderboards(output, top_n).iteritems()):
+      filename = "%s/%s" % (prefix, name)
+      with cloudstorage.open(filename, "w", content_type="text/plain") as f:
+        f.writelines(lines)
+      results[name] = [filename]
+
+    _put_manifests(key, results)
+
+
+def merge_leaderboards(output, top_n, _open=cloudstorage.open):
+  """Merges per-shard leaderboards into global ones.
+
+  Args:
+    output: the file paths of the per-shard leaderboards, as written by
+      LeaderboardReducer through the partitioned output writer.
+    top_n: number of entities per leaderboard.
+    _open: a callable that opens a file for reading. Used for dependency
+      injection.
+
+  Returns:
+    A dict of leaderboard name (e.g. 'JazzTopDollarSong') to the list of its
+    'rank<TAB>entity<TAB>value' lines.
+  """
+  writer = output_writers.GoogleCloudStoragePartitionedOutputWriter
+  heaps = {}
+  for filename in output:
+    heap = heaps.setdefault(writer.get_partition(filename), [])
+    with _open(filename) as f:
+      for line in f:
+        (total, entity) = line.rstrip("\n").split("\t", 1)
+        sketches.bounded_top_add(heap, top_n, int(total), entity)
+
+  leaderboards = {}
+  for (genre, top_metric), heap in heaps.iteritems():
+    metric = top_metric[len("Top"):]
+    lines = leaderboards[genre + top_metric] = []
+    for rank, (total, entity) in enumerate(
+        sketches.bounded_top_items(heap), 1):
+      if metric in _DOLLAR_METRICS:
+        value = transactions.format_cents(total)
+      else:
+        value = str(total)
+      lines.append("%d\t%s\t%s\n" % (rank, entity, value))
+  return leaderboards
+
 
 class UploadHandler(blobstore_handlers.BlobstoreUploadHandler):
   """Handler to upload data to blobstore."""
@@ -809,6 +1792,9 @@ class UploadHandler(blobstore_handlers.BlobstoreUploadHandler):
     m.blobkey = str_blob_key
     m.put()
 
+    if self.request.get("incremental"):
+      IncrementalMetricsPipeline(str(m.key()), str_blob_key).start()
+
     self.redirect("/")
 
 
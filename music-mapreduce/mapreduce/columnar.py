@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# Copyright 2011 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Block-compressed columnar file format.
+
+A columnar file holds rows of typed columns. Rows are grouped into blocks and
+each block stores every column separately, so that a reader can load whole
+columns of a block at once, and only the columns it needs:
+
+   file := magic block* footer footer_length trailer_magic
+   block := column_chunk*          // one per column, in column order
+   column_chunk := zlib(values)
+   footer := columns blocks
+   columns := count:varint (name:string type:string)*
+   blocks := count:varint
+       (offset:varint rows:varint min_key:string max_key:string
+        chunk_length:varint*)*
+   footer_length: uint32           // little endian
+   magic, trailer_magic: "MRC1"
+
+where a string is a varint length followed by the bytes, and varints are
+unsigned LEB128. The values of an "int" column are zigzag varints. The values
+of a "string" column are the varint lengths of all the values of the block,
+followed by their concatenated bytes.
+
+The first column is the key column and must be of type "string". The footer
+records the smallest and largest key of every block, so that a range of keys
+can be read without decompressing the blocks outside of it.
+"""
+
+__all__ = ["COLUMN_TYPES",
+           "DEFAULT_BLOCK_ROWS",
+           "ColumnarWriter",
+           "ColumnarReader"]
+
+import collections
+import struct
+import zlib
+
+from mapreduce import errors
+
+
+# pylint: disable=g-bad-name
+
+# Column types.
+COLUMN_TYPES = ("string", "int")
+
+# Leading and trailing magic bytes of a columnar file.
+_MAGIC = "MRC1"
+
+# Format of the footer length.
+_LENGTH_FORMAT = "<I"
+
+_TRAILER_LENGTH = struct.calcsize(_LENGTH_FORMAT) + len(_MAGIC)
+
+# Default maximum number of rows per block.
+DEFAULT_BLOCK_ROWS = 4096
+
+# zlib compression level of column chunks.
+_COMPRESSION_LEVEL = 6
+
+
+# Index entry of a block: its offset in the file, its number of rows, its
+# smallest and largest key and the lengths of its column chunks.
+Block = collections.namedtuple(
+    "Block", ["offset", "rows", "min_key", "max_key", "chunk_lengths"])
+
+
+def _encode_uvarint(value, chunks):
+  while value > 0x7f:
+    chunks.append(chr((value & 0x7f) | 0x80))
+    value >>= 7
+  chunks.append(chr(value))
+
+
+def _decode_uvarints(data, count, pos=0):
+  """Decodes count varints of data starting at pos.
+
+  Returns:
+    A (values, position after the last varint) tuple.
+  """
+  values = []
+  append = values.append
+  for _ in xrange(count):
+    value = 0
+    shift = 0
+    while True:
+      byte = ord(data[pos])
+      pos += 1
+      value |= (byte & 0x7f) << shift
+      if byte < 0x80:
+        break
+      shift += 7
+    append(value)
+  return (values, pos)
+
+
+def _encode_string(s, chunks):
+  _encode_uvarint(len(s), chunks)
+  chunks.append(s)
+
+
+def _decode_string(data, pos):
+  ((length,), pos) = _decode_uvarints(data, 1, pos)
+  return (data[pos:pos + length], pos + length)
+
+
+def _encode_column(column_type, values):
+  """Encodes the values of a column in a block, uncompressed."""
+  chunks = []
+  if column_type == "int":
+    for value in values:
+      _encode_uvarint(~(value << 1) if value < 0 else value << 1, chunks)
+  else:
+    for value in values:
+      _encode_uvarint(len(value), chunks)
+    chunks.extend(values)
+  return "".join(chunks)
+
+
+def _decode_column(column_type, data, rows):
+  """Decodes the values of a column encoded by _encode_column."""
+  (numbers, pos) = _decode_uvarints(data, rows)
+  if column_type == "int":
+    return [(n >> 1) ^ -(n & 1) for n in numbers]
+  values = []
+  for length in numbers:
+    values.append(data[pos:pos + length])
+    pos += length
+  return values
+
+
+def _check_columns(columns):
+  """Returns columns as a list of (name, type) tuples, or raises ValueError.
+
+  Names and types may be unicode, e.g. when columns were decoded from JSON.
+  """
+  checked = []
+  for column in columns:
+    if len(column) != 2 or column[1] not in COLUMN_TYPES:
+      raise ValueError("Bad column %r, expected (name, type) with a type in %s"
+                       % (column, COLUMN_TYPES))
+    checked.append((str(column[0]), str(column[1])))
+  columns = checked
+  if not columns:
+    raise ValueError("At least one column is required")
+  if columns[0][1] != "string":
+    raise ValueError("The key column %r must be of type string" %
+                     (columns[0][0],))
+  if len(set(name for (name, _) in columns)) != len(columns):
+    raise ValueError("Duplicate column names in %r" % (columns,))
+  return columns
+
+
+class ColumnarWriter(object):
+  """A writer for columnar files.
+
+  Rows are buffered in memory until a block is full. The block index is only
+  written by close(), so a writer that outlives its object (e.g. a shard
+  writer serialized between slices) must flush() and keep the blocks, and
+  pass them back to the next ColumnarWriter of the file.
+  """
+
+  def __init__(self, writer, columns, block_rows=DEFAULT_BLOCK_ROWS,
+               blocks=None):
+    """Constructor.
+
+    Args:
+      writer: a writer conforming to Python io.RawIOBase interface that
+        implements 'write' and 'tell'.
+      columns: list of (name, type) pairs, see COLUMN_TYPES. The first column
+        is the key column.
+      block_rows: maximum number of rows per block.
+      blocks: blocks already written to writer by a previous ColumnarWriter,
+        or None to start a new file.
+
+    Raises:
+      ValueError: if columns is invalid.
+    """
+    self.__writer = writer
+    self.columns = _check_columns(columns)
+    self.block_rows = block_rows
+    self.__pending = [[] for _ in self.columns]
+    if blocks is None:
+      writer.write(_MAGIC)
+      blocks = []
+    self.blocks = list(blocks)
+
+  def write(self, row):
+    """Write single row.
+
+    Args:
+      row: a sequence with one value per column, a string for "string"
+        columns and an integer for "int" columns.
+    """
+    if len(row) != len(self.columns):
+      raise ValueError("Expected %d columns, got %r" % (len(self.columns), row))
+    for (values, value) in zip(self.__pending, row):
+      values.append(value)
+    if len(self.__pending[0]) >= self.block_rows:
+      self.flush()
+
+  def flush(self):
+    """Writes the buffered rows as a block, if there are any."""
+    keys = self.__pending[0]
+    if not keys:
+      return
+    offset = self.__writer.tell()
+    chunk_lengths = []
+    for ((_, column_type), values) in zip(self.columns, self.__pending):
+      chunk = zlib.compress(_encode_column(column_type, values),
+                            _COMPRESSION_LEVEL)
+      self.__writer.write(chunk)
+      chunk_lengths.append(len(chunk))
+    self.blocks.append(Block(offset, len(keys), min(keys), max(keys),
+                             tuple(chunk_lengths)))
+    self.__pending = [[] for _ in self.columns]
+
+  def close(self):
+    """Writes the buffered rows and the footer. The writer is not closed."""
+    self.flush()
+    chunks = []
+    _encode_uvarint(len(self.columns), chunks)
+    for (name, column_type) in self.columns:
+      _encode_string(name, chunks)
+      _encode_string(column_type, chunks)
+    _encode_uvarint(len(self.blocks), chunks)
+    for block in self.blocks:
+      _encode_uvarint(block.offset, chunks)
+      _encode_uvarint(block.rows, chunks)
+      _encode_string(block.min_key, chunks)
+      _encode_string(block.max_key, chunks)
+      for length in block.chunk_lengths:
+        _encode_uvarint(length, chunks)
+    footer = "".join(chunks)
+    self.__writer.write(footer)
+    self.__writer.write(struct.pack(_LENGTH_FORMAT, len(footer)) + _MAGIC)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, atype, value, traceback):
+    self.close()
+
+
+class ColumnarReader(object):
+  """A reader for columnar files."""
+
+  def __init__(self, reader):
+    """Init.
+
+    Args:
+      reader: a reader conforming to Python io.RawIOBase interface that
+        implements 'read', 'seek', and 'tell'.
+
+    Raises:
+      errors.InvalidColumnarFileError: if the file is not a columnar file.
+    """
+    self.__reader = reader
+    reader.seek(0, 2)
+    size = reader.tell()
+    if size < len(_MAGIC) + _TRAILER_LENGTH:
+      raise errors.InvalidColumnarFileError("File too short")
+    reader.seek(size - _TRAILER_LENGTH)
+    trailer = reader.read(_TRAILER_LENGTH)
+    if trailer[-len(_MAGIC):] != _MAGIC:
+      raise errors.InvalidColumnarFileError("Bad trailer magic")
+    (footer_length,) = struct.unpack(_LENGTH_FORMAT, trailer[:-len(_MAGIC)])
+    if footer_length > size - len(_MAGIC) - _TRAILER_LENGTH:
+      raise errors.InvalidColumnarFileError("Footer length is too big")
+    reader.seek(size - _TRAILER_LENGTH - footer_length)
+    footer = reader.read(footer_length)
+    try:
+      self.__parse_footer(footer)
+    except (IndexError, ValueError), e:
+      raise errors.InvalidColumnarFileError("Bad footer: %s" % e)
+
+  def __parse_footer(self, footer):
+    ((count,), pos) = _decode_uvarints(footer, 1)
+    self.columns = []
+    for _ in xrange(count):
+      (name, pos) = _decode_string(footer, pos)
+      (column_type, pos) = _decode_string(footer, pos)
+      self.columns.append((name, column_type))
+    self.columns = _check_columns(self.columns)
+    ((count,), pos) = _decode_uvarints(footer, 1, pos)
+    self.blocks = []
+    for _ in xrange(count):
+      ((offset, rows), pos) = _decode_uvarints(footer, 2, pos)
+      (min_key, pos) = _decode_string(footer, pos)
+      (max_key, pos) = _decode_string(footer, pos)
+      (chunk_lengths, pos) = _decode_uvarints(footer, len(self.columns), pos)
+      self.blocks.append(
+          Block(offset, rows, min_key, max_key, tuple(chunk_lengths)))
+    if pos != len(footer):
+      raise ValueError("%d trailing bytes" % (len(footer) - pos))
+
+  def __column_indexes(self, columns):
+    names = [name for (name, _) in self.columns]
+    if columns is None:
+      return range(len(names))
+    try:
+      return [names.index(name) for name in columns]
+    except ValueError:
+      raise KeyError("Unknown column in %r, expected some of %r" %
+                     (columns, names))
+
+  def read_block(self, block, columns=None):
+    """Reads columns of a block.
+
+    Only the chunks of the requested columns are read and decompressed.
+
+    Args:
+      block: a Block of self.blocks.
+      columns: names of the columns to read, or None for all of them.
+
+    Returns:
+      An OrderedDict of column name to the list of its values in the block.
+    """
+    result = collections.OrderedDict()
+    offsets = [block.offset]
+    for length in block.chunk_lengths:
+      offsets.append(offsets[-1] + length)
+    for i in self.__column_indexes(columns):
+      (name, column_type) = self.columns[i]
+      self.__reader.seek(offsets[i])
+      try:
+        data = zlib.decompress(self.__reader.read(block.chunk_lengths[i]))
+        result[name] = _decode_column(column_type, data, block.rows)
+      except (IndexError, zlib.error), e:
+        raise errors.InvalidColumnarFileError(
+            "Bad chunk of column %s at offset %d: %s" % (name, offsets[i], e))
+    return result
+
+  def read_columns(self, start=None, end=None, columns=None):
+    """Reads columns of the rows with a key in [start, end).
+
+    Blocks whose keys are all out of the range are skipped using the footer
+    index, without being read.
+
+    Args:
+      start: the smallest key to return, or None to start from the first row.
+      end: keys from this one on are not returned, or None for no limit.
+      columns: names of the columns to read, or None for all of them.
+
+    Returns:
+      An OrderedDict of column name to the list of its values, in file order.
+    """
+    names = [self.columns[i][0] for i in self.__column_indexes(columns)]
+    result = collections.OrderedDict((name, []) for name in names)
+    key_name = self.columns[0][0]
+    for block in self.blocks:
+      if ((start is not None and block.max_key < start) or
+          (end is not None and block.min_key >= end)):
+        continue
+      inside = ((start is None or block.min_key >= start) and
+                (end is None or block.max_key < end))
+      block_columns = names
+      if not inside and key_name not in names:
+        block_columns = [key_name] + names
+      values = self.read_block(block, block_columns)
+      if inside:
+        for name in names:
+          result[name].extend(values[name])
+        continue
+      selected = [i for (i, key) in enumerate(values[key_name])
+                  if (start is None or key >= start) and
+                  (end is None or key < end)]
+      for name in names:
+        column = values[name]
+        result[name].extend(column[i] for i in selected)
+    return result
+
+  def __iter__(self):
+    """Yields every row as a tuple of values, in file order."""
+    for block in self.blocks:
+      for row in zip(*self.read_block(block).values()):
+        yield row
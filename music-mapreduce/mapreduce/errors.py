@@ -31,6 +31,7 @@ __all__ = [
     "RetrySliceError",
     "ShuffleServiceError",
     "InvalidRecordError",
+    "InvalidColumnarFileError",
     ]
 
 
@@ -88,3 +89,7 @@ class RetrySliceError(Error):
 
 class InvalidRecordError(Error):
   """Raised when invalid record encountered."""
+
+
+class InvalidColumnarFileError(Error):
+  """Raised when a columnar file is invalid or corrupted."""
@@ -67,7 +67,7 @@ from mapreduce import datastore_range_iterators as db_iters
 from mapreduce import errors
 from mapreduce import json_util
 from mapreduce import key_ranges
-from mapreduce import kv_pb
+from mapreduce import kv_format
 from mapreduce import model
 from mapreduce import namespace_range
 from mapreduce import operation
@@ -1443,19 +1443,44 @@ class BlobstoreZipInputReader(InputReader):
   """Input reader for files from a zip archive stored in the Blobstore.
 
   Each instance of the reader will read the TOC, from the end of the zip file,
-  and then only the contained files which it is responsible for.
+  and then only the contained files which it is responsible for. Shards are
+  balanced by the uncompressed size of the contained files, or by their
+  compressed size if the 'balance_by' parameter is 'compress_size'.
+
+  In streaming mode (the 'streaming' parameter) contained files are not read
+  into memory. Instead they are decompressed incrementally and handed to the
+  mapper as line iterators of at most _STREAMING_CHUNK_SIZE bytes each, so the
+  reader can be checkpointed in the middle of a contained file.
+
+  The checkpoint is the offset of the next line in the decompressed file.
+  Deflate streams can't be seeked and zipfile can't save the state of a
+  decompressor, so a reader resumed in the middle of a contained file
+  decompresses and discards everything before the offset. A contained file
+  read over many slices is therefore decompressed up to once per slice, which
+  is quadratic in its size: zips of many moderately sized files, each read in
+  a few slices, stream best.
   """
 
   # Maximum number of shards to allow.
   _MAX_SHARD_COUNT = 256
 
+  # Number of decompressed bytes of a contained file per input in streaming
+  # mode.
+  _STREAMING_CHUNK_SIZE = 1024 * 1024
+
   # Mapreduce parameters.
   BLOB_KEY_PARAM = "blob_key"
   START_INDEX_PARAM = "start_index"
   END_INDEX_PARAM = "end_index"
+  OFFSET_PARAM = "offset"
+  STREAMING_PARAM = "streaming"
+  BALANCE_BY_PARAM = "balance_by"
+
+  # Supported values of BALANCE_BY_PARAM, as zipfile.ZipInfo attribute names.
+  _BALANCE_BY_VALUES = ("file_size", "compress_size")
 
   def __init__(self, blob_key, start_index, end_index,
-               _reader=blobstore.BlobReader):
+               _reader=blobstore.BlobReader, offset=0, streaming=False):
     """Initializes this instance with the given blob key and file range.
 
     This BlobstoreZipInputReader will read from the file with index start_index
@@ -1467,13 +1492,21 @@ class BlobstoreZipInputReader(InputReader):
       end_index: the index of the first file that will not be read.
       _reader: a callable that returns a file-like object for reading blobs.
           Used for dependency injection.
+      offset: the byte offset within the file with index start_index to
+          start reading at. Only used in streaming mode.
+      streaming: whether to stream contained files line by line instead of
+          reading each of them whole.
     """
     self._blob_key = blob_key
     self._start_index = start_index
     self._end_index = end_index
     self._reader = _reader
+    self._offset = offset
+    self._streaming = streaming
     self._zip = None
     self._entries = None
+    self._stream = None
+    self._chunk = None
 
   def next(self):
     """Returns the next input from this input reader as (ZipInfo, opener) tuple.
@@ -1482,13 +1515,17 @@ class BlobstoreZipInputReader(InputReader):
       The next input from this input reader, in the form of a 2-tuple.
       The first element of the tuple is a zipfile.ZipInfo object.
       The second element of the tuple is a zero-argument function that, when
-      called, returns the complete body of the file.
+      called, returns the complete body of the file. In streaming mode it
+      returns an iterator over the next lines of the file instead, which must
+      be consumed before the next input is requested.
     """
     if not self._zip:
       self._zip = zipfile.ZipFile(self._reader(self._blob_key))
       # Get a list of entries, reversed so we can pop entries off in order
       self._entries = self._zip.infolist()[self._start_index:self._end_index]
       self._entries.reverse()
+    if self._streaming:
+      return self._next_chunk()
     if not self._entries:
       raise StopIteration()
     entry = self._entries.pop()
@@ -1514,6 +1551,75 @@ class BlobstoreZipInputReader(InputReader):
 
     return content
 
+  def _next_chunk(self):
+    """Returns the next chunk of lines of the current entry in streaming mode.
+
+    Returns:
+      A (ZipInfo, opener) tuple whose opener returns a line iterator.
+    """
+    self._finish_chunk()
+    while True:
+      if not self._entries:
+        raise StopIteration()
+      if self._stream is None:
+        self._stream = self._zip.open(self._entries[-1])
+        # Deflated data can't be seeked, decompress up to the offset. This
+        # is the cost of resuming in the middle of an entry, see the class
+        # docstring.
+        to_skip = self._offset
+        while to_skip:
+          skipped = len(self._stream.read(min(to_skip, 64 * 1024)))
+          if not skipped:
+            break
+          to_skip -= skipped
+      if self._stream.peek(1):
+        break
+      # Done with this entry, move on to the next one.
+      self._stream.close()
+      self._stream = None
+      self._entries.pop()
+      self._start_index += 1
+      self._offset = 0
+
+    entry = self._entries[-1]
+    self._chunk = self._read_lines(self._stream)
+    chunk = self._chunk
+    return (entry, lambda: chunk)
+
+  def _read_lines(self, stream):
+    """Yields lines from stream, up to _STREAMING_CHUNK_SIZE bytes.
+
+    Args:
+      stream: the stream of the current entry.
+
+    Yields:
+      Lines including their trailing newline.
+    """
+    start_time = time.time()
+    start_offset = self._offset
+    end_offset = start_offset + self._STREAMING_CHUNK_SIZE
+    try:
+      while self._offset < end_offset:
+        line = stream.readline()
+        if not line:
+          break
+        self._offset += len(line)
+        yield line
+    finally:
+      ctx = context.get()
+      if ctx:
+        operation.counters.Increment(
+            COUNTER_IO_READ_BYTES, self._offset - start_offset)(ctx)
+        operation.counters.Increment(
+            COUNTER_IO_READ_MSEC, int((time.time() - start_time) * 1000))(ctx)
+
+  def _finish_chunk(self):
+    """Skips the unconsumed lines of the last chunk returned by next()."""
+    if self._chunk is not None:
+      for _ in self._chunk:
+        pass
+      self._chunk = None
+
   @classmethod
   def from_json(cls, json):
     """Creates an instance of the InputReader for the given input shard state.
@@ -1526,7 +1632,9 @@ class BlobstoreZipInputReader(InputReader):
     """
     return cls(json[cls.BLOB_KEY_PARAM],
                json[cls.START_INDEX_PARAM],
-               json[cls.END_INDEX_PARAM])
+               json[cls.END_INDEX_PARAM],
+               offset=json.get(cls.OFFSET_PARAM, 0),
+               streaming=json.get(cls.STREAMING_PARAM, False))
 
   def to_json(self):
     """Returns an input shard state for the remaining inputs.
@@ -1534,14 +1642,17 @@ class BlobstoreZipInputReader(InputReader):
     Returns:
       A json-izable version of the remaining InputReader.
     """
+    self._finish_chunk()
     return {self.BLOB_KEY_PARAM: self._blob_key,
             self.START_INDEX_PARAM: self._start_index,
-            self.END_INDEX_PARAM: self._end_index}
+            self.END_INDEX_PARAM: self._end_index,
+            self.OFFSET_PARAM: self._offset,
+            self.STREAMING_PARAM: self._streaming}
 
   def __str__(self):
     """Returns the string representation of this BlobstoreZipInputReader."""
-    return "blobstore.BlobKey(%r):[%d, %d]" % (
-        self._blob_key, self._start_index, self._end_index)
+    return "blobstore.BlobKey(%r):[%d, %d]@%d" % (
+        self._blob_key, self._start_index, self._end_index, self._offset)
 
   @classmethod
   def validate(cls, mapper_spec):
@@ -1563,6 +1674,10 @@ class BlobstoreZipInputReader(InputReader):
     if not blob_info:
       raise BadReaderParamsError("Could not find blobinfo for key %s" %
                                  blob_key)
+    balance_by = params.get(cls.BALANCE_BY_PARAM, "file_size")
+    if balance_by not in cls._BALANCE_BY_VALUES:
+      raise BadReaderParamsError("Bad balance_by %r, must be one of %s" %
+                                 (balance_by, cls._BALANCE_BY_VALUES))
 
   @classmethod
   def split_input(cls, mapper_spec, _reader=blobstore.BlobReader):
@@ -1579,26 +1694,35 @@ class BlobstoreZipInputReader(InputReader):
     """
     params = _get_params(mapper_spec)
     blob_key = params[cls.BLOB_KEY_PARAM]
+    balance_by = params.get(cls.BALANCE_BY_PARAM, "file_size")
     zip_input = zipfile.ZipFile(_reader(blob_key))
     zfiles = zip_input.infolist()
-    total_size = sum(x.file_size for x in zfiles)
-    num_shards = min(mapper_spec.shard_count, cls._MAX_SHARD_COUNT)
-    size_per_shard = total_size // num_shards
-
-    # Break the list of files into sublists, each of approximately
-    # size_per_shard bytes.
+    if not zfiles:
+      return []
+    sizes = [getattr(x, balance_by) for x in zfiles]
+    total_size = sum(sizes)
+    num_shards = min(mapper_spec.shard_count, cls._MAX_SHARD_COUNT, len(zfiles))
+
+    # Break the list of files into at most num_shards sublists. A sublist ends
+    # once its size reaches an even share of the size left for the remaining
+    # shards, so that a few large files don't leave the last shards empty.
     shard_start_indexes = [0]
-    current_shard_size = 0
-    for i, fileinfo in enumerate(zfiles):
-      current_shard_size += fileinfo.file_size
-      if current_shard_size >= size_per_shard:
+    remaining_size = total_size
+    current_size = 0
+    for i, size in enumerate(sizes[:-1]):
+      current_size += size
+      remaining_shards = num_shards - len(shard_start_indexes) + 1
+      if remaining_shards == 1:
+        break
+      if current_size * remaining_shards >= remaining_size:
         shard_start_indexes.append(i + 1)
-        current_shard_size = 0
-
-    if shard_start_indexes[-1] != len(zfiles):
-      shard_start_indexes.append(len(zfiles))
+        remaining_size -= current_size
+        current_size = 0
+    shard_start_indexes.append(len(zfiles))
 
-    return [cls(blob_key, start_index, end_index, _reader)
+    streaming = bool(params.get(cls.STREAMING_PARAM, False))
+    return [cls(blob_key, start_index, end_index, _reader,
+                streaming=streaming)
             for start_index, end_index
             in zip(shard_start_indexes, shard_start_indexes[1:])]
 
@@ -2550,12 +2674,14 @@ class _GoogleCloudStorageRecordInputReader(_GoogleCloudStorageInputReader):
   """
 
   def __getstate__(self):
-    result = self.__dict__.copy()
     # record reader may not exist if reader has not been used
-    if "_record_reader" in result:
-      # RecordsReader has no buffering, it can safely be reconstructed after
-      # deserialization
-      result.pop("_record_reader")
+    if getattr(self, "_record_reader", None) is not None:
+      # RecordsReader buffers the rest of a block. Seeking to its position
+      # moves the file handle back to the next record, so that the reader can
+      # safely be reconstructed after deserialization.
+      self._record_reader.seek(self._record_reader.tell())
+    result = self.__dict__.copy()
+    result.pop("_record_reader", None)
     return result
 
   def next(self):
@@ -2596,7 +2722,7 @@ GoogleCloudStorageRecordInputReader = _GoogleCloudStorageRecordInputReader
 
 
 class _ReducerReader(_GoogleCloudStorageRecordInputReader):
-  """Reader to read KeyValues records from GCS."""
+  """Reader to read KeyValues records of any kv_format version from GCS."""
 
   expand_parameters = True
 
@@ -2619,22 +2745,21 @@ class _ReducerReader(_GoogleCloudStorageRecordInputReader):
     try:
       while True:
         binary_record = super(_ReducerReader, self).next()
-        proto = kv_pb.KeyValues()
-        proto.ParseFromString(binary_record)
+        (key, values) = kv_format.decode_key_values(binary_record)
 
         to_yield = None
-        if self.current_key is not None and self.current_key != proto.key():
+        if self.current_key is not None and self.current_key != key:
           to_yield = (self.current_key, self.current_values)
           self.current_key = None
           self.current_values = None
 
         if self.current_key is None:
-          self.current_key = proto.key()
+          self.current_key = key
           self.current_values = []
 
         if combiner:
           combiner_result = combiner(
-              self.current_key, proto.value_list(), self.current_values)
+              self.current_key, values, self.current_values)
 
           if not util.is_generator(combiner_result):
             raise errors.BadCombinerOutputError(
@@ -2656,7 +2781,7 @@ class _ReducerReader(_GoogleCloudStorageRecordInputReader):
             yield ALLOW_CHECKPOINT
         else:
           # Without combiner we just accumulate values.
-          self.current_values.extend(proto.value_list())
+          self.current_values.extend(values)
 
         if to_yield:
           yield to_yield
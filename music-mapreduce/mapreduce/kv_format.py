@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# Copyright 2011 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Encodings of the key/value records of the shuffle.
+
+Map output and the shuffle's intermediate files are records files of
+KeyValue records, and the merged files read by reducers hold KeyValues
+records of a key and a list of its values. Their encoding is selected per job
+by a format version:
+
+  FORMAT_PROTO: kv_pb.KeyValue and kv_pb.KeyValues protocol buffers. This is
+    the default.
+  FORMAT_COMPACT: varint-length framing, which is decoded by slicing without
+    creating a message object per record:
+
+      key_value := marker key_length:varint key value
+      key_values := marker key_length:varint key (value_length:varint value)*
+      marker := "\\x00"
+
+    varints are unsigned LEB128, and the value of a key_value is the rest of
+    the record.
+
+A protocol buffer record never starts with a zero byte, since its first byte
+is the tag of its required key field. The decoding functions use this to
+accept records of both formats, so readers do not depend on the format
+version.
+"""
+
+__all__ = ["FORMAT_PROTO",
+           "FORMAT_COMPACT",
+           "FORMATS",
+           "FORMAT_PARAM",
+           "encode_key_value",
+           "decode_key_value",
+           "decode_key",
+           "encode_key_values",
+           "decode_key_values"]
+
+from mapreduce import errors
+from mapreduce import kv_pb
+
+
+# pylint: disable=g-bad-name
+
+# Format versions.
+FORMAT_PROTO = 1
+FORMAT_COMPACT = 2
+
+FORMATS = (FORMAT_PROTO, FORMAT_COMPACT)
+
+# Name of the mapper and output writer parameter holding the format version.
+FORMAT_PARAM = "shuffle_format"
+
+# First byte of a FORMAT_COMPACT record.
+_MARKER = "\x00"
+
+# Encoded varints of the lengths below 128, which take one byte.
+_SHORT_LENGTHS = [chr(length) for length in xrange(0x80)]
+
+
+def _encode_length(length):
+  if length < 0x80:
+    return _SHORT_LENGTHS[length]
+  chunks = []
+  while length > 0x7f:
+    chunks.append(chr((length & 0x7f) | 0x80))
+    length >>= 7
+  chunks.append(chr(length))
+  return "".join(chunks)
+
+
+def _decode_string(record, pos):
+  """Decodes the length-prefixed string of a compact record at pos.
+
+  Returns:
+    A (string, position after it) tuple.
+
+  Raises:
+    InvalidRecordError: if the record ends within the string.
+  """
+  try:
+    length = ord(record[pos])
+    pos += 1
+    if length > 0x7f:
+      length &= 0x7f
+      shift = 7
+      while True:
+        byte = ord(record[pos])
+        pos += 1
+        length |= (byte & 0x7f) << shift
+        if byte < 0x80:
+          break
+        shift += 7
+  except IndexError:
+    raise errors.InvalidRecordError("Truncated key/value record")
+  end = pos + length
+  if end > len(record):
+    raise errors.InvalidRecordError("Truncated key/value record")
+  return (record[pos:end], end)
+
+
+def encode_key_value(key, value, shuffle_format=FORMAT_PROTO):
+  """Encodes a key and a value as a KeyValue record."""
+  if shuffle_format == FORMAT_COMPACT:
+    return "".join((_MARKER, _encode_length(len(key)), key, value))
+  proto = kv_pb.KeyValue()
+  proto.set_key(key)
+  proto.set_value(value)
+  return proto.Encode()
+
+
+def decode_key_value(record):
+  """Decodes a KeyValue record of either format.
+
+  Returns:
+    A (key, value) tuple.
+  """
+  if record[:1] == _MARKER:
+    (key, pos) = _decode_string(record, 1)
+    return (key, record[pos:])
+  proto = kv_pb.KeyValue()
+  proto.ParseFromString(record)
+  return (proto.key(), proto.value())
+
+
+def decode_key(record):
+  """Returns the key of a KeyValue record of either format."""
+  if record[:1] == _MARKER:
+    return _decode_string(record, 1)[0]
+  proto = kv_pb.KeyValue()
+  proto.ParseFromString(record)
+  return proto.key()
+
+
+def encode_key_values(key, values, shuffle_format=FORMAT_PROTO):
+  """Encodes a key and a list of its values as a KeyValues record."""
+  if shuffle_format == FORMAT_COMPACT:
+    chunks = [_MARKER, _encode_length(len(key)), key]
+    for value in values:
+      chunks.append(_encode_length(len(value)))
+      chunks.append(value)
+    return "".join(chunks)
+  proto = kv_pb.KeyValues()
+  proto.set_key(key)
+  proto.value_list().extend(values)
+  return proto.Encode()
+
+
+def decode_key_values(record):
+  """Decodes a KeyValues record of either format.
+
+  Returns:
+    A (key, values) tuple, where values is a list.
+  """
+  if record[:1] == _MARKER:
+    (key, pos) = _decode_string(record, 1)
+    values = []
+    end = len(record)
+    while pos < end:
+      (value, pos) = _decode_string(record, pos)
+      values.append(value)
+    return (key, values)
+  proto = kv_pb.KeyValues()
+  proto.ParseFromString(record)
+  return (proto.key(), proto.value_list())
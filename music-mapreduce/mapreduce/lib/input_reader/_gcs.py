@@ -368,12 +368,14 @@ class GCSRecordInputReader(GCSInputReader):
   """
 
   def __getstate__(self):
-    result = self.__dict__.copy()
     # record reader may not exist if reader has not been used
-    if "_record_reader" in result:
-      # RecordsReader has no buffering, it can safely be reconstructed after
-      # deserialization
-      result.pop("_record_reader")
+    if getattr(self, "_record_reader", None) is not None:
+      # RecordsReader buffers the rest of a block. Seeking to its position
+      # moves the file handle back to the next record, so that the reader can
+      # safely be reconstructed after deserialization.
+      self._record_reader.seek(self._record_reader.tell())
+    result = self.__dict__.copy()
+    result.pop("_record_reader", None)
     return result
 
   def next(self):
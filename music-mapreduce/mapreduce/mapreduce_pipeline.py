@@ -34,6 +34,7 @@ from pipeline import common as pipeline_common
 from google.appengine.api import app_identity
 from mapreduce import errors
 from mapreduce import input_readers
+from mapreduce import kv_format
 from mapreduce import mapper_pipeline
 from mapreduce import model
 from mapreduce import output_writers
@@ -69,9 +70,16 @@ class MapPipeline(pipeline_base._OutputSlotsMixin,
     input_reader_spec: input reader specification as string.
     params: mapper and input reader parameters as dict.
     shards: number of shards to start as int.
+    shuffle_format: Optional. kv_format version of the output records.
+    reduce_shards: Optional. Number of reduce shards to partition the output
+      into if sort_map_output is True. Defaults to shards.
+    sort_map_output: Optional. If True, the output is written by
+      shuffler._SortedRunsGCSOutputWriter as sorted runs per reduce shard.
 
   Returns:
-    list of filenames written to by this mapper, one for each shard.
+    list of filenames written to by this mapper, one for each shard. If
+    sort_map_output is True, a list of the list of the runs of each reduce
+    shard instead.
   """
 
   def run(self,
@@ -79,17 +87,29 @@ class MapPipeline(pipeline_base._OutputSlotsMixin,
           mapper_spec,
           input_reader_spec,
           params,
-          shards=None):
+          shards=None,
+          shuffle_format=kv_format.FORMAT_PROTO,
+          reduce_shards=None,
+          sort_map_output=False):
     new_params = dict(params or {})
     # Although we are using all the default settings (and inherited bucket_name)
     # we still need to define an output_writer dict in order to pass validation.
-    new_params.update({"output_writer": {}})
+    new_params.update({"output_writer": {
+        kv_format.FORMAT_PARAM: shuffle_format,
+    }})
+    output_writer_spec = (output_writers.__name__ +
+                          "._GoogleCloudStorageKeyValueOutputWriter")
+    if sort_map_output:
+      output_writer_spec = shuffler.__name__ + "._SortedRunsGCSOutputWriter"
+      new_params["output_writer"].update({
+          "bucket_name": new_params["bucket_name"],
+          "reduce_shards": reduce_shards or shards,
+      })
     yield MapperPipeline(
         job_name + "-map",
         mapper_spec,
         input_reader_spec,
-        output_writer_spec=(output_writers.__name__ +
-                            "._GoogleCloudStorageKeyValueOutputWriter"),
+        output_writer_spec=output_writer_spec,
         params=new_params,
         shards=shards)
 
@@ -116,6 +136,12 @@ class ReducePipeline(pipeline_base._OutputSlotsMixin,
       same as the input key.
     shards: Optional. Number of output shards. Defaults to the number of
       input files.
+    hot_keys: Optional. The hot keys the shuffle salted, see ShufflePipeline.
+      If set, the second half of filenames holds their sub-keys. These are
+      combined and unsalted in a first stage, whose output is shuffled again
+      and reduced by a second stage. Requires combiner_spec.
+    shuffle_format: Optional. kv_format version of the records the first
+      stage of hot keys writes and shuffles.
 
   Returns:
     filenames from output writer.
@@ -131,7 +157,12 @@ class ReducePipeline(pipeline_base._OutputSlotsMixin,
           bucket_name,
           filenames,
           combiner_spec=None,
-          shards=None):
+          shards=None,
+          hot_keys=None,
+          shuffle_format=kv_format.FORMAT_PROTO):
+    if hot_keys:
+      hot_filenames = filenames[len(filenames) // 2:]
+      filenames = filenames[:len(filenames) // 2]
     filenames_only = (
         util.strip_prefix_from_items("/%s/" % bucket_name, filenames))
     new_params = dict(params or {})
@@ -149,13 +180,102 @@ class ReducePipeline(pipeline_base._OutputSlotsMixin,
     if shards is None:
       shards = len(filenames)
 
-    yield mapper_pipeline.MapperPipeline(
+    reduce_pipeline = yield mapper_pipeline.MapperPipeline(
         job_name + "-reduce",
         reducer_spec,
         __name__ + "._ReducerReader",
         output_writer_spec,
         new_params,
         shards=shards)
+    if not hot_keys:
+      return
+
+    # The combiner of the first stage sees the reducer parameters, as it does
+    # in the reduce stage.
+    hot_params = dict(params or {})
+    hot_params.update({
+        "input_reader": {
+            "bucket_name": bucket_name,
+            "objects": util.strip_prefix_from_items(
+                "/%s/" % bucket_name, hot_filenames),
+        },
+        "combiner_spec": combiner_spec,
+        "output_writer": {
+            "bucket_name": bucket_name,
+            kv_format.FORMAT_PARAM: shuffle_format,
+        },
+    })
+    partials = yield mapper_pipeline.MapperPipeline(
+        job_name + "-reduce-hot",
+        __name__ + "._unsalt_reduce",
+        __name__ + "._ReducerReader",
+        output_writers.__name__ + "._GoogleCloudStorageKeyValueOutputWriter",
+        hot_params,
+        shards=len(hot_filenames))
+    merged_partials = yield ShufflePipeline(
+        job_name + "-hot", {"bucket_name": bucket_name}, partials,
+        shuffle_format=shuffle_format)
+    hot_reduce_pipeline = yield ReducePipeline(
+        job_name + "-hot",
+        reducer_spec,
+        output_writer_spec,
+        params,
+        bucket_name,
+        merged_partials,
+        combiner_spec=combiner_spec)
+    with pipeline.After(hot_reduce_pipeline):
+      temp_files = yield pipeline_common.Extend(partials, merged_partials)
+      yield CleanupPipeline(temp_files)
+    yield _CombineReduceOutputs(reduce_pipeline.result_status,
+                                hot_reduce_pipeline.result_status,
+                                reduce_pipeline.counters,
+                                hot_reduce_pipeline.counters,
+                                reduce_pipeline.job_id,
+                                reduce_pipeline,
+                                hot_reduce_pipeline)
+
+
+def _unsalt_reduce(key, values):
+  """Reduce function of the first stage of hot keys.
+
+  Yields the values of a sub-key, already combined by _ReducerReader, under
+  the hot key for the second stage.
+  """
+  key = shuffler._unsalt_key(key)
+  for value in values:
+    yield (key, value)
+
+
+class _CombineReduceOutputs(pipeline_base._OutputSlotsMixin,
+                            pipeline_base.PipelineBase):
+  """Fills the outputs of a ReducePipeline that ran in two stages.
+
+  The result status is the worst of both, counters are added up and the
+  output is the output of both stages. The job id is the first stage's.
+  """
+
+  output_names = mapper_pipeline.MapperPipeline.output_names
+
+  def run(self,
+          result_status,
+          hot_result_status,
+          counters,
+          hot_counters,
+          job_id,
+          outputs,
+          hot_outputs):
+    for status in (model.MapreduceState.RESULT_ABORTED,
+                   model.MapreduceState.RESULT_FAILED):
+      if status in (result_status, hot_result_status):
+        result_status = status
+        break
+    counters = dict(counters or {})
+    for name, value in (hot_counters or {}).iteritems():
+      counters[name] = counters.get(name, 0) + value
+    self.fill(self.outputs.result_status, result_status)
+    self.fill(self.outputs.counters, counters)
+    self.fill(self.outputs.job_id, job_id)
+    return list(outputs or []) + list(hot_outputs or [])
 
 
 class MapreducePipeline(pipeline_base._OutputSlotsMixin,
@@ -181,6 +301,32 @@ class MapreducePipeline(pipeline_base._OutputSlotsMixin,
       combined values that might be processed by another combiner call, but will
       eventually end up in reducer. The combiner output key is assumed to be the
       same as the input key.
+    reduce_shards: Optional. Number of shards to use for the shuffle and reduce
+      phases. Defaults to the number of map output files, i.e. shards. Can't
+      be larger than that.
+    detect_hot_keys: Optional. If True and a combiner is set, the keys that
+      would take a large part of a reduce shard are found from a sample of
+      the map output and spread over all reduce shards as salted sub-keys.
+      Their values are combined per sub-key and then reduced by a second,
+      small reduce stage, so the reducer still sees each key once. The
+      combiner must be associative for this, as it already must be for the
+      combine step. Defaults to False, since sampling is an extra pipeline
+      that only pays off for jobs whose map output is skewed.
+    shuffle_format: Optional. kv_format version of the map output and shuffle
+      records. kv_format.FORMAT_COMPACT is faster to encode and decode than
+      the default kv_format.FORMAT_PROTO.
+    sort_map_output: Optional. If True, the map phase partitions its output by
+      reduce shard and sorts it in memory, writing sorted runs (see
+      shuffler._SortedRunsGCSOutputWriter), and the shuffle only merges them.
+      This saves the shuffle's hash and sort passes over the map output, but
+      hot keys are not detected.
+    hot_key_share: Optional. The fraction of a reduce shard's fair share of
+      the sampled map output that makes a key hot, see
+      shuffler._find_hot_keys. Defaults to
+      shuffler._SampleHotKeysPipeline._HOT_KEY_SHARE, which suits map output
+      with a record per input. Mappers that combine in memory write about a
+      record per key and slice, which flattens the sampled skew, so jobs
+      using them need a much smaller share.
 
   Returns:
     result_status: one of model.MapreduceState._RESULTS. Check this to see
@@ -200,7 +346,12 @@ class MapreducePipeline(pipeline_base._OutputSlotsMixin,
           mapper_params=None,
           reducer_params=None,
           shards=None,
-          combiner_spec=None):
+          combiner_spec=None,
+          reduce_shards=None,
+          detect_hot_keys=False,
+          shuffle_format=kv_format.FORMAT_PROTO,
+          sort_map_output=False,
+          hot_key_share=None):
     # Check that you have a bucket_name set in the mapper_params and set it
     # to the default if not.
     if mapper_params.get("bucket_name") is None:
@@ -220,9 +371,19 @@ class MapreducePipeline(pipeline_base._OutputSlotsMixin,
                                      mapper_spec,
                                      input_reader_spec,
                                      params=mapper_params,
-                                     shards=shards)
+                                     shards=shards,
+                                     shuffle_format=shuffle_format,
+                                     reduce_shards=reduce_shards,
+                                     sort_map_output=sort_map_output)
+    hot_keys = None
+    if combiner_spec and detect_hot_keys and not sort_map_output:
+      hot_keys = yield shuffler._SampleHotKeysPipeline(map_pipeline,
+                                                       shards=reduce_shards,
+                                                       share=hot_key_share)
     shuffler_pipeline = yield ShufflePipeline(
-        job_name, mapper_params, map_pipeline)
+        job_name, mapper_params, map_pipeline, shards=reduce_shards,
+        hot_keys=hot_keys, shuffle_format=shuffle_format,
+        presorted=sort_map_output)
     reducer_pipeline = yield ReducePipeline(
         job_name,
         reducer_spec,
@@ -230,7 +391,9 @@ class MapreducePipeline(pipeline_base._OutputSlotsMixin,
         reducer_params,
         mapper_params["bucket_name"],
         shuffler_pipeline,
-        combiner_spec=combiner_spec)
+        combiner_spec=combiner_spec,
+        hot_keys=hot_keys,
+        shuffle_format=shuffle_format)
     with pipeline.After(reducer_pipeline):
       all_temp_files = yield pipeline_common.Extend(
           map_pipeline, shuffler_pipeline)
@@ -20,10 +20,12 @@ from __future__ import with_statement
 
 
 __all__ = [
+    "GoogleCloudStorageColumnarOutputWriter",
     "GoogleCloudStorageConsistentOutputWriter",
     "GoogleCloudStorageConsistentRecordOutputWriter",
     "GoogleCloudStorageKeyValueOutputWriter",
     "GoogleCloudStorageOutputWriter",
+    "GoogleCloudStoragePartitionedOutputWriter",
     "GoogleCloudStorageRecordOutputWriter",
     "COUNTER_IO_WRITE_BYTES",
     "COUNTER_IO_WRITE_MSEC",
@@ -41,11 +43,13 @@ import pickle
 import random
 import string
 import time
+import urllib
 
+from mapreduce import columnar
 from mapreduce import context
 from mapreduce import errors
 from mapreduce import json_util
-from mapreduce import kv_pb
+from mapreduce import kv_format
 from mapreduce import model
 from mapreduce import operation
 from mapreduce import records
@@ -375,8 +379,7 @@ class _RecordsPoolBase(context.Pool):
     # Write data to in-memory buffer first.
     buf = cStringIO.StringIO()
     with records.RecordsWriter(buf) as w:
-      for record in self._buffer:
-        w.write(record)
+      w.write_many(self._buffer)
       w._pad_block()
     str_buf = buf.getvalue()
     buf.close()
@@ -848,6 +851,250 @@ class _GoogleCloudStorageOutputWriter(_GoogleCloudStorageOutputWriterBase):
 GoogleCloudStorageOutputWriter = _GoogleCloudStorageOutputWriter
 
 
+class _GoogleCloudStoragePartitionedOutputWriter(
+    _GoogleCloudStorageOutputWriterBase):
+  """Routes handler output to one GCS file per partition and shard.
+
+  The handler yields (partition, data) tuples. partition is a string or a
+  tuple of strings and data is written as is to the file of that partition.
+  Files are opened lazily, so a shard only creates files for partitions it
+  actually wrote to. The partition becomes a directory right above the
+  base name produced by NAMING_FORMAT_PARAM, e.g. "$name/$id/Pop+Dance/output-0"
+  for partition ("Pop", "Dance"). Use get_partition() to map an output
+  filename back to its partition.
+
+  Like _GoogleCloudStorageOutputWriter this writer doesn't do slice recovery.
+  """
+
+  _JSON_GCS_BUFFERS = "buffers"
+  _JSON_WRITER_SPEC = "writer_spec"
+  _JSON_FILENAME = "filename"
+
+  # Separates the components of a tuple partition in its directory name.
+  _PARTITION_SEP = "+"
+
+  def __init__(self, writer_spec, filename, streaming_buffers=None):
+    """Initialize a GoogleCloudStoragePartitionedOutputWriter instance.
+
+    Args:
+      writer_spec: the specification for the writer.
+      filename: the shard's base filename, without the bucket.
+      streaming_buffers: dict of partition to writable buffer from
+        cloudstorage_api.
+    """
+    self._writer_spec = writer_spec
+    self._filename = filename
+    self._streaming_buffers = streaming_buffers or {}
+
+  @classmethod
+  def _partition_path(cls, partition):
+    """Encodes a partition as a single GCS path component."""
+    if isinstance(partition, basestring):
+      partition = (partition,)
+    return cls._PARTITION_SEP.join(
+        urllib.quote(str(part), safe="") for part in partition)
+
+  @classmethod
+  def get_partition(cls, filename):
+    """Returns the partition a file produced by this writer belongs to.
+
+    Args:
+      filename: output filename as returned by get_filenames().
+
+    Returns:
+      the partition as a tuple of strings.
+    """
+    path = filename.rsplit("/", 2)[-2]
+    return tuple(urllib.unquote(part)
+                 for part in path.split(cls._PARTITION_SEP))
+
+  @classmethod
+  def create(cls, mr_spec, shard_number, shard_attempt, _writer_state=None):
+    """Inherit docs."""
+    writer_spec = cls.get_params(mr_spec.mapper, allow_old=False)
+    filename = cls._generate_filename(writer_spec, mr_spec.name,
+                                      mr_spec.mapreduce_id, shard_number)
+    return cls(writer_spec, filename)
+
+  @classmethod
+  def from_json(cls, state):
+    return cls(state[cls._JSON_WRITER_SPEC],
+               state[cls._JSON_FILENAME],
+               pickle.loads(state[cls._JSON_GCS_BUFFERS]))
+
+  def to_json(self):
+    return {self._JSON_WRITER_SPEC: self._writer_spec,
+            self._JSON_FILENAME: self._filename,
+            self._JSON_GCS_BUFFERS: pickle.dumps(self._streaming_buffers)}
+
+  def _get_write_buffer(self, partition=None):
+    """Returns the buffer of a partition, opening its file if needed."""
+    if partition not in self._streaming_buffers:
+      if "/" in self._filename:
+        dirname, basename = self._filename.rsplit("/", 1)
+        dirname += "/"
+      else:
+        dirname, basename = "", self._filename
+      suffix = "%s%s/%s" % (dirname, self._partition_path(partition), basename)
+      self._streaming_buffers[partition] = self._open_file(self._writer_spec,
+                                                           suffix)
+    return self._streaming_buffers[partition]
+
+  def write(self, data):
+    """Write data to the file of its partition.
+
+    Args:
+      data: (partition, string) tuple.
+
+    Raises:
+      TypeError: if data is not a (partition, string) tuple or list.
+    """
+    if not isinstance(data, (tuple, list)) or len(data) != 2:
+      raise TypeError("Expected a (partition, string) tuple, got %s: %r" %
+                      (data.__class__.__name__, data))
+    partition, data = data
+    if isinstance(partition, list):
+      partition = tuple(partition)
+    start_time = time.time()
+    self._get_write_buffer(partition).write(data)
+    ctx = context.get()
+    operation.counters.Increment(COUNTER_IO_WRITE_BYTES, len(data))(ctx)
+    operation.counters.Increment(
+        COUNTER_IO_WRITE_MSEC, int((time.time() - start_time) * 1000))(ctx)
+
+  def end_slice(self, slice_ctx):
+    for streaming_buffer in self._streaming_buffers.itervalues():
+      if not streaming_buffer.closed:
+        streaming_buffer.flush()
+
+  def finalize(self, ctx, shard_state):
+    filenames = []
+    for partition in sorted(self._streaming_buffers):
+      streaming_buffer = self._streaming_buffers[partition]
+      streaming_buffer.close()
+      filenames.append(streaming_buffer.name)
+    shard_state.writer_state = {"filenames": filenames}
+
+  @classmethod
+  def get_filenames(cls, mapreduce_state):
+    filenames = []
+    for shard in model.ShardState.find_all_by_mapreduce_state(mapreduce_state):
+      if shard.result_status == model.ShardState.RESULT_SUCCESS:
+        filenames.extend(shard.writer_state["filenames"])
+    return filenames
+
+
+GoogleCloudStoragePartitionedOutputWriter = (
+    _GoogleCloudStoragePartitionedOutputWriter)
+
+
+class _GoogleCloudStorageColumnarOutputWriter(_GoogleCloudStorageOutputWriter):
+  """Writes handler output rows to GCS files in columnar format.
+
+  The handler yields rows as tuples with one value per column, see
+  columnar.ColumnarWriter. Every slice ends the block it is writing, so the
+  rows buffered in memory are never serialized.
+
+  Required configuration in the mapper_spec.output_writer dictionary:
+    columns: list of (name, type) pairs. The first column is the key column,
+      whose smallest and largest value per block are indexed in the footer.
+
+  Optional configuration in the mapper_spec.output_writer dictionary:
+    block_rows: maximum number of rows per block.
+
+  Slice recovery is not supported, since the footer of a file has to index
+  all of its blocks.
+  """
+
+  COLUMNS_PARAM = "columns"
+  BLOCK_ROWS_PARAM = "block_rows"
+
+  _JSON_COLUMNS = "columns"
+  _JSON_BLOCK_ROWS = "block_rows"
+  _JSON_BLOCKS = "blocks"
+
+  def __init__(self, streaming_buffer, writer_spec=None):
+    super(_GoogleCloudStorageColumnarOutputWriter, self).__init__(
+        streaming_buffer, writer_spec=writer_spec)
+    self._columnar = None
+    if writer_spec:
+      self._columnar = columnar.ColumnarWriter(
+          streaming_buffer, writer_spec[self.COLUMNS_PARAM],
+          block_rows=writer_spec.get(self.BLOCK_ROWS_PARAM,
+                                     columnar.DEFAULT_BLOCK_ROWS))
+
+  @classmethod
+  def validate(cls, mapper_spec):
+    """Inherit docs."""
+    writer_spec = cls.get_params(mapper_spec, allow_old=False)
+    if writer_spec.get(cls._NO_DUPLICATE, False):
+      raise errors.BadWriterParamsError(
+          "Columnar output does not support %s." % cls._NO_DUPLICATE)
+    if cls.COLUMNS_PARAM not in writer_spec:
+      raise errors.BadWriterParamsError(
+          "%s is required for columnar output" % cls.COLUMNS_PARAM)
+    try:
+      columnar._check_columns(writer_spec[cls.COLUMNS_PARAM])
+    except (TypeError, ValueError), error:
+      raise errors.BadWriterParamsError("Bad columns, %s" % error)
+    block_rows = writer_spec.get(cls.BLOCK_ROWS_PARAM,
+                                 columnar.DEFAULT_BLOCK_ROWS)
+    if not isinstance(block_rows, (int, long)) or block_rows <= 0:
+      raise errors.BadWriterParamsError(
+          "%s must be a positive integer" % cls.BLOCK_ROWS_PARAM)
+    super(_GoogleCloudStorageColumnarOutputWriter, cls).validate(mapper_spec)
+
+  @classmethod
+  def from_json(cls, state):
+    writer = super(_GoogleCloudStorageColumnarOutputWriter, cls).from_json(
+        state)
+    writer._columnar = columnar.ColumnarWriter(
+        writer._streaming_buffer, state[cls._JSON_COLUMNS],
+        block_rows=state[cls._JSON_BLOCK_ROWS],
+        blocks=pickle.loads(state[cls._JSON_BLOCKS]))
+    return writer
+
+  def to_json(self):
+    result = super(_GoogleCloudStorageColumnarOutputWriter, self).to_json()
+    result.update({self._JSON_COLUMNS: self._columnar.columns,
+                   self._JSON_BLOCK_ROWS: self._columnar.block_rows,
+                   self._JSON_BLOCKS: pickle.dumps(self._columnar.blocks)})
+    return result
+
+  def write(self, data):
+    """Write a row to the GoogleCloudStorage file.
+
+    Args:
+      data: a tuple with one value per column.
+    """
+    start_time = time.time()
+    start = self._streaming_buffer.tell()
+    self._columnar.write(data)
+    ctx = context.get()
+    operation.counters.Increment(
+        COUNTER_IO_WRITE_BYTES, self._streaming_buffer.tell() - start)(ctx)
+    operation.counters.Increment(
+        COUNTER_IO_WRITE_MSEC, int((time.time() - start_time) * 1000))(ctx)
+
+  def end_slice(self, slice_ctx):
+    # Nothing to flush if this is the end_slice call after finalization.
+    if not self._streaming_buffer.closed:
+      self._columnar.flush()
+    super(_GoogleCloudStorageColumnarOutputWriter, self).end_slice(slice_ctx)
+
+  def finalize(self, ctx, shard_state):
+    self._columnar.close()
+    super(_GoogleCloudStorageColumnarOutputWriter, self).finalize(
+        ctx, shard_state)
+
+  def _supports_slice_recovery(self, mapper_spec):
+    return False
+
+
+GoogleCloudStorageColumnarOutputWriter = (
+    _GoogleCloudStorageColumnarOutputWriter)
+
+
 class _ConsistentStatus(object):
   """Object used to pass status to the next slice."""
 
@@ -1139,7 +1386,45 @@ class GoogleCloudStorageConsistentRecordOutputWriter(
 # TODO(user): Write a test for this.
 class _GoogleCloudStorageKeyValueOutputWriter(
     _GoogleCloudStorageRecordOutputWriter):
-  """Write key/values to Google Cloud Storage files in LevelDB format."""
+  """Write key/values to Google Cloud Storage files in LevelDB format.
+
+  Optional configuration in the mapper_spec.output_writer dictionary:
+    shuffle_format: kv_format version of the records, FORMAT_PROTO by default.
+  """
+
+  SHUFFLE_FORMAT_PARAM = kv_format.FORMAT_PARAM
+
+  def __init__(self, writer, shuffle_format=kv_format.FORMAT_PROTO):
+    super(_GoogleCloudStorageKeyValueOutputWriter, self).__init__(writer)
+    self._shuffle_format = shuffle_format
+
+  @classmethod
+  def validate(cls, mapper_spec):
+    """Inherit docs."""
+    writer_spec = cls.WRITER_CLS.get_params(mapper_spec, allow_old=False)
+    if (writer_spec.get(cls.SHUFFLE_FORMAT_PARAM, kv_format.FORMAT_PROTO) not in
+        kv_format.FORMATS):
+      raise errors.BadWriterParamsError(
+          "Unknown %s" % cls.SHUFFLE_FORMAT_PARAM)
+    super(_GoogleCloudStorageKeyValueOutputWriter, cls).validate(mapper_spec)
+
+  @classmethod
+  def from_json(cls, state):
+    return cls(cls.WRITER_CLS.from_json(state),
+               state.get(cls.SHUFFLE_FORMAT_PARAM, kv_format.FORMAT_PROTO))
+
+  def to_json(self):
+    result = super(_GoogleCloudStorageKeyValueOutputWriter, self).to_json()
+    result[self.SHUFFLE_FORMAT_PARAM] = self._shuffle_format
+    return result
+
+  @classmethod
+  def create(cls, mr_spec, shard_number, shard_attempt, _writer_state=None):
+    writer_spec = cls.WRITER_CLS.get_params(mr_spec.mapper, allow_old=False)
+    return cls(cls.WRITER_CLS.create(mr_spec, shard_number, shard_attempt,
+                                     _writer_state),
+               writer_spec.get(cls.SHUFFLE_FORMAT_PARAM,
+                               kv_format.FORMAT_PROTO))
 
   def write(self, data):
     if len(data) != 2:
@@ -1153,10 +1438,8 @@ class _GoogleCloudStorageKeyValueOutputWriter(
       logging.error("Expecting a tuple, but got %s: %s",
                     data.__class__.__name__, data)
 
-    proto = kv_pb.KeyValue()
-    proto.set_key(key)
-    proto.set_value(value)
-    GoogleCloudStorageRecordOutputWriter.write(self, proto.Encode())
+    GoogleCloudStorageRecordOutputWriter.write(
+        self, kv_format.encode_key_value(key, value, self._shuffle_format))
 
 
 GoogleCloudStorageKeyValueOutputWriter = _GoogleCloudStorageKeyValueOutputWriter
@@ -82,6 +82,7 @@ __all__ = ['RecordsWriter',
            'RecordsReader']
 
 import logging
+import os
 import struct
 
 # Note: this will be scrubbed to google.appengine.api.files import crc32c
@@ -101,6 +102,11 @@ _HEADER_FORMAT = '<IHB'
 # Header length in bytes.
 _HEADER_LENGTH = struct.calcsize(_HEADER_FORMAT)
 
+_HEADER_STRUCT = struct.Struct(_HEADER_FORMAT)
+
+# Maximum trailer of a block.
+_PADDING = '\x00' * _HEADER_LENGTH
+
 # Not a record but padding bytes.
 _RECORD_TYPE_NONE = 0
 
@@ -117,6 +123,12 @@ _RECORD_TYPE_MIDDLE = 3
 _RECORD_TYPE_LAST = 4
 
 
+# CRC of the record type, the first byte checksummed in every record. Every
+# byte value is included so that readers can checksum corrupted types too.
+_RECORD_TYPE_CRCS = tuple(crc32c.crc_update(crc32c.CRC_INIT, [record_type])
+                          for record_type in range(256))
+
+
 # CRC Mask. Comes from http://leveldb.googlecode.com/svn/trunk/util/crc32c.h
 _CRC_MASK_DELTA = 0xa282ead8
 
@@ -161,8 +173,7 @@ class RecordsWriter(object):
     """Write single physical record."""
     length = len(data)
 
-    crc = crc32c.crc_update(crc32c.CRC_INIT, [record_type])
-    crc = crc32c.crc_update(crc, data)
+    crc = crc32c.crc_update(_RECORD_TYPE_CRCS[record_type], data)
     crc = crc32c.crc_finalize(crc)
 
     self.__writer.write(
@@ -201,6 +212,66 @@ class RecordsWriter(object):
     else:
       self.__write_record(_RECORD_TYPE_FULL, data)
 
+  def write_many(self, records):
+    """Write records.
+
+    Writes the same bytes as calling write() for each record, but assembles
+    them in memory and writes them a block at a time.
+
+    Args:
+      records: iterable of records, each a string.
+    """
+    chunks = []
+    append = chunks.append
+    pack = _HEADER_STRUCT.pack
+    crc_update = crc32c.crc_update
+    type_crcs = _RECORD_TYPE_CRCS
+    position = self.__position
+    # Position of the first byte of chunks.
+    start = position
+
+    for data in records:
+      block_remaining = _BLOCK_SIZE - position % _BLOCK_SIZE
+      if block_remaining < _HEADER_LENGTH:
+        # Header won't fit into remainder
+        append(_PADDING[:block_remaining])
+        position += block_remaining
+        block_remaining = _BLOCK_SIZE
+
+      length = len(data)
+      if block_remaining >= length + _HEADER_LENGTH:
+        append(pack(_mask_crc(crc_update(type_crcs[_RECORD_TYPE_FULL], data)),
+                    length, _RECORD_TYPE_FULL))
+        append(data)
+        position += _HEADER_LENGTH + length
+      else:
+        record_type = _RECORD_TYPE_FIRST
+        offset = 0
+        while True:
+          size = block_remaining - _HEADER_LENGTH
+          if record_type != _RECORD_TYPE_FIRST and length - offset <= size:
+            record_type = _RECORD_TYPE_LAST
+            size = length - offset
+          chunk = data[offset:offset + size]
+          append(pack(_mask_crc(crc_update(type_crcs[record_type], chunk)),
+                      size, record_type))
+          append(chunk)
+          position += _HEADER_LENGTH + size
+          offset += size
+          if record_type == _RECORD_TYPE_LAST:
+            break
+          record_type = _RECORD_TYPE_MIDDLE
+          block_remaining = _BLOCK_SIZE
+
+      if position - start >= _BLOCK_SIZE:
+        self.__writer.write(''.join(chunks))
+        del chunks[:]
+        start = position
+
+    if chunks:
+      self.__writer.write(''.join(chunks))
+    self.__position = position
+
   def __enter__(self):
     return self
 
@@ -225,7 +296,14 @@ class RecordsWriter(object):
 
 
 class RecordsReader(object):
-  """A reader for records format."""
+  """A reader for records format.
+
+  The reader reads its input a block at a time and parses the records of a
+  block from memory, so reading a record costs no call to the underlying
+  reader. tell() and seek() still work with positions of records in the file:
+  a position returned by tell() can be passed to seek() on a new reader of the
+  same file to resume reading from the same record.
+  """
 
   def __init__(self, reader):
     """Init.
@@ -235,6 +313,28 @@ class RecordsReader(object):
         implements 'read', 'seek', and 'tell'.
     """
     self.__reader = reader
+    # The data read from the current block, from the file position
+    # __block_offset to the end of the block (or of the file), and the
+    # position of the next record in it.
+    self.__block = ''
+    self.__block_offset = None
+    self.__block_length = 0
+    self.__position = 0
+
+  def __fill(self):
+    """Reads the rest of the block at the current position if none is left.
+
+    Returns:
+      The number of bytes of the current block left to parse.
+    """
+    remaining = len(self.__block) - self.__position
+    if not remaining:
+      self.__block_offset = self.__reader.tell()
+      self.__block_length = _BLOCK_SIZE - self.__block_offset % _BLOCK_SIZE
+      self.__block = self.__reader.read(self.__block_length)
+      self.__position = 0
+      remaining = len(self.__block)
+    return remaining
 
   def __try_read_record(self):
     """Try reading a record.
@@ -245,23 +345,28 @@ class RecordsReader(object):
       EOFError: when end of file was reached.
       InvalidRecordError: when valid record could not be read.
     """
-    block_remaining = _BLOCK_SIZE - self.__reader.tell() % _BLOCK_SIZE
+    available = self.__fill()
+    position = self.__position
+    block_remaining = self.__block_length - position
     if block_remaining < _HEADER_LENGTH:
       return ('', _RECORD_TYPE_NONE)
 
-    header = self.__reader.read(_HEADER_LENGTH)
-    if len(header) != _HEADER_LENGTH:
+    if available < _HEADER_LENGTH:
+      self.__position += available
       raise EOFError('Read %s bytes instead of %s' %
-                     (len(header), _HEADER_LENGTH))
+                     (available, _HEADER_LENGTH))
 
-    (masked_crc, length, record_type) = struct.unpack(_HEADER_FORMAT, header)
-    crc = _unmask_crc(masked_crc)
+    (masked_crc, length, record_type) = _HEADER_STRUCT.unpack_from(
+        self.__block, position)
+    position += _HEADER_LENGTH
+    self.__position = position
 
     if length + _HEADER_LENGTH > block_remaining:
       # A record can't be bigger than one block.
       raise errors.InvalidRecordError('Length is too big')
 
-    data = self.__reader.read(length)
+    data = self.__block[position:position + length]
+    self.__position = position + len(data)
     if len(data) != length:
       raise EOFError('Not enough data read. Expected: %s but got %s' %
                      (length, len(data)))
@@ -269,22 +374,22 @@ class RecordsReader(object):
     if record_type == _RECORD_TYPE_NONE:
       return ('', record_type)
 
-    actual_crc = crc32c.crc_update(crc32c.CRC_INIT, [record_type])
-    actual_crc = crc32c.crc_update(actual_crc, data)
+    actual_crc = crc32c.crc_update(_RECORD_TYPE_CRCS[record_type], data)
     actual_crc = crc32c.crc_finalize(actual_crc)
 
-    if actual_crc != crc:
+    if actual_crc != _unmask_crc(masked_crc):
       raise errors.InvalidRecordError('Data crc does not match')
     return (data, record_type)
 
   def __sync(self):
     """Skip reader to the block boundary."""
-    pad_length = _BLOCK_SIZE - self.__reader.tell() % _BLOCK_SIZE
+    pad_length = _BLOCK_SIZE - self.tell() % _BLOCK_SIZE
     if pad_length and pad_length != _BLOCK_SIZE:
-      data = self.__reader.read(pad_length)
-      if len(data) != pad_length:
+      available = self.__fill()
+      self.__position += min(pad_length, available)
+      if available < pad_length:
         raise EOFError('Read %d bytes instead of %d' %
-                       (len(data), pad_length))
+                       (available, pad_length))
 
   def read(self):
     """Reads record from current position in reader.
@@ -346,11 +451,20 @@ class RecordsReader(object):
 
   def tell(self):
     """Return file's current position."""
-    return self.__reader.tell()
+    if self.__block_offset is None:
+      return self.__reader.tell()
+    return self.__block_offset + self.__position
 
-  def seek(self, *args, **kwargs):
+  def seek(self, offset, whence=os.SEEK_SET):
     """Set the file's current position.
 
-    Arguments are passed directly to the underlying reader.
+    Arguments are passed to the underlying reader, with offsets relative to
+    the current position made relative to tell(). The rest of the current
+    block is dropped.
     """
-    return self.__reader.seek(*args, **kwargs)
+    if whence == os.SEEK_CUR:
+      (offset, whence) = (self.tell() + offset, os.SEEK_SET)
+    self.__block = ''
+    self.__block_offset = None
+    self.__position = 0
+    return self.__reader.seek(offset, whence)
@@ -29,6 +29,7 @@ __all__ = [
 
 import gc
 import heapq
+import itertools
 import logging
 import pickle
 import time
@@ -39,7 +40,7 @@ from google.appengine.ext import db
 from mapreduce import context
 from mapreduce import errors
 from mapreduce import input_readers
-from mapreduce import kv_pb
+from mapreduce import kv_format
 from mapreduce import mapper_pipeline
 from mapreduce import model
 from mapreduce import operation
@@ -63,6 +64,44 @@ except ImportError:
 # pylint: disable=protected-access
 
 
+# Separates a hot key from the salt of its sub-keys.
+_SALT_SEP = "\x00"
+
+
+def _salt_key(key, salt):
+  """Returns sub-key number salt of a hot key."""
+  return "%s%s%d" % (key, _SALT_SEP, salt)
+
+
+def _unsalt_key(sub_key):
+  """Returns the hot key of a sub-key made by _salt_key."""
+  return sub_key.rsplit(_SALT_SEP, 1)[0]
+
+
+def _find_hot_keys(key_sizes, shards, share, max_keys):
+  """Returns the hot keys of a sample of map output.
+
+  A key is hot if its share of the sampled bytes is at least share / shards,
+  i.e. if it alone would take that fraction of a reduce shard's fair share.
+
+  Args:
+    key_sizes: dict of key to the number of sampled bytes with that key.
+    shards: number of reduce shards.
+    share: fraction of a reduce shard's fair share that makes a key hot.
+    max_keys: maximum number of hot keys to return.
+
+  Returns:
+    The hot keys, hottest first.
+  """
+  total = sum(key_sizes.itervalues())
+  if shards < 2 or not total:
+    return []
+  threshold = total * share / shards
+  hot_keys = heapq.nlargest(max_keys, key_sizes.iteritems(),
+                            key=lambda key_size: key_size[1])
+  return [key for (key, size) in hot_keys if size >= threshold]
+
+
 class _OutputFile(db.Model):
   """Entity to store output filenames of pipelines.
 
@@ -124,12 +163,13 @@ class _BatchGCSRecordsReader(
 def _sort_records_map(records):
   """Map function sorting records.
 
-  Converts records to KeyValue protos, sorts them by key and writes them
-  into new GCS file. Creates _OutputFile entity to record resulting
+  Decodes the keys of KeyValue records, sorts the records by key and writes
+  them into new GCS file. Creates _OutputFile entity to record resulting
   file name.
 
   Args:
-    records: list of records which are serialized KeyValue protos.
+    records: list of records which are serialized KeyValue records, see
+      kv_format.
   """
   ctx = context.get()
   l = len(records)
@@ -137,9 +177,7 @@ def _sort_records_map(records):
 
   logging.debug("Parsing")
   for i in range(l):
-    proto = kv_pb.KeyValue()
-    proto.ParseFromString(records[i])
-    key_records[i] = (proto.key(), records[i])
+    key_records[i] = (kv_format.decode_key(records[i]), records[i])
 
   logging.debug("Sorting")
   key_records.sort(cmp=_compare_keys)
@@ -357,11 +395,9 @@ class _MergingReader(input_readers.InputReader):
           operation.counters.Increment(
               input_readers.COUNTER_IO_READ_MSEC,
               int((time.time() - start_time) * 1000))(context.get())
-        proto = kv_pb.KeyValue()
-        proto.ParseFromString(binary_record)
+        (key, value) = kv_format.decode_key_value(binary_record)
         # Put read data back into heap.
-        heapq.heapreplace(readers,
-                          (proto.key(), proto.value(), index, reader))
+        heapq.heapreplace(readers, (key, value, index, reader))
       except EOFError:
         heapq.heappop(readers)
 
@@ -410,20 +446,38 @@ class _HashingGCSOutputWriter(output_writers.OutputWriter):
   shard. The same key will be hashed to the same logical file across all of
   the shards. Then the list of all the same logical files will be assembled
   and a list of those lists will be returned.
+
+  If hot keys are given, each shard also writes shard_count hot buckets, after
+  the regular ones. The records of a hot key are spread round-robin over the
+  hot buckets under salted sub-keys (see _salt_key), so that no single reduce
+  shard gets all of them.
+
+  Records are encoded in the kv_format version of the shuffle_format
+  parameter, FORMAT_PROTO by default.
   """
 
   # Supported parameters
   BUCKET_NAME_PARAM = "bucket_name"
+  HOT_KEYS_PARAM = "hot_keys"
+  SHUFFLE_FORMAT_PARAM = kv_format.FORMAT_PARAM
 
   # pylint: disable=super-init-not-called
-  def __init__(self, filehandles):
+  def __init__(self, filehandles, hot_keys=None, salt=0,
+               shuffle_format=kv_format.FORMAT_PROTO):
     """Constructor.
 
     Args:
-      filehandles: list of file handles that this writer outputs to.
+      filehandles: list of file handles that this writer outputs to. If there
+        are hot keys, the second half of the list are the hot buckets.
+      hot_keys: optional list of hot keys.
+      salt: salt of the next record of a hot key.
+      shuffle_format: kv_format version of the records.
     """
     self._filehandles = filehandles
     self._pools = [None] * len(filehandles)
+    self._hot_keys = frozenset(hot_keys or ())
+    self._salt = salt
+    self._shuffle_format = shuffle_format
 
   @classmethod
   def validate(cls, mapper_spec):
@@ -442,6 +496,10 @@ class _HashingGCSOutputWriter(output_writers.OutputWriter):
       raise errors.BadWriterParamsError(
           "%s is required for the _HashingGCSOutputWriter" %
           cls.BUCKET_NAME_PARAM)
+    if (params.get(cls.SHUFFLE_FORMAT_PARAM, kv_format.FORMAT_PROTO) not in
+        kv_format.FORMATS):
+      raise errors.BadWriterParamsError(
+          "Unknown %s" % cls.SHUFFLE_FORMAT_PARAM)
 
   @classmethod
   def from_json(cls, json):
@@ -453,7 +511,10 @@ class _HashingGCSOutputWriter(output_writers.OutputWriter):
     Returns:
       An instance of the OutputWriter configured using the values of json.
     """
-    return cls(pickle.loads(json["filehandles"]))
+    return cls(pickle.loads(json["filehandles"]),
+               json.get("hot_keys"),
+               json.get("salt", 0),
+               json.get("shuffle_format", kv_format.FORMAT_PROTO))
 
   def to_json(self):
     """Returns writer state to serialize in json.
@@ -467,7 +528,10 @@ class _HashingGCSOutputWriter(output_writers.OutputWriter):
     for pool in self._pools:
       if pool is not None:
         pool.flush(True)
-    return {"filehandles": pickle.dumps(self._filehandles)}
+    return {"filehandles": pickle.dumps(self._filehandles),
+            "hot_keys": sorted(self._hot_keys),
+            "salt": self._salt,
+            "shuffle_format": self._shuffle_format}
 
   @classmethod
   def create(cls, mr_spec, shard_number, shard_attempt, _writer_state=None):
@@ -475,6 +539,9 @@ class _HashingGCSOutputWriter(output_writers.OutputWriter):
     mapper_spec = mr_spec.mapper
     params = output_writers._get_params(mapper_spec)
     bucket_name = params.get(cls.BUCKET_NAME_PARAM)
+    hot_keys = params.get(cls.HOT_KEYS_PARAM)
+    shuffle_format = params.get(cls.SHUFFLE_FORMAT_PARAM,
+                                kv_format.FORMAT_PROTO)
     shards = mapper_spec.shard_count
 
     filehandles = []
@@ -483,19 +550,26 @@ class _HashingGCSOutputWriter(output_writers.OutputWriter):
     for i in range(shards):
       full_filename = "/%s/%s%d" % (bucket_name, filename, i)
       filehandles.append(cloudstorage.open(full_filename, mode="w"))
-    return cls(filehandles)
+    if hot_keys:
+      for i in range(shards):
+        full_filename = "/%s/%shot-%d" % (bucket_name, filename, i)
+        filehandles.append(cloudstorage.open(full_filename, mode="w"))
+    # Start each shard at a different hot bucket.
+    return cls(filehandles, hot_keys, shard_number, shuffle_format)
 
   @classmethod
   def get_filenames(cls, mapreduce_state):
     """See parent class."""
     shards = mapreduce_state.mapreduce_spec.mapper.shard_count
+    params = output_writers._get_params(mapreduce_state.mapreduce_spec.mapper)
+    buckets = shards * (2 if params.get(cls.HOT_KEYS_PARAM) else 1)
     filenames = []
-    for _ in range(shards):
+    for _ in range(buckets):
       filenames.append([None] * shards)
     shard_states = model.ShardState.find_all_by_mapreduce_state(mapreduce_state)
     for x, shard_state in enumerate(shard_states):
       shard_filenames = shard_state.writer_state["shard_filenames"]
-      for y in range(shards):
+      for y in range(buckets):
         filenames[y][x] = shard_filenames[y]
     return filenames
 
@@ -525,7 +599,15 @@ class _HashingGCSOutputWriter(output_writers.OutputWriter):
       logging.error("Expecting a tuple, but got %s: %s",
                     data.__class__.__name__, data)
 
-    file_index = key.__hash__() % len(self._filehandles)
+    if key in self._hot_keys:
+      shards = len(self._filehandles) // 2
+      salt = self._salt
+      self._salt = (salt + 1) % shards
+      file_index = shards + (key.__hash__() + salt) % shards
+      key = _salt_key(key, salt)
+    else:
+      shards = len(self._filehandles) // (2 if self._hot_keys else 1)
+      file_index = key.__hash__() % shards
 
     # Work-around: Since we don't have access to the context in the to_json()
     # function, but we need to flush each pool before we serialize the
@@ -537,10 +619,180 @@ class _HashingGCSOutputWriter(output_writers.OutputWriter):
       pool = output_writers.GCSRecordsPool(filehandle=filehandle, ctx=ctx)
       self._pools[file_index] = pool
 
-    proto = kv_pb.KeyValue()
-    proto.set_key(key)
-    proto.set_value(value)
-    pool.append(proto.Encode())
+    pool.append(kv_format.encode_key_value(key, value, self._shuffle_format))
+
+
+class _SortedRunsGCSOutputWriter(output_writers.OutputWriter):
+  """An OutputWriter which writes map output as sorted runs per reduce shard.
+
+  Records are hashed by key into reduce_shards buckets, like with
+  _HashingGCSOutputWriter, but buffered in memory. Each bucket's buffer is
+  sorted by key and written to a new GCS file, a run, when the buffers grow
+  larger than _MAX_RUN_SIZE and before the writer's state is serialized at the
+  end of every slice. The runs of a reduce shard can then be merged by
+  _MergePipeline directly, without the hash and sort passes of
+  ShufflePipeline.
+
+  Runs are named after their shard, bucket and sequence number, so that a
+  retried slice overwrites the runs of its failed attempt. Hot keys are not
+  salted.
+
+  Records are encoded in the kv_format version of the shuffle_format
+  parameter, FORMAT_PROTO by default.
+  """
+
+  # Supported parameters
+  BUCKET_NAME_PARAM = "bucket_name"
+  REDUCE_SHARDS_PARAM = "reduce_shards"
+  SHUFFLE_FORMAT_PARAM = kv_format.FORMAT_PARAM
+
+  # Size of buffered records above which they are written as runs.
+  _MAX_RUN_SIZE = 8 * 1024 * 1024
+
+  # pylint: disable=super-init-not-called
+  def __init__(self, filename_prefix, runs,
+               shuffle_format=kv_format.FORMAT_PROTO):
+    """Constructor.
+
+    Args:
+      filename_prefix: prefix of the names of the runs, with the bucket.
+      runs: list with the list of names of the runs written so far for each
+        reduce shard.
+      shuffle_format: kv_format version of the records.
+    """
+    self._filename_prefix = filename_prefix
+    self._runs = runs
+    self._shuffle_format = shuffle_format
+    self._buffers = [[] for _ in runs]
+    self._size = 0
+
+  @classmethod
+  def validate(cls, mapper_spec):
+    """Validates mapper specification.
+
+    Args:
+      mapper_spec: an instance of model.MapperSpec to validate.
+    Raises:
+      BadWriterParamsError: when Output writer class mismatch.
+    """
+    if mapper_spec.output_writer_class() != cls:
+      raise errors.BadWriterParamsError("Output writer class mismatch")
+    params = output_writers._get_params(mapper_spec)
+    # Bucket Name is required
+    if cls.BUCKET_NAME_PARAM not in params:
+      raise errors.BadWriterParamsError(
+          "%s is required for the _SortedRunsGCSOutputWriter" %
+          cls.BUCKET_NAME_PARAM)
+    reduce_shards = params.get(cls.REDUCE_SHARDS_PARAM,
+                               mapper_spec.shard_count)
+    if not isinstance(reduce_shards, (int, long)) or reduce_shards <= 0:
+      raise errors.BadWriterParamsError(
+          "%s must be a positive integer" % cls.REDUCE_SHARDS_PARAM)
+    if (params.get(cls.SHUFFLE_FORMAT_PARAM, kv_format.FORMAT_PROTO) not in
+        kv_format.FORMATS):
+      raise errors.BadWriterParamsError(
+          "Unknown %s" % cls.SHUFFLE_FORMAT_PARAM)
+
+  @classmethod
+  def from_json(cls, json):
+    """Creates an instance of the OutputWriter for the given json state.
+
+    Args:
+      json: The OutputWriter state as a dict-like object.
+
+    Returns:
+      An instance of the OutputWriter configured using the values of json.
+    """
+    return cls(json["filename_prefix"],
+               json["runs"],
+               json.get("shuffle_format", kv_format.FORMAT_PROTO))
+
+  def to_json(self):
+    """Returns writer state to serialize in json.
+
+    Returns:
+      A json-izable version of the OutputWriter state.
+    """
+    # As in _HashingGCSOutputWriter, write the buffered records here since
+    # there is no context to flush them at the end of a slice.
+    self._write_runs(context.get())
+    return {"filename_prefix": self._filename_prefix,
+            "runs": self._runs,
+            "shuffle_format": self._shuffle_format}
+
+  @classmethod
+  def create(cls, mr_spec, shard_number, shard_attempt, _writer_state=None):
+    """Inherit docs."""
+    mapper_spec = mr_spec.mapper
+    params = output_writers._get_params(mapper_spec)
+    bucket_name = params.get(cls.BUCKET_NAME_PARAM)
+    reduce_shards = params.get(cls.REDUCE_SHARDS_PARAM,
+                               mapper_spec.shard_count)
+    shuffle_format = params.get(cls.SHUFFLE_FORMAT_PARAM,
+                                kv_format.FORMAT_PROTO)
+    filename_prefix = "/%s/%s/%s/shard-%d-" % (
+        bucket_name, mr_spec.name, mr_spec.mapreduce_id, shard_number)
+    return cls(filename_prefix, [[] for _ in range(reduce_shards)],
+               shuffle_format)
+
+  @classmethod
+  def get_filenames(cls, mapreduce_state):
+    """Returns the list of the runs of each reduce shard, of all shards."""
+    filenames = None
+    shard_states = model.ShardState.find_all_by_mapreduce_state(mapreduce_state)
+    for shard_state in shard_states:
+      shard_runs = shard_state.writer_state["runs"]
+      if filenames is None:
+        filenames = [[] for _ in shard_runs]
+      for bucket, runs in enumerate(shard_runs):
+        filenames[bucket].extend(runs)
+    return filenames or []
+
+  def finalize(self, ctx, shard_state):
+    """See parent class."""
+    self._write_runs(ctx)
+    shard_state.writer_state = {"runs": self._runs}
+
+  def _write_runs(self, ctx):
+    """Writes the buffer of each bucket sorted by key as a new run."""
+    for bucket, key_records in enumerate(self._buffers):
+      if not key_records:
+        continue
+      key_records.sort(key=lambda key_record: key_record[0])
+      runs = self._runs[bucket]
+      filename = "%sbucket-%d-run-%d" % (self._filename_prefix, bucket,
+                                         len(runs))
+      filehandle = cloudstorage.open(filename, mode="w")
+      with output_writers.GCSRecordsPool(filehandle, ctx=ctx) as pool:
+        for (_, record) in key_records:
+          pool.append(record)
+      filehandle.close()
+      runs.append(filename)
+    self._buffers = [[] for _ in self._runs]
+    self._size = 0
+
+  def write(self, data):
+    """Write data.
+
+    Args:
+      data: actual data yielded from handler. Type is writer-specific.
+    """
+    if len(data) != 2:
+      logging.error("Got bad tuple of length %d (2-tuple expected): %s",
+                    len(data), data)
+
+    try:
+      key = str(data[0])
+      value = str(data[1])
+    except TypeError:
+      logging.error("Expecting a tuple, but got %s: %s",
+                    data.__class__.__name__, data)
+
+    record = kv_format.encode_key_value(key, value, self._shuffle_format)
+    self._buffers[key.__hash__() % len(self._buffers)].append((key, record))
+    self._size += len(record)
+    if self._size > self._MAX_RUN_SIZE:
+      self._write_runs(context.get())
 
 
 class _ShardOutputs(pipeline_base.PipelineBase):
@@ -561,7 +813,8 @@ class _ShardOutputs(pipeline_base.PipelineBase):
 def _merge_map(key, values, partial):
   """A map function used in merge phase.
 
-  Stores (key, values) into KeyValues proto and yields its serialization.
+  Stores (key, values) into a KeyValues record and yields its serialization,
+  in the kv_format version of the shuffle_format mapper parameter.
 
   Args:
     key: values key.
@@ -569,12 +822,14 @@ def _merge_map(key, values, partial):
     partial: True if more values for this key will follow. False otherwise.
 
   Yields:
-    The proto.
+    The record.
   """
-  proto = kv_pb.KeyValues()
-  proto.set_key(key)
-  proto.value_list().extend(values)
-  yield proto.Encode()
+  shuffle_format = kv_format.FORMAT_PROTO
+  ctx = context.get()
+  if ctx:
+    shuffle_format = ctx.mapreduce_spec.mapper.params.get(
+        kv_format.FORMAT_PARAM, shuffle_format)
+  yield kv_format.encode_key_values(key, values, shuffle_format)
 
 
 class _MergePipeline(pipeline_base.PipelineBase):
@@ -597,7 +852,8 @@ class _MergePipeline(pipeline_base.PipelineBase):
   # Maximum size of values to produce in a single KeyValues proto.
   _MAX_VALUES_SIZE = 1000000
 
-  def run(self, job_name, bucket_name, filenames):
+  def run(self, job_name, bucket_name, filenames,
+          shuffle_format=kv_format.FORMAT_PROTO):
     yield mapper_pipeline.MapperPipeline(
         job_name + "-shuffle-merge",
         __name__ + "._merge_map",
@@ -608,6 +864,7 @@ class _MergePipeline(pipeline_base.PipelineBase):
             _MergingReader.FILES_PARAM: filenames,
             _MergingReader.MAX_VALUES_COUNT_PARAM: self._MAX_VALUES_COUNT,
             _MergingReader.MAX_VALUES_SIZE_PARAM: self._MAX_VALUES_SIZE,
+            kv_format.FORMAT_PARAM: shuffle_format,
             "output_writer": {
                 "bucket_name": bucket_name,
             },
@@ -626,9 +883,7 @@ def _hashing_map(binary_record):
   Yields:
     The (key, value).
   """
-  proto = kv_pb.KeyValue()
-  proto.ParseFromString(binary_record)
-  yield (proto.key(), proto.value())
+  yield kv_format.decode_key_value(binary_record)
 
 
 class _HashPipeline(pipeline_base.PipelineBase):
@@ -641,6 +896,8 @@ class _HashPipeline(pipeline_base.PipelineBase):
       with serialized KeyValue proto.
     shards: Optional. Number of output shards to generate. Defaults
       to the number of input files.
+    hot_keys: Optional. Keys to salt, see _HashingGCSOutputWriter.
+    shuffle_format: Optional. kv_format version of the output records.
 
   Yields:
     The list of filenames. Each file is of records formad with serialized
@@ -648,7 +905,8 @@ class _HashPipeline(pipeline_base.PipelineBase):
     hash. Thus all equal keys would end up in the same file.
   """
 
-  def run(self, job_name, bucket_name, filenames, shards=None):
+  def run(self, job_name, bucket_name, filenames, shards=None, hot_keys=None,
+          shuffle_format=kv_format.FORMAT_PROTO):
     filenames_only = (
         util.strip_prefix_from_items("/%s/" % bucket_name, filenames))
     if shards is None:
@@ -665,11 +923,57 @@ class _HashPipeline(pipeline_base.PipelineBase):
             },
             "output_writer": {
                 "bucket_name": bucket_name,
+                "hot_keys": hot_keys or [],
+                "shuffle_format": shuffle_format,
             },
         },
         shards=shards)
 
 
+class _SampleHotKeysPipeline(pipeline_base.PipelineBase):
+  """A pipeline to find the hot keys of map output from a sample of it.
+
+  Reads the first records of each map output file and counts the bytes of
+  each key, see _find_hot_keys.
+
+  Args:
+    filenames: filenames of mapper output, with their bucket. Should be of
+      records format with serialized KeyValue proto.
+    shards: Optional. Number of reduce shards. Defaults to the number of
+      input files.
+    share: Optional. Fraction of a reduce shard's fair share of the sampled
+      bytes that makes a key hot. Defaults to _HOT_KEY_SHARE.
+
+  Returns:
+    The list of hot keys, hottest first.
+  """
+
+  # Maximum number of records to sample from each file.
+  _SAMPLE_RECORDS = 1000
+  # Fraction of a reduce shard's fair share of the sampled bytes that makes a
+  # key hot.
+  _HOT_KEY_SHARE = 0.5
+  # Maximum number of hot keys.
+  _MAX_HOT_KEYS = 100
+
+  def run(self, filenames, shards=None, share=None):
+    if shards is None:
+      shards = len(filenames)
+    if share is None:
+      share = self._HOT_KEY_SHARE
+    key_sizes = {}
+    for filename in filenames:
+      with cloudstorage.open(filename) as f:
+        for record in itertools.islice(records.RecordsReader(f),
+                                       self._SAMPLE_RECORDS):
+          key = kv_format.decode_key(record)
+          key_sizes[key] = key_sizes.get(key, 0) + len(record)
+    hot_keys = _find_hot_keys(key_sizes, shards, share, self._MAX_HOT_KEYS)
+    if hot_keys:
+      logging.info("Salting %d hot keys: %r", len(hot_keys), hot_keys[:10])
+    return hot_keys
+
+
 class ShufflePipeline(pipeline_base.PipelineBase):
   """A pipeline to shuffle multiple key-value files.
 
@@ -678,28 +982,48 @@ class ShufflePipeline(pipeline_base.PipelineBase):
     mapper_params: parameters to use for mapper phase.
     filenames: list of file names to sort. Files have to be of records format
       defined by Files API and contain serialized kv_pb.KeyValue
-      protocol messages. The filenames may or may not contain the
-      GCS bucket name in their path.
+      protocol messages or compact KeyValue records (see kv_format). The
+      filenames may or may not contain the GCS bucket name in their path.
     shards: Optional. Number of output shards to generate. Defaults
       to the number of input files.
+    hot_keys: Optional. Keys to spread over all shards as salted sub-keys,
+      see _HashingGCSOutputWriter.
+    shuffle_format: Optional. kv_format version of the records written by the
+      shuffle. Input records can be of any version.
+    presorted: Optional. If True, filenames is a list with the list of the
+      files of each output shard, sorted by key, as written by
+      _SortedRunsGCSOutputWriter, and they are only merged. shards and
+      hot_keys are then ignored.
 
   Returns:
     default: a list of filenames as string. Resulting files contain
-      serialized kv_pb.KeyValues protocol messages with
-      all values collated to a single key. When there is no output,
-      an empty list from shuffle service or a list of empty files from
-      in memory shuffler.
+      serialized kv_pb.KeyValues protocol messages (or compact KeyValues
+      records) with all values collated to a single key. When there is no
+      output, an empty list from shuffle service or a list of empty files from
+      in memory shuffler. If there are hot keys, the list has twice as many
+      files, and the files of the second half hold the sub-keys.
   """
 
-  def run(self, job_name, mapper_params, filenames, shards=None):
+  def run(self, job_name, mapper_params, filenames, shards=None,
+          hot_keys=None, shuffle_format=kv_format.FORMAT_PROTO,
+          presorted=False):
     bucket_name = mapper_params["bucket_name"]
+    if presorted:
+      merged_files = yield _MergePipeline(job_name, bucket_name, filenames,
+                                          shuffle_format=shuffle_format)
+      yield pipeline_common.Return(merged_files)
+      return
+
     hashed_files = yield _HashPipeline(job_name, bucket_name,
-                                       filenames, shards=shards)
+                                       filenames, shards=shards,
+                                       hot_keys=hot_keys,
+                                       shuffle_format=shuffle_format)
     sorted_files = yield _SortChunksPipeline(job_name, bucket_name,
                                              hashed_files)
     temp_files = [hashed_files, sorted_files]
 
-    merged_files = yield _MergePipeline(job_name, bucket_name, sorted_files)
+    merged_files = yield _MergePipeline(job_name, bucket_name, sorted_files,
+                                        shuffle_format=shuffle_format)
 
     with pipeline.After(merged_files):
       all_temp_files = yield pipeline_common.Extend(*temp_files)
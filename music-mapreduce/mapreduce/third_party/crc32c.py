@@ -9,13 +9,21 @@ See http://en.wikipedia.org/wiki/Cyclic_redundancy_check for details on CRC-32C.
 This code is a manual python translation of c code generated by
 pycrc 0.7.1 (http://www.tty1.net/pycrc/). Command line used:
 './pycrc.py --model=crc-32c --generate c --algorithm=table-driven'
-"""
-
 
+crc_update uses the fastest engine available, in this order:
+  1. a native module, if one is importable: the crc32c package (which uses
+     SSE4.2 instructions when the CPU has them) or the google_crc32c package.
+  2. slicing-by-8: eight tables derived from CRC_TABLE, so that the checksum
+     advances by a little-endian 8-byte word per iteration instead of a byte.
+A native module is only used if it agrees with the byte-by-byte CRC_TABLE
+implementation on a set of test vectors when this module is imported.
+"""
 
-# TODO(user): We would really benefit from having this as a c extension.
+from __future__ import absolute_import
 
 import array
+import logging
+import struct
 
 CRC_TABLE = (
     0x00000000L, 0xf26b8303L, 0xe13b70f7L, 0x1350f3f4L,
@@ -91,16 +99,17 @@ CRC_INIT = 0
 _MASK = 0xFFFFFFFFL
 
 
-def crc_update(crc, data):
-  """Update CRC-32C checksum with data.
+def _as_string(data):
+  """Returns byte array, string or iterable over bytes data as a string."""
+  if isinstance(data, str):
+    return data
+  if isinstance(data, array.array) and data.itemsize == 1:
+    return data.tostring()
+  return array.array("B", data).tostring()
 
-  Args:
-    crc: 32-bit checksum to update as long.
-    data: byte array, string or iterable over bytes.
 
-  Returns:
-    32-bit updated CRC-32C as long.
-  """
+def _crc_update_table(crc, data):
+  """crc_update computed byte by byte with CRC_TABLE."""
   # Convert data to byte array if needed
   if type(data) != array.array or data.itemsize != 1:
     buf = array.array("B", data)
@@ -114,6 +123,114 @@ def crc_update(crc, data):
   return crc ^ _MASK
 
 
+def _slicing_tables():
+  """Returns the 8 tables of slicing-by-8, the first one being CRC_TABLE.
+
+  Entry i of table k is the CRC of byte i followed by k zero bytes.
+  """
+  tables = [[int(value) for value in CRC_TABLE]]
+  for _ in range(7):
+    previous = tables[-1]
+    tables.append([(value >> 8) ^ tables[0][value & 0xff]
+                   for value in previous])
+  return tuple(tuple(table) for table in tables)
+
+
+_TABLES = _slicing_tables()
+
+
+def _crc_update_sliced(crc, data):
+  """crc_update computed 8 bytes at a time with slicing-by-8 tables."""
+  data = _as_string(data)
+  (t0, t1, t2, t3, t4, t5, t6, t7) = _TABLES
+  crc = int(crc) ^ 0xffffffff
+  words = len(data) // 8
+  if words:
+    it = iter(struct.unpack("<%dI" % (2 * words), data[:8 * words]))
+    for low in it:
+      high = next(it)
+      low ^= crc
+      crc = (t7[low & 0xff] ^ t6[(low >> 8) & 0xff] ^
+             t5[(low >> 16) & 0xff] ^ t4[low >> 24] ^
+             t3[high & 0xff] ^ t2[(high >> 8) & 0xff] ^
+             t1[(high >> 16) & 0xff] ^ t0[high >> 24])
+  for c in data[8 * words:]:
+    crc = t0[(crc ^ ord(c)) & 0xff] ^ (crc >> 8)
+  return crc ^ 0xffffffff
+
+
+def _native_engines():
+  """Yields (name, crc_update) of the importable native CRC-32C modules."""
+  # pylint: disable=g-import-not-at-top
+  try:
+    import crc32c as native
+    # Named crc32 before version 2 of the package.
+    native_crc = getattr(native, "crc32c", None) or getattr(native, "crc32")
+    yield ("crc32c", lambda crc, data: native_crc(_as_string(data), crc))
+  except (ImportError, AttributeError):
+    pass
+  try:
+    import google_crc32c as native
+    if native.implementation == "c":
+      yield ("google_crc32c",
+             lambda crc, data: native.extend(crc, _as_string(data)))
+  except (ImportError, AttributeError):
+    pass
+
+
+# Known answer: the CRC-32C of "123456789", from rfc3720 section B.4's model.
+_CHECK = ("123456789", 0xe3069283)
+
+
+def _verify(update):
+  """Returns whether update agrees with _crc_update_table."""
+  try:
+    if update(CRC_INIT, _CHECK[0]) != _CHECK[1]:
+      return False
+    data = "".join(chr((i * 7 + 3) & 0xff) for i in range(300))
+    for length in range(0, 40) + [255, 256, 257, 300]:
+      for start in (0, 1, 5):
+        chunk = data[start:start + length]
+        expected = _crc_update_table(0x12345678, chunk)
+        if update(0x12345678, chunk) != expected:
+          return False
+        if update(CRC_INIT, [ord(c) for c in chunk]) != _crc_update_table(
+            CRC_INIT, chunk):
+          return False
+    return True
+  except Exception:  # pylint: disable=broad-except
+    logging.exception("CRC-32C engine failed verification")
+    return False
+
+
+def _select_engine():
+  """Returns (name, crc_update) of the fastest verified engine."""
+  for (name, update) in _native_engines():
+    if _verify(update):
+      return (name, update)
+    logging.warning("Not using CRC-32C module %s, which disagrees with the "
+                    "table-driven implementation", name)
+  if _verify(_crc_update_sliced):
+    return ("slicing-by-8", _crc_update_sliced)
+  return ("table", _crc_update_table)
+
+
+(ENGINE, _crc_update) = _select_engine()
+
+
+def crc_update(crc, data):
+  """Update CRC-32C checksum with data.
+
+  Args:
+    crc: 32-bit checksum to update as long.
+    data: byte array, string or iterable over bytes.
+
+  Returns:
+    32-bit updated CRC-32C as long.
+  """
+  return _crc_update(crc, data)
+
+
 def crc_finalize(crc):
   """Finalize CRC-32C checksum.
 
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs the unit tests in the tests directory.
+
+  python run_tests.py SDK_PATH [PATTERN]
+
+SDK_PATH is the directory of the App Engine SDK (the one holding
+dev_appserver.py), and PATTERN restricts the test modules to run, by default
+*_test.py.
+"""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+
+import optparse
+import os
+import sys
+import unittest
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+  parser = optparse.OptionParser(usage="%prog SDK_PATH [PATTERN]")
+  (_, args) = parser.parse_args()
+  if not 1 <= len(args) <= 2:
+    parser.error("expected the SDK path and an optional test pattern")
+  sys.path.insert(0, args[0])
+  import dev_appserver  # pylint: disable=g-import-not-at-top
+  dev_appserver.fix_sys_path()
+  sys.path.insert(0, _APP_DIR)
+  os.environ.setdefault("APPLICATION_ID", "dev~test")
+
+  pattern = args[1] if len(args) > 1 else "*_test.py"
+  suite = unittest.TestLoader().discover(
+      os.path.join(_APP_DIR, "tests"), pattern=pattern,
+      top_level_dir=_APP_DIR)
+  result = unittest.TextTestRunner(verbosity=2).run(suite)
+  sys.exit(not result.wasSuccessful())
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bounded-memory summaries used by the analysis jobs.
+
+The summaries are plain Python values so that they can be encoded as shuffle
+values and merged by combiners and reducers.
+"""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+
+import hashlib
+import heapq
+import math
+import struct
+
+
+def space_saving_add(counts, item, count, capacity):
+  """Adds count occurrences of item to a space-saving summary.
+
+  The summary is an item -> count dict holding at most capacity items. When a
+  new item arrives and the summary is full, the item with the smallest count
+  is evicted and the new item inherits its count, so counts may overestimate
+  but never underestimate, and every item more frequent than 1/capacity of the
+  stream is kept.
+
+  Args:
+    counts: the summary, an item -> count dict. Updated in place.
+    item: the item to add.
+    count: the number of occurrences to add.
+    capacity: maximum number of items in the summary.
+  """
+  if item in counts:
+    counts[item] += count
+  elif len(counts) < capacity:
+    counts[item] = count
+  else:
+    evicted = min(counts, key=counts.get)
+    counts[item] = counts.pop(evicted) + count
+
+
+def space_saving_truncate(counts, capacity):
+  """Shrinks a merged space-saving summary back to capacity items.
+
+  Summaries are merged by adding their counts item by item. This keeps the
+  capacity items with the largest merged counts.
+
+  Args:
+    counts: the summary, an item -> count dict. Updated in place.
+    capacity: maximum number of items in the summary.
+  """
+  if len(counts) > capacity:
+    kept = heapq.nlargest(capacity, counts.iteritems(), key=lambda kv: kv[1])
+    counts.clear()
+    counts.update(kept)
+
+
+def top_k(counts, k, min_support=1):
+  """Returns the k most frequent items of counts, with ties.
+
+  Args:
+    counts: an item -> count dict.
+    k: number of ranks to return.
+    min_support: minimum count of a returned item.
+
+  Returns:
+    A list of (rank, item, count) tuples, by decreasing count and then item.
+    Items with equal counts share a rank, and every item tied with the k-th
+    one is returned, so the list may be longer than k.
+  """
+  if k <= 0:
+    return []
+  largest = heapq.nlargest(k, counts.itervalues())
+  if not largest:
+    return []
+  threshold = max(largest[-1], min_support)
+  ranked = sorted(((count, item) for item, count in counts.iteritems()
+                   if count >= threshold),
+                  key=lambda ci: (-ci[0], ci[1]))
+  result = []
+  for i, (count, item) in enumerate(ranked):
+    if i and count == result[-1][2]:
+      rank = result[-1][0]
+    else:
+      rank = i + 1
+    result.append((rank, item, count))
+  return result
+
+
+class _Reversed(object):
+  """Wraps a value so that it sorts in reverse order."""
+
+  __slots__ = ("value",)
+
+  def __init__(self, value):
+    self.value = value
+
+  def __lt__(self, other):
+    return other.value < self.value
+
+  def __eq__(self, other):
+    return self.value == other.value
+
+  def __ne__(self, other):
+    return self.value != other.value
+
+
+def bounded_top_add(heap, n, count, item):
+  """Adds an item to a heap of the n items with the largest counts.
+
+  The heap is a list managed with heapq, whose smallest entry is the first
+  to be evicted. Of items with equal counts, the smallest ones are kept, so
+  that the result does not depend on the order items are added in.
+
+  Args:
+    heap: the heap, a list. Updated in place.
+    n: maximum number of items in the heap.
+    count: the count of the item.
+    item: the item to add. Items must be distinct.
+  """
+  entry = (count, _Reversed(item))
+  if len(heap) < n:
+    heapq.heappush(heap, entry)
+  elif heap and heap[0] < entry:
+    heapq.heapreplace(heap, entry)
+
+
+def bounded_top_items(heap):
+  """Returns the (count, item) pairs of a bounded_top_add heap, best first."""
+  return [(count, item.value) for (count, item) in sorted(heap, reverse=True)]
+
+
+# Default HyperLogLog precision: 2^12 registers, about 1.6% standard error.
+HLL_PRECISION = 12
+
+# Encoding of HyperLogLog sketches: the precision, the format, then either
+# every register (dense) or the (index, value) pairs of the non-zero registers
+# (sparse), whichever is shorter.
+_HLL_DENSE = "d"
+_HLL_SPARSE = "s"
+_HLL_PAIR = struct.Struct(">HB")
+
+
+def hll_new(precision=HLL_PRECISION):
+  """Returns an empty HyperLogLog sketch with 2^precision registers.
+
+  A sketch is a bytearray of registers, so that its size is fixed whatever
+  the number of distinct items added to it.
+  """
+  if not 4 <= precision <= 16:
+    raise ValueError("HyperLogLog precision must be in [4, 16]: %d" %
+                     precision)
+  return bytearray(1 << precision)
+
+
+def hll_add(registers, item):
+  """Adds an item (a string) to a HyperLogLog sketch."""
+  precision = len(registers).bit_length() - 1
+  bits = 64 - precision
+  (h,) = struct.unpack(">Q", hashlib.md5(item).digest()[:8])
+  index = h >> bits
+  rest = h & ((1 << bits) - 1)
+  # Position of the leftmost 1 bit of the remaining bits.
+  rank = bits - rest.bit_length() + 1
+  if rank > registers[index]:
+    registers[index] = rank
+
+
+def hll_merge(registers, other):
+  """Merges the sketch other into registers, which must have its precision."""
+  if len(registers) != len(other):
+    raise ValueError("Cannot merge HyperLogLog sketches of %d and %d "
+                     "registers" % (len(registers), len(other)))
+  for index, value in enumerate(other):
+    if value > registers[index]:
+      registers[index] = value
+
+
+def hll_count(registers):
+  """Returns the estimated number of distinct items added to a sketch."""
+  m = len(registers)
+  if m == 16:
+    alpha = 0.673
+  elif m == 32:
+    alpha = 0.697
+  elif m == 64:
+    alpha = 0.709
+  else:
+    alpha = 0.7213 / (1 + 1.079 / m)
+  estimate = alpha * m * m / sum(2.0 ** -value for value in registers)
+  zeros = registers.count("\0")
+  if estimate <= 2.5 * m and zeros:
+    # Small range correction: linear counting.
+    estimate = m * math.log(float(m) / zeros)
+  return int(round(estimate))
+
+
+def hll_encode(registers):
+  """Encodes a sketch as a string."""
+  header = chr(len(registers).bit_length() - 1)
+  pairs = [(index, value) for index, value in enumerate(registers) if value]
+  if len(pairs) * _HLL_PAIR.size < len(registers):
+    return header + _HLL_SPARSE + "".join(
+        _HLL_PAIR.pack(index, value) for (index, value) in pairs)
+  return header + _HLL_DENSE + str(registers)
+
+
+def hll_decode(s):
+  """Decodes a sketch encoded by hll_encode."""
+  registers = hll_new(ord(s[0]))
+  if s[1] == _HLL_DENSE:
+    registers[:] = s[2:]
+  else:
+    for offset in xrange(2, len(s), _HLL_PAIR.size):
+      (index, value) = _HLL_PAIR.unpack_from(s, offset)
+      registers[index] = value
+  return registers
@@ -36,5 +36,14 @@ function updateForm(filekey, blobkey, filename) {
   $('#jazz_song_artist').removeAttr('disabled');
   $('#jazz_dollar_artist').removeAttr('disabled');
   $('#most_buy_together').removeAttr('disabled');
+  $('#all_metrics').removeAttr('disabled');
+  $('#genre_metrics').removeAttr('disabled');
+  $('#incremental_metrics').removeAttr('disabled');
+  $('#windowed_sales').removeAttr('disabled');
+  $('#leaderboards').removeAttr('disabled');
+  $('#distinct_buyers').removeAttr('disabled');
+  $('#user_profile').removeAttr('disabled');
+  $('#song_sales').removeAttr('disabled');
+  $('#duration_stats').removeAttr('disabled');
 }
 
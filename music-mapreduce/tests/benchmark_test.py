@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for benchmark."""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+
+import cStringIO
+import json
+import sys
+import unittest
+
+import benchmark
+
+
+class BenchmarkTest(unittest.TestCase):
+
+  def run_main(self, *args):
+    """Runs main() with args and returns its results."""
+    (argv, stdout, stderr) = (sys.argv, sys.stdout, sys.stderr)
+    sys.argv = ["benchmark.py", "--lines=2000", "--processes=1"] + list(args)
+    sys.stdout = cStringIO.StringIO()
+    sys.stderr = cStringIO.StringIO()
+    try:
+      benchmark.main()
+      return json.loads(sys.stdout.getvalue())
+    finally:
+      (sys.argv, sys.stdout, sys.stderr) = (argv, stdout, stderr)
+
+  def testOptionsAreFilteredPerJob(self):
+    results = self.run_main("--job=genre_metrics",
+                            "--job=most_buy_together", "--option=top_k=3")
+    self.assertEqual(["genre_metrics", "most_buy_together"],
+                     [job["job"] for job in results["jobs"]])
+    for job in results["jobs"]:
+      self.assertNotIn("error", job)
+
+  def testUnknownOptionIsRejected(self):
+    self.assertRaises(SystemExit, self.run_main, "--job=genre_metrics",
+                      "--option=top_k=3")
+
+
+if __name__ == "__main__":
+  unittest.main()
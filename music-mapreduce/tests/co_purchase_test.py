@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the most_buy_together job of main.py."""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import local_runner
+import main
+
+
+def sale(timestamp, user, title):
+  return "\t".join((timestamp, user, title, "Artist", "Album", "Jazz",
+                    "3:00", "0.99"))
+
+
+# A basket of songs A, B and C that starts at the end of the first file and
+# ends at the start of the second one, between baskets of other users.
+FILES = (
+    [sale("2017.1.1 10:00", "Ann", "X"),
+     sale("2017.1.1 10:00", "Ann", "Y"),
+     sale("2017.1.2 11:00", "Bob", "A"),
+     sale("2017.1.2 11:00", "Bob", "B")],
+    [sale("2017.1.2 11:00", "Bob", "C"),
+     sale("2017.1.3 12:00", "Cid", "A"),
+     sale("2017.1.3 12:00", "Cid", "D")],
+)
+
+
+class CoPurchaseTest(unittest.TestCase):
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp()
+    self.input_path = os.path.join(self.work_dir, "input.zip")
+    with zipfile.ZipFile(self.input_path, "w") as zf:
+      for i, lines in enumerate(FILES):
+        zf.writestr("transaction%d.txt" % (i + 1), "\n".join(lines) + "\n")
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+
+  def run_job(self, shards):
+    """Returns the song -> {partner: count} output of the job."""
+    (args, kwargs) = main.MostBuyTogetherPipeline.mapreduce_args(
+        self.input_path, {}, _reader=local_runner._open_local, top_k=10)
+    kwargs.update(shards=shards, reduce_shards=shards)
+    (filenames, _) = local_runner.run_mapreduce(
+        *args, output_dir=os.path.join(self.work_dir, "output-%d" % shards),
+        processes=1, **kwargs)
+    partners = {}
+    for filename in filenames:
+      with open(filename) as f:
+        for line in f:
+          (song, _, partner, count) = line.rstrip("\n").split(", ")
+          partners.setdefault(song, {})[partner] = int(count)
+    return partners
+
+  def testBasketAcrossFilesOfOneShard(self):
+    self.assertEqual({"X": {"Y": 1},
+                      "Y": {"X": 1},
+                      "A": {"B": 1, "C": 1, "D": 1},
+                      "B": {"A": 1, "C": 1},
+                      "C": {"A": 1, "B": 1},
+                      "D": {"A": 1}},
+                     self.run_job(1))
+
+  def testBasketAcrossShards(self):
+    # Each file goes to its own shard, so Bob's basket is counted as a basket
+    # of A and B and a basket of C alone: the pairs with C are missed, and
+    # nothing is counted twice.
+    self.assertEqual({"X": {"Y": 1},
+                      "Y": {"X": 1},
+                      "A": {"B": 1, "D": 1},
+                      "B": {"A": 1},
+                      "D": {"A": 1}},
+                     self.run_job(2))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for mapreduce.third_party.crc32c."""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+# pylint: disable=protected-access
+
+import array
+import random
+import unittest
+
+from mapreduce.third_party import crc32c
+
+
+def engines():
+  """Returns (name, crc_update) of every engine available here."""
+  return ([("slicing-by-8", crc32c._crc_update_sliced),
+           ("selected " + crc32c.ENGINE, crc32c.crc_update)] +
+          list(crc32c._native_engines()))
+
+
+class Crc32cTest(unittest.TestCase):
+
+  def setUp(self):
+    self.rand = random.Random(0)
+
+  def random_bytes(self, length):
+    return "".join(chr(self.rand.randrange(256)) for _ in xrange(length))
+
+  def testKnownAnswer(self):
+    self.assertEqual(0xe3069283, crc32c.crc("123456789"))
+    self.assertEqual(0, crc32c.crc(""))
+    for (name, update) in engines():
+      self.assertEqual(0xe3069283, update(crc32c.CRC_INIT, "123456789"), name)
+
+  def testEnginesMatchTable(self):
+    # Every length mod 8, around the word size and for longer buffers, at
+    # unaligned offsets of a larger buffer.
+    data = self.random_bytes(4200)
+    lengths = range(0, 33) + [63, 64, 65, 1000, 1001, 1002, 1003, 1004,
+                              1005, 1006, 1007, 4096]
+    for (name, update) in engines():
+      for length in lengths:
+        for start in (0, 1, 3, 7):
+          chunk = data[start:start + length]
+          for crc in (crc32c.CRC_INIT, 0xffffffff, 0x12345678):
+            self.assertEqual(crc32c._crc_update_table(crc, chunk),
+                             update(crc, chunk),
+                             "%s, length %d" % (name, length))
+
+  def testEmptyInputKeepsCrc(self):
+    for (name, update) in engines():
+      for crc in (crc32c.CRC_INIT, 1, 0xffffffff, 0x9abcdef0):
+        self.assertEqual(crc, update(crc, ""), name)
+
+  def testIncrementalUpdates(self):
+    data = self.random_bytes(3000)
+    expected = crc32c._crc_update_table(crc32c.CRC_INIT, data)
+    for (name, update) in engines():
+      for _ in range(20):
+        cuts = sorted(self.rand.randrange(len(data) + 1)
+                      for _ in range(self.rand.randrange(1, 10)))
+        crc = crc32c.CRC_INIT
+        for (start, end) in zip([0] + cuts, cuts + [len(data)]):
+          crc = update(crc, data[start:end])
+        self.assertEqual(expected, crc, "%s, cuts %r" % (name, cuts))
+
+  def testInputTypes(self):
+    data = self.random_bytes(77)
+    expected = crc32c._crc_update_table(crc32c.CRC_INIT, data)
+    for (name, update) in engines():
+      self.assertEqual(expected, update(crc32c.CRC_INIT,
+                                        array.array("B", data)), name)
+      self.assertEqual(expected, update(crc32c.CRC_INIT,
+                                        [ord(c) for c in data]), name)
+      self.assertEqual(expected, update(crc32c.CRC_INIT, bytearray(data)),
+                       name)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the duration_stats job of main.py."""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import local_runner
+import main
+from mapreduce import input_readers
+
+CHUNK_SIZE = 100
+
+LINES = ["2017.1.1 10:00\tAnn\tSong A\tArtist\tAlbum\tJazz\t3:00\t0.99\n",
+         "2017.1.1 10:05\tBob\tSong B\tArtist\tAlbum\tJazz\t4:30\t1.29\n",
+         "2017.1.1 10:10\tAnn\tSong C\tArtist\tAlbum\tPop\t2:00\t0.99\n",
+         "2017.1.1 10:15\tCid\tSong D\tArtist\tAlbum\tJazz\t1:30\t0.69\n"]
+
+
+class SmallChunkZipInputReader(input_readers.BlobstoreZipInputReader):
+  """Streams chunks of CHUNK_SIZE bytes, so that one file spans many."""
+
+  _STREAMING_CHUNK_SIZE = CHUNK_SIZE
+
+
+class DurationStatsChunksTest(unittest.TestCase):
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp()
+    self.input_path = os.path.join(self.work_dir, "input.zip")
+    with zipfile.ZipFile(self.input_path, "w", zipfile.ZIP_DEFLATED) as zf:
+      zf.writestr("transaction1.txt", "".join(LINES))
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+
+  def run_job(self, input_reader_spec):
+    (args, kwargs) = main.DurationStatsPipeline.mapreduce_args(
+        self.input_path, {}, _reader=local_runner._open_local)
+    args = args[:3] + (input_reader_spec,) + args[4:]
+    kwargs.update(shards=1, reduce_shards=1)
+    (filenames, _) = local_runner.run_mapreduce(
+        *args, output_dir=os.path.join(self.work_dir, input_reader_spec),
+        processes=1, **kwargs)
+    stats = {}
+    for filename in filenames:
+      with open(filename) as f:
+        for line in f:
+          fields = line.rstrip("\n").split("\t")
+          stats[fields[0]] = fields[1:]
+    return stats
+
+  def testLineAcrossChunkBoundary(self):
+    # The second line crosses the end of the first chunk.
+    self.assertTrue(len(LINES[0]) < CHUNK_SIZE < len(LINES[0] + LINES[1]))
+    stats = self.run_job(
+        "tests.duration_stats_test.SmallChunkZipInputReader")
+    # The line stays whole in the first chunk: no sale is lost or split in
+    # two broken records.
+    self.assertEqual({"Jazz": "3", "Pop": "1"},
+                     dict((genre, s[0]) for genre, s in stats.iteritems()))
+    self.assertEqual("9.0", stats["Jazz"][1])
+    self.assertEqual(
+        self.run_job("mapreduce.input_readers.BlobstoreZipInputReader"),
+        stats)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the salting of hot keys, run with the local runner."""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import local_runner
+from mapreduce import context
+
+
+def word_map(data):
+  (_, text_fn) = data
+  for word in text_fn().split():
+    yield (word, "1")
+
+
+def _parse_tagged(value):
+  """Parses a map output count or a 'tag,...:count' combined value."""
+  (tags, _, count) = value.rpartition(":")
+  return (set(filter(None, tags.split(","))), int(count))
+
+
+def tagged_count_combine(key, values, previously_combined_values):
+  """Sums counts, tagging the sum with the "tag" parameters it was run with.
+
+  Every combiner call adds the "tag" parameter of its job, or "-" if it is
+  missing, to the tags of the values.
+  """
+  tags = set([context.get().mapreduce_spec.mapper.params.get("tag", "-")])
+  total = 0
+  for value in list(values) + list(previously_combined_values):
+    (value_tags, count) = _parse_tagged(value)
+    tags.update(value_tags)
+    total += count
+  yield "%s:%d" % (",".join(sorted(tags)), total)
+
+
+def tagged_count_reduce(key, values):
+  tags = set()
+  total = 0
+  for value in values:
+    (value_tags, count) = _parse_tagged(value)
+    tags.update(value_tags)
+    total += count
+  yield "%s\t%s\t%d\n" % (key, ",".join(sorted(tags)), total)
+
+
+class HotKeysTest(unittest.TestCase):
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp()
+    self.input_path = os.path.join(self.work_dir, "input.zip")
+    # One key takes most of the input, the others are rare.
+    self.write_input(["hot"] * 900 + ["cold%d" % i for i in range(100)])
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+
+  def write_input(self, words):
+    """Writes words to each of the 4 members of the input zip."""
+    with zipfile.ZipFile(self.input_path, "w") as zf:
+      for member in range(4):
+        zf.writestr("words%d.txt" % member, "\n".join(words) + "\n")
+
+  def run_job(self, **kwargs):
+    (filenames, stats) = local_runner.run_mapreduce(
+        "words",
+        __name__ + ".word_map",
+        __name__ + ".tagged_count_reduce",
+        "mapreduce.input_readers.BlobstoreZipInputReader",
+        mapper_params={"blob_key": self.input_path},
+        reducer_params={"tag": "t"},
+        shards=4,
+        combiner_spec=__name__ + ".tagged_count_combine",
+        output_dir=os.path.join(self.work_dir, "output"),
+        processes=1,
+        **kwargs)
+    rows = {}
+    for filename in filenames:
+      with open(filename) as f:
+        for line in f:
+          (key, tags, total) = line.rstrip("\n").split("\t")
+          self.assertNotIn(key, rows)
+          rows[key] = (tags, int(total))
+    return (rows, stats)
+
+  def testCombinersOfHotKeysSeeReducerParams(self):
+    (rows, stats) = self.run_job(detect_hot_keys=True)
+    self.assertEqual(1, stats["hot_keys"])
+    self.assertEqual(("t", 3600), rows["hot"])
+    self.assertEqual(("t", 4), rows["cold7"])
+    self.assertEqual(101, len(rows))
+
+  def testHotKeysAreDetectedOnSkewedInput(self):
+    (rows, stats) = self.run_job(detect_hot_keys=True)
+    self.assertEqual(1, stats["hot_keys"])
+    self.assertEqual(self.run_job()[0], rows)
+
+  def testUniformInputHasNoHotKeys(self):
+    self.write_input(["word%d" % i for i in range(1000)])
+    (rows, stats) = self.run_job(detect_hot_keys=True)
+    self.assertEqual(0, stats["hot_keys"])
+    self.assertEqual(1000, len(rows))
+
+  def testDetectionIsOptIn(self):
+    self.assertEqual(0, self.run_job()[1]["hot_keys"])
+    for pipeline_class in local_runner.analysis_pipelines().itervalues():
+      self.assertFalse(pipeline_class.detect_hot_keys)
+
+
+if __name__ == "__main__":
+  unittest.main()
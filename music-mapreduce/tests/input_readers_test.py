@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the streaming mode of BlobstoreZipInputReader."""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+# pylint: disable=protected-access
+
+import cStringIO
+import json
+import random
+import unittest
+import zipfile
+
+from google.appengine.ext import testbed
+from mapreduce import input_readers
+from mapreduce import model
+
+
+class SmallChunkZipInputReader(input_readers.BlobstoreZipInputReader):
+  """Streams chunks of about 200 bytes, so that files span many chunks."""
+
+  _STREAMING_CHUNK_SIZE = 200
+
+
+class BlobstoreZipInputReaderStreamingTest(unittest.TestCase):
+
+  BLOB_KEY = "zip-blob"
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_blobstore_stub()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.rand = random.Random(0)
+    # Contained files of varying sizes, one of them empty and one without a
+    # final newline, stored both deflated and uncompressed.
+    self.files = []
+    f = cStringIO.StringIO()
+    with zipfile.ZipFile(f, "w") as zf:
+      for i, lines in enumerate((300, 0, 1, 57, 120)):
+        text = "".join("file%d line%d %s\n" % (
+            i, j, "x" * self.rand.randrange(40)) for j in range(lines))
+        if i == 3:
+          text = text.rstrip("\n")
+        info = zipfile.ZipInfo("file%d.txt" % i)
+        info.compress_type = (zipfile.ZIP_STORED if i % 2 else
+                              zipfile.ZIP_DEFLATED)
+        zf.writestr(info, text)
+        self.files.append(text)
+    self.testbed.get_stub(testbed.BLOBSTORE_SERVICE_NAME).CreateBlob(
+        self.BLOB_KEY, f.getvalue())
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def expected_lines(self):
+    return [line for text in self.files
+            for line in cStringIO.StringIO(text).readlines()]
+
+  def split(self, shards):
+    mapper_spec = model.MapperSpec(
+        "handler",
+        SmallChunkZipInputReader.__module__ + ".SmallChunkZipInputReader",
+        {"input_reader": {"blob_key": self.BLOB_KEY, "streaming": True}},
+        shards)
+    return SmallChunkZipInputReader.split_input(mapper_spec)
+
+  def read_with_restarts(self, reader, restart_probability):
+    """Reads all lines, serializing the reader at random chunk boundaries."""
+    lines = []
+    while True:
+      try:
+        (_, text_fn) = reader.next()
+      except StopIteration:
+        return lines
+      lines.extend(text_fn())
+      if self.rand.random() < restart_probability:
+        reader = SmallChunkZipInputReader.from_json(
+            json.loads(json.dumps(reader.to_json())))
+
+  def testLinesAreReadOnce(self):
+    for shards in (1, 2, 5):
+      for restart_probability in (0, 0.3, 1):
+        lines = []
+        for reader in self.split(shards):
+          lines.extend(self.read_with_restarts(reader, restart_probability))
+        self.assertEqual(self.expected_lines(), lines)
+
+  def testResumeWithinFile(self):
+    (reader,) = self.split(1)
+    (entry, text_fn) = reader.next()
+    self.assertEqual("file0.txt", entry.filename)
+    first = list(text_fn())
+    self.assertTrue(0 < len(first) < 300)
+    state = reader.to_json()
+    self.assertEqual(0, state["start_index"])
+    self.assertEqual(sum(len(line) for line in first), state["offset"])
+    resumed = self.read_with_restarts(
+        SmallChunkZipInputReader.from_json(state), 0)
+    self.assertEqual(self.expected_lines(), first + resumed)
+
+
+if __name__ == "__main__":
+  unittest.main()
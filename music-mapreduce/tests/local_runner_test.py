@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for local_runner."""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+
+import cStringIO
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import local_runner
+import main
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))), "data", "small.zip")
+
+
+def read_lines(filenames):
+  lines = []
+  for filename in filenames:
+    with open(filename) as f:
+      lines.extend(f)
+  return sorted(lines)
+
+
+class LocalRunnerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.output_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.output_dir)
+
+  def run_main(self, *args):
+    """Runs main() with args and returns the stats of each job."""
+    (argv, stdout) = (sys.argv, sys.stdout)
+    sys.argv = ["local_runner.py", "--processes=1",
+                "--output=" + self.output_dir] + list(args) + [DATA]
+    sys.stdout = cStringIO.StringIO()
+    try:
+      local_runner.main()
+      output = sys.stdout.getvalue()
+    finally:
+      (sys.argv, sys.stdout) = (argv, stdout)
+    decoder = json.JSONDecoder()
+    stats = {}
+    position = 0
+    while output[position:].strip():
+      while output[position].isspace():
+        position += 1
+      (job_stats, position) = decoder.raw_decode(output, position)
+      stats[job_stats["job"]] = job_stats
+    return stats
+
+  def testJobOptions(self):
+    options = {"top_k": 3, "top_n": 5, "sketch_size": 8}
+    self.assertEqual({"top_k": 3, "sketch_size": 8}, local_runner.job_options(
+        main.MostBuyTogetherPipeline, options))
+    self.assertEqual({"top_n": 5}, local_runner.job_options(
+        main.LeaderboardsPipeline, options))
+    self.assertEqual({}, local_runner.job_options(
+        main.SongSoldNumPipeline, options))
+
+  def testOptionsAreFilteredPerJob(self):
+    stats = self.run_main("--job=song_sold_num", "--job=leaderboards",
+                          "--option=top_n=3")
+    self.assertEqual(set(["song_sold_num", "leaderboards"]), set(stats))
+    leaderboards = [filename for filename in stats["leaderboards"]["files"]
+                    if "/merged/" in filename]
+    self.assertIn(os.path.join(self.output_dir, "leaderboards", "merged",
+                               "TopDollarSong"), leaderboards)
+    for filename in leaderboards:
+      with open(filename) as f:
+        self.assertTrue(1 <= len(f.readlines()) <= 3, filename)
+
+  def testUnknownOptionIsRejected(self):
+    stderr = sys.stderr
+    sys.stderr = cStringIO.StringIO()
+    try:
+      self.assertRaises(SystemExit, self.run_main, "--job=song_sold_num",
+                        "--option=top_n=3")
+    finally:
+      sys.stderr = stderr
+
+  def testSnapshotsMatchStandaloneJobs(self):
+    (filenames, _) = local_runner.run_analysis(
+        main.IncrementalMetricsPipeline, DATA,
+        os.path.join(self.output_dir, "incremental"), processes=1)
+    reports = dict((os.path.basename(filename), filename)
+                   for filename in filenames if "/merged/" in filename)
+    for pipeline_class in (main.SongSoldNumPipeline, main.DollarSongPipeline,
+                           main.SongArtistPipeline,
+                           main.DollarArtistPipeline):
+      (expected, _) = local_runner.run_analysis(
+          pipeline_class, DATA,
+          os.path.join(self.output_dir, pipeline_class.job_name),
+          processes=1)
+      self.assertEqual(
+          read_lines(expected),
+          read_lines([reports[pipeline_class.result_name + "-report"]]))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for mapreduce.output_writers."""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+
+import unittest
+
+import cloudstorage
+from google.appengine.ext import testbed
+from mapreduce import context
+from mapreduce import model
+from mapreduce import output_writers
+
+PartitionedWriter = output_writers.GoogleCloudStoragePartitionedOutputWriter
+_WRITER_SPEC = (
+    "mapreduce.output_writers.GoogleCloudStoragePartitionedOutputWriter")
+
+
+class _ShardState(object):
+  """Receives the writer_state set by finalize()."""
+
+
+class GoogleCloudStoragePartitionedOutputWriterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_app_identity_stub()
+    self.testbed.init_blobstore_stub()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_urlfetch_stub()
+    mapper = model.MapperSpec(
+        "handler", "reader", {"output_writer": {"bucket_name": "bucket"}}, 1,
+        output_writer_spec=_WRITER_SPEC)
+    self.mr_spec = model.MapreduceSpec("job", "jobid", mapper.to_json())
+    self.ctx = context.Context(self.mr_spec,
+                               model.ShardState.create_new("jobid", 0))
+    context.Context._set(self.ctx)  # pylint: disable=protected-access
+
+  def tearDown(self):
+    context.Context._set(None)  # pylint: disable=protected-access
+    self.testbed.deactivate()
+
+  def testWritesOneFilePerPartition(self):
+    writer = PartitionedWriter.create(self.mr_spec, 0, 0)
+    writer.write(("Pop", "a\n"))
+    writer.write((["Pop", "Dance"], "b\n"))
+    writer.write(("Pop", "c\n"))
+    shard_state = _ShardState()
+    writer.finalize(self.ctx, shard_state)
+    contents = {}
+    for filename in shard_state.writer_state["filenames"]:
+      with cloudstorage.open(filename) as f:
+        contents[PartitionedWriter.get_partition(filename)] = f.read()
+    self.assertEqual({("Pop",): "a\nc\n", ("Pop", "Dance"): "b\n"}, contents)
+
+  def testRejectsBadValues(self):
+    writer = PartitionedWriter.create(self.mr_spec, 0, 0)
+    for value in ["ab", "Pop,a\n", ("Pop",), ("Pop", "a\n", "b\n")]:
+      self.assertRaises(TypeError, writer.write, value)
+    shard_state = _ShardState()
+    writer.finalize(self.ctx, shard_state)
+    self.assertEqual([], shard_state.writer_state["filenames"])
+
+
+if __name__ == "__main__":
+  unittest.main()
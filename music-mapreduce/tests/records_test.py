@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for mapreduce.records."""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+# pylint: disable=protected-access
+
+import cStringIO
+import json
+import os
+import random
+import unittest
+
+import cloudstorage
+from google.appengine.ext import testbed
+from mapreduce import input_readers
+from mapreduce import records
+from mapreduce.lib.input_reader import _gcs
+
+BLOCK = records._BLOCK_SIZE
+HEADER = records._HEADER_LENGTH
+
+
+def record_types(data):
+  """Returns the types of the physical records of a records file."""
+  types = []
+  position = 0
+  while position + HEADER <= len(data):
+    block_remaining = BLOCK - position % BLOCK
+    if block_remaining < HEADER:
+      position += block_remaining
+      continue
+    (_, length, record_type) = records._HEADER_STRUCT.unpack_from(
+        data, position)
+    if record_type == records._RECORD_TYPE_NONE:
+      position += block_remaining
+      continue
+    types.append(record_type)
+    position += HEADER + length
+  return types
+
+
+def write_records(recs):
+  f = cStringIO.StringIO()
+  records.RecordsWriter(f).write_many(recs)
+  return f.getvalue()
+
+
+def random_records(rand, count):
+  """Returns count records of random lengths, some spanning blocks."""
+  return ["%d:" % i + "x" * rand.choice([0, 5, 100, 3000, BLOCK, 40000])
+          for i in range(count)]
+
+
+class RecordsWriterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.rand = random.Random(0)
+
+  def random_record(self, length):
+    pattern = "".join(chr(self.rand.randrange(256)) for _ in range(50))
+    return (pattern * (length // 50 + 1))[:length]
+
+  def write(self, recs, split=0, pad=False):
+    """Writes recs[:split] with write() and the rest with write_many()."""
+    f = cStringIO.StringIO()
+    writer = records.RecordsWriter(f)
+    for record in recs[:split]:
+      writer.write(record)
+    writer.write_many(iter(recs[split:]))
+    if pad:
+      writer._pad_block()
+    return f.getvalue()
+
+  def write_one_by_one(self, recs, pad=False):
+    return self.write(recs, len(recs), pad)
+
+  def assertSameBytes(self, recs, split=0, pad=False):
+    expected = self.write_one_by_one(recs, pad)
+    self.assertEqual(expected, self.write(recs, split, pad))
+    self.assertEqual(recs, list(records.RecordsReader(
+        cStringIO.StringIO(expected))))
+    return expected
+
+  def testEmpty(self):
+    self.assertEqual("", self.write([]))
+    self.assertSameBytes([""])
+
+  def testBlockBoundaries(self):
+    # Records ending exactly at, just before and just after the end of a
+    # block, and leaving less than a header at its end.
+    for first in (BLOCK - HEADER, BLOCK - 2 * HEADER, BLOCK - 2 * HEADER + 1,
+                  BLOCK - HEADER - 1, BLOCK - HEADER - 6, BLOCK - HEADER + 1):
+      for second in (0, 1, 10, BLOCK):
+        self.assertSameBytes([self.random_record(first),
+                              self.random_record(second), "x"])
+
+  def testLargeRecordsAreFragmented(self):
+    recs = ["a", self.random_record(3 * BLOCK + 100), "b",
+            self.random_record(BLOCK), self.random_record(2 * BLOCK - 14)]
+    data = self.assertSameBytes(recs)
+    self.assertEqual(
+        [records._RECORD_TYPE_FULL,
+         records._RECORD_TYPE_FIRST] + [records._RECORD_TYPE_MIDDLE] * 2 +
+        [records._RECORD_TYPE_LAST,
+         records._RECORD_TYPE_FULL,
+         records._RECORD_TYPE_FIRST, records._RECORD_TYPE_LAST,
+         records._RECORD_TYPE_FIRST, records._RECORD_TYPE_MIDDLE,
+         records._RECORD_TYPE_LAST],
+        record_types(data))
+
+  def testRandomRecords(self):
+    sizes = [0, 1, 6, 7, 8, BLOCK - 7, BLOCK - 8, BLOCK - 6, BLOCK,
+             BLOCK + 1, 2 * BLOCK, 3 * BLOCK - 14, 100000]
+    for trial in range(20):
+      recs = [self.random_record(self.rand.choice(
+          sizes + [self.rand.randint(0, 200), self.rand.randint(0, 70000)]))
+              for _ in range(self.rand.randint(0, 40))]
+      self.assertSameBytes(recs, self.rand.randint(0, len(recs)),
+                           pad=trial % 3 == 0)
+
+  def testWritesContinueAfterWriteMany(self):
+    recs = [self.random_record(self.rand.randint(0, 5000)) for _ in range(40)]
+    f = cStringIO.StringIO()
+    writer = records.RecordsWriter(f)
+    writer.write_many(recs[:20])
+    for record in recs[20:]:
+      writer.write(record)
+    self.assertEqual(self.write_one_by_one(recs), f.getvalue())
+
+
+class RecordsReaderTest(unittest.TestCase):
+
+  def setUp(self):
+    self.rand = random.Random(0)
+    self.recs = random_records(self.rand, 30)
+    self.data = write_records(self.recs)
+
+  def assertResumes(self, data, expected):
+    """Checks that reading resumes from tell() after every record."""
+    for count in range(len(expected) + 1):
+      reader = records.RecordsReader(cStringIO.StringIO(data))
+      for record in expected[:count]:
+        self.assertEqual(record, reader.read())
+      position = reader.tell()
+      resumed = records.RecordsReader(cStringIO.StringIO(data))
+      resumed.seek(position)
+      self.assertEqual(position, resumed.tell())
+      self.assertEqual(expected[count:], list(resumed))
+
+  def testTellWithinBlock(self):
+    recs = ["a" * 10, "b" * 20, "c" * 30]
+    f = cStringIO.StringIO(write_records(recs))
+    reader = records.RecordsReader(f)
+    self.assertEqual(0, reader.tell())
+    self.assertEqual(recs[0], reader.read())
+    # The reader has read the whole block, but tell() is the position of the
+    # next record.
+    self.assertEqual(len(f.getvalue()), f.tell())
+    self.assertEqual(HEADER + 10, reader.tell())
+    self.assertEqual(recs[1], reader.read())
+    self.assertEqual(2 * HEADER + 30, reader.tell())
+
+  def testResume(self):
+    self.assertResumes(self.data, self.recs)
+
+  def testResumeAfterCorruptedBlock(self):
+    # Flip a byte of the second block, which loses the records in it.
+    corrupted = list(self.data)
+    corrupted[BLOCK + 100] = chr(ord(corrupted[BLOCK + 100]) ^ 1)
+    corrupted = "".join(corrupted)
+    expected = list(records.RecordsReader(cStringIO.StringIO(corrupted)))
+    self.assertTrue(0 < len(expected) < len(self.recs))
+    self.assertEqual(self.recs[-len(expected) // 2:],
+                     expected[-len(expected) // 2:])
+    self.assertResumes(corrupted, expected)
+
+  def testSeekCurrent(self):
+    reader = records.RecordsReader(cStringIO.StringIO(self.data))
+    reader.read()
+    position = reader.tell()
+    reader.seek(0, os.SEEK_CUR)
+    self.assertEqual(position, reader.tell())
+    self.assertEqual(self.recs[1:], list(reader))
+
+  def testTruncatedFile(self):
+    truncated = self.data[:len(self.data) - 10]
+    self.assertEqual(
+        self.recs[:-1],
+        list(records.RecordsReader(cStringIO.StringIO(truncated))))
+
+
+class GoogleCloudStorageRecordInputReaderTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_app_identity_stub()
+    self.testbed.init_blobstore_stub()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_urlfetch_stub()
+    self.rand = random.Random(0)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def write_file(self, filename, data):
+    with cloudstorage.open(filename, "w") as f:
+      f.write(data)
+
+  def read_with_restarts(self, filenames, restart_every):
+    """Reads all records, serializing the reader every few records."""
+    reader = input_readers._GoogleCloudStorageRecordInputReader(filenames)
+    result = []
+    while True:
+      try:
+        for _ in range(restart_every):
+          result.append(reader.next())
+      except StopIteration:
+        return result
+      reader = input_readers._GoogleCloudStorageRecordInputReader.from_json(
+          json.loads(json.dumps(reader.to_json())))
+
+  def testResumeAfterSerialization(self):
+    recs = random_records(self.rand, 40)
+    self.write_file("/bucket/a", write_records(recs[:25]))
+    self.write_file("/bucket/b", write_records(recs[25:]))
+    for restart_every in (1, 2, 7, 100):
+      self.assertEqual(
+          recs,
+          self.read_with_restarts(["/bucket/a", "/bucket/b"], restart_every))
+
+  def testResumeAfterCorruptedBlock(self):
+    data = list(write_records(random_records(self.rand, 40)))
+    data[BLOCK + 100] = chr(ord(data[BLOCK + 100]) ^ 1)
+    data = "".join(data)
+    self.write_file("/bucket/a", data)
+    expected = list(records.RecordsReader(cStringIO.StringIO(data)))
+    for restart_every in (1, 3, 100):
+      self.assertEqual(expected,
+                       self.read_with_restarts(["/bucket/a"], restart_every))
+
+
+class _SliceContext(object):
+  """Slice context that only counts, for the map_job input readers."""
+
+  def __init__(self):
+    self.counters = {}
+
+  def incr(self, counter_name, delta=1):
+    self.counters[counter_name] = self.counters.get(counter_name, 0) + delta
+
+
+class GCSRecordInputReaderTest(GoogleCloudStorageRecordInputReaderTest):
+  """Runs the same tests against the map_job GCSRecordInputReader."""
+
+  def read_with_restarts(self, filenames, restart_every):
+    """Reads all records, serializing the reader every few records."""
+    reader = _gcs.GCSRecordInputReader(filenames)
+    result = []
+    while True:
+      reader.begin_slice(_SliceContext())
+      try:
+        for _ in range(restart_every):
+          result.append(reader.next())
+      except StopIteration:
+        return result
+      reader.end_slice(None)
+      reader = _gcs.GCSRecordInputReader.from_json(
+          json.loads(json.dumps(reader.to_json())))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the user_profile job of main.py."""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+
+import collections
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import local_runner
+import main
+import sketches
+import transactions
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))), "data", "transactions.zip")
+
+
+def exact_favourites(path):
+  """Returns user -> (genre, artist) favourites counted exactly."""
+  genres = collections.defaultdict(collections.Counter)
+  artists = collections.defaultdict(collections.Counter)
+  with zipfile.ZipFile(path) as zf:
+    for name in zf.namelist():
+      for t in transactions.iter_transactions(zf.read(name)):
+        genres[t.user][t.genre] += 1
+        artists[t.user][t.artist] += 1
+  return dict((user, (sketches.top_k(genres[user], 1)[0][1],
+                      sketches.top_k(artists[user], 1)[0][1]))
+              for user in genres)
+
+
+class UserProfileTest(unittest.TestCase):
+
+  def setUp(self):
+    self.output_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.output_dir)
+
+  def run_job(self, shards, **options):
+    (args, kwargs) = main.UserProfilePipeline.mapreduce_args(
+        DATA, {}, _reader=local_runner._open_local, **options)
+    kwargs.update(shards=shards, reduce_shards=shards)
+    (filenames, _) = local_runner.run_mapreduce(
+        *args, output_dir=self.output_dir, processes=1, **kwargs)
+    favourites = {}
+    for filename in filenames:
+      with open(filename) as f:
+        for line in f:
+          (user, _, _, _, genre, artist) = line.rstrip("\n").split("\t")
+          favourites[user] = (genre, artist)
+    return favourites
+
+  def testFavouritesAreExactByDefault(self):
+    expected = exact_favourites(DATA)
+    self.assertEqual(expected, self.run_job(1))
+    self.assertEqual(expected, self.run_job(4))
+
+  def testFavouritesWithinCapacityAreExact(self):
+    # Every user bought from fewer than 200 artists, so summaries of that
+    # capacity never evict.
+    self.assertEqual(exact_favourites(DATA),
+                     self.run_job(4, profile_capacity=200))
+
+
+class UserProfileBasketsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp()
+    self.input_path = os.path.join(self.work_dir, "input.zip")
+    # Bob's second basket starts at the end of the first file and ends at the
+    # start of the second one.
+    files = (["2017.1.1 10:00\tBob\tA\tX\tL\tJazz\t3:00\t0.99",
+              "2017.1.2 11:00\tBob\tB\tX\tL\tJazz\t3:00\t0.99"],
+             ["2017.1.2 11:00\tBob\tC\tY\tL\tPop\t3:00\t0.99",
+              "2017.1.3 12:00\tAnn\tD\tY\tL\tPop\t3:00\t0.99"])
+    with zipfile.ZipFile(self.input_path, "w") as zf:
+      for i, lines in enumerate(files):
+        zf.writestr("transaction%d.txt" % (i + 1), "\n".join(lines) + "\n")
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+
+  def baskets(self, shards):
+    (args, kwargs) = main.UserProfilePipeline.mapreduce_args(
+        self.input_path, {}, _reader=local_runner._open_local)
+    kwargs.update(shards=shards, reduce_shards=shards)
+    (filenames, _) = local_runner.run_mapreduce(
+        *args, output_dir=os.path.join(self.work_dir, "output-%d" % shards),
+        processes=1, **kwargs)
+    baskets = {}
+    for filename in filenames:
+      with open(filename) as f:
+        for line in f:
+          fields = line.split("\t")
+          baskets[fields[0]] = (int(fields[2]), int(fields[3]))
+    return baskets
+
+  def testBasketAcrossFilesOfOneShard(self):
+    self.assertEqual({"Bob": (2, 3), "Ann": (1, 1)}, self.baskets(1))
+
+  def testBasketAcrossShardsIsCountedTwice(self):
+    # Documented in UserProfileMapper: each shard starts a new basket.
+    self.assertEqual({"Bob": (3, 3), "Ann": (1, 1)}, self.baskets(2))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Hourly sales series, their rollups and the sorted files they are kept in.
+
+A series is an hour -> [count, cents] dict, where hours are counted from the
+start of the proleptic Gregorian calendar (see hour_of). Series are encoded as
+delta-coded varints so that they can be shuffle values, and rolled up into
+daily and monthly series labelled with fixed-width, sortable bucket names.
+
+The jobs write series as text files of lines that start with
+'entity<TAB>bucket', sorted by entity and then bucket. scan() reads a range of
+such a file by binary search, without reading the whole file.
+"""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+
+import datetime
+import os
+
+import transactions
+
+
+# Granularities of the rollups, from the finest one.
+GRANULARITIES = ("Hourly", "Daily", "Monthly")
+
+
+def hour_of(dt):
+  """Returns the hour a datetime falls in, as an integer."""
+  return dt.toordinal() * 24 + dt.hour
+
+
+def add(series, hour, count, cents):
+  """Adds count sales worth cents to an hour of a series."""
+  totals = series.get(hour)
+  if totals is None:
+    series[hour] = [count, cents]
+  else:
+    totals[0] += count
+    totals[1] += cents
+
+
+def encode(series):
+  """Encodes a series as delta-coded (hour, count, cents) varints."""
+  chunks = []
+  previous = 0
+  for hour in sorted(series):
+    (count, cents) = series[hour]
+    chunks.append(transactions.encode_varint(hour - previous))
+    chunks.append(transactions.encode_varint(count))
+    chunks.append(transactions.encode_varint(cents))
+    previous = hour
+  return "".join(chunks)
+
+
+def merge(series, value):
+  """Adds a series encoded by encode to series."""
+  numbers = transactions.decode_varints(value)
+  hour = 0
+  for delta in numbers:
+    hour += delta
+    add(series, hour, next(numbers), next(numbers))
+
+
+def _hour_label(hour):
+  return "%sT%02d" % (datetime.date.fromordinal(hour // 24).isoformat(),
+                      hour % 24)
+
+
+def _day_label(hour):
+  return datetime.date.fromordinal(hour // 24).isoformat()
+
+
+def _month_label(hour):
+  return datetime.date.fromordinal(hour // 24).isoformat()[:7]
+
+
+_LABELS = {
+    "Hourly": _hour_label,
+    "Daily": _day_label,
+    "Monthly": _month_label,
+}
+
+
+def rollups(series):
+  """Rolls an hourly series up to every granularity.
+
+  Args:
+    series: an hour -> [count, cents] dict.
+
+  Returns:
+    A list of (granularity, buckets) tuples, one per GRANULARITIES entry, where
+    buckets is a list of (bucket, count, cents) tuples sorted by bucket.
+    Buckets are labelled 'YYYY-MM-DDTHH', 'YYYY-MM-DD' and 'YYYY-MM'.
+  """
+  result = []
+  for granularity in GRANULARITIES:
+    label = _LABELS[granularity]
+    buckets = []
+    # Labels sort like hours, so rolling up sorted hours needs no dict.
+    for hour in sorted(series):
+      (count, cents) = series[hour]
+      bucket = label(hour)
+      if buckets and buckets[-1][0] == bucket:
+        buckets[-1][1] += count
+        buckets[-1][2] += cents
+      else:
+        buckets.append([bucket, count, cents])
+    result.append((granularity, [tuple(bucket) for bucket in buckets]))
+  return result
+
+
+def _seek_line(f, offset):
+  """Seeks to the first line of f starting at or after offset."""
+  if offset:
+    f.seek(offset - 1)
+    f.readline()
+  else:
+    f.seek(0)
+
+
+def scan(f, start, end=None):
+  """Yields the lines of a sorted file from start (inclusive) to end.
+
+  The first line is found by binary search over byte offsets, so only about
+  log2(file size) lines are read before it.
+
+  Args:
+    f: a seekable file object of lines sorted in byte order.
+    start: lines before this string are skipped.
+    end: lines from this string on are not returned. Defaults to the end of
+      the file.
+
+  Yields:
+    The lines, with their line separators.
+  """
+  f.seek(0, os.SEEK_END)
+  lo = 0
+  hi = f.tell()
+  # Lines starting before lo are less than start, and the first line starting
+  # at or after hi (if any) is not.
+  while lo < hi:
+    mid = (lo + hi) // 2
+    _seek_line(f, mid)
+    position = f.tell()
+    line = f.readline()
+    if line and line < start:
+      lo = position + len(line)
+    else:
+      hi = mid
+  _seek_line(f, lo)
+  for line in iter(f.readline, ""):
+    if end is not None and line >= end:
+      break
+    yield line
+
+
+def scan_series(f, entity, first=None, last=None):
+  """Yields the buckets of an entity in a time series file.
+
+  Args:
+    f: a seekable file object of 'entity<TAB>bucket<TAB>...' lines, sorted.
+    entity: the entity to return the buckets of.
+    first: the first bucket to return, or None to start from the first one.
+    last: the last bucket to return, or None to stop at the last one.
+
+  Yields:
+    The fields of the lines of the buckets, as lists of strings.
+  """
+  prefix = entity + "\t"
+  # Bucket labels are followed by a tab, which sorts before any label
+  # character, and "\xff" sorts after any byte of UTF-8 text.
+  end = prefix + (last + "\t\xff" if last else "\xff")
+  for line in scan(f, prefix + (first or ""), end):
+    yield line.rstrip("\n").split("\t")
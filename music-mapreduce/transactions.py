@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Parser for the music store transaction files.
+
+Each transaction is a line of tab-separated fields:
+
+  timestamp, user, title, artist, album, genre, duration (m:ss), price (d.cc)
+"""
+
+# Using opensource naming conventions, pylint: disable=g-bad-name
+
+import datetime
+
+_FIELD_SEP = "\t"
+_NUM_FIELDS = 8
+
+
+class Transaction(object):
+  """A single song purchase.
+
+  Attributes:
+    timestamp: purchase time, as found in the input.
+    user: the buying user.
+    title: song title.
+    artist: song artist.
+    album: song album.
+    genre: song genre.
+    duration: song duration in seconds.
+    price: price in cents.
+  """
+
+  __slots__ = ("timestamp", "user", "title", "artist", "album", "genre",
+               "duration", "price")
+
+  def __init__(self, timestamp, user, title, artist, album, genre, duration,
+               price):
+    self.timestamp = timestamp
+    self.user = user
+    self.title = title
+    self.artist = artist
+    self.album = album
+    self.genre = genre
+    self.duration = duration
+    self.price = price
+
+  @property
+  def song(self):
+    """Key identifying the song across transactions: title-artist-album."""
+    return "-".join((self.title, self.artist, self.album))
+
+  def __repr__(self):
+    return "Transaction(%s)" % ", ".join(
+        repr(getattr(self, name)) for name in self.__slots__)
+
+
+def parse_cents(s):
+  """Parses a decimal amount such as '1.29' into integer cents."""
+  (units, _, fraction) = s.strip().partition(".")
+  cents = int(units or "0") * 100
+  if fraction:
+    value = int((fraction + "00")[:2])
+    if len(fraction) > 2 and fraction[2] >= "5":
+      value += 1
+    if units.startswith("-"):
+      value = -value
+    cents += value
+  return cents
+
+
+def format_cents(cents):
+  """Formats integer cents as a decimal amount such as '1.29'."""
+  sign = "-" if cents < 0 else ""
+  return "%s%d.%02d" % ((sign,) + divmod(abs(cents), 100))
+
+
+def encode_varint(value):
+  """Encodes an integer as a zigzag varint string."""
+  value = ~(value << 1) if value < 0 else value << 1
+  chunks = []
+  while value > 0x7f:
+    chunks.append(chr((value & 0x7f) | 0x80))
+    value >>= 7
+  chunks.append(chr(value))
+  return "".join(chunks)
+
+
+def decode_varint(s):
+  """Decodes an integer encoded by encode_varint."""
+  value = 0
+  shift = 0
+  for c in s:
+    value |= (ord(c) & 0x7f) << shift
+    shift += 7
+  return (value >> 1) ^ -(value & 1)
+
+
+def decode_varints(s):
+  """Yields the integers of a concatenation of encode_varint strings."""
+  value = 0
+  shift = 0
+  for c in s:
+    byte = ord(c)
+    value |= (byte & 0x7f) << shift
+    shift += 7
+    if byte < 0x80:
+      yield (value >> 1) ^ -(value & 1)
+      value = 0
+      shift = 0
+
+
+def parse_timestamp(s):
+  """Parses a timestamp such as '2017.2.6 20:10' into a datetime.
+
+  Returns:
+    The datetime, or None if s is malformed.
+  """
+  try:
+    (date, _, time) = s.partition(" ")
+    (year, month, day) = date.split(".")
+    (hour, minute) = time.split(":")
+    return datetime.datetime(int(year), int(month), int(day), int(hour),
+                             int(minute))
+  except ValueError:
+    return None
+
+
+def parse_duration(s):
+  """Parses a duration such as '4:05' or '1:02:03' into seconds."""
+  seconds = 0
+  for part in s.split(":"):
+    seconds = seconds * 60 + int(part)
+  return seconds
+
+
+def parse_transaction(line):
+  """Parses one transaction line.
+
+  Args:
+    line: the line, with or without its trailing newline.
+
+  Returns:
+    A Transaction, or None if the line is blank, short or malformed.
+  """
+  fields = line.rstrip("\r\n").split(_FIELD_SEP)
+  if len(fields) < _NUM_FIELDS:
+    return None
+  try:
+    return Transaction(fields[0], fields[1], fields[2], fields[3], fields[4],
+                       fields[5], parse_duration(fields[6]),
+                       parse_cents(fields[7]))
+  except ValueError:
+    return None
+
+
+def iter_lines(text):
+  """Lazily yields the lines of a string, without the line separators."""
+  start = 0
+  end = text.find("\n")
+  while end != -1:
+    yield text[start:end]
+    start = end + 1
+    end = text.find("\n", start)
+  if start < len(text):
+    yield text[start:]
+
+
+def iter_transactions(data):
+  """Yields the transactions of a file, skipping lines that do not parse.
+
+  Args:
+    data: the file contents, either as a string or as an iterable of lines.
+
+  Yields:
+    Transaction instances in file order.
+  """
+  if isinstance(data, basestring):
+    data = iter_lines(data)
+  for line in data:
+    transaction = parse_transaction(line)
+    if transaction is not None:
+      yield transaction